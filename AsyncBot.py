@@ -0,0 +1,557 @@
+"""asyncio mode of the Teamspeak3 Bot."""
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import inspect
+import logging
+import threading
+import time
+
+import ts3API.Events as Events
+from ts3API import utilities
+from ts3API.TS3Connection import TS3Connection, TS3QueryException
+from ts3API.utilities import TS3ConnectionClosedException
+
+import Bot
+import ClientInfo
+import CommandHandler
+import EventHandler
+import MessageQueue
+import Moduleloader
+import Profiler
+import QueryPipeline
+import ServerGroups
+
+logger = logging.getLogger("bot")
+
+
+class AsyncTS3Connection(object):
+    """
+    Non-blocking ServerQuery connection on asyncio streams. The server answers queries in the
+    order they were sent, so any number of queries can be in flight at the same time. Events are
+    parsed on the event loop and passed to event_listener. Only raw TCP connections are supported.
+    """
+
+    def __init__(self, host, port, keepalive_interval=5):
+        """
+        Create a new, unconnected AsyncTS3Connection.
+        :param host: Host to connect to, can be a IP or a host name
+        :param port: Port to connect to
+        :param keepalive_interval: Seconds between keepalive queries.
+        """
+        self.host = host
+        self.port = int(port)
+        self.keepalive_interval = keepalive_interval
+        # Called with the connection as sender and the event as keyword argument event
+        self.event_listener = None
+        self._reader = None
+        self._writer = None
+        # Futures and collected data lines of the queries waiting for their response
+        self._pending = collections.deque()
+        self._tasks = []
+        self.closed = None
+
+    async def connect(self):
+        """
+        Connect to the server and start reading responses and events.
+        """
+        loop = asyncio.get_running_loop()
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        # Skip the welcome message
+        await self._reader.readuntil(b"\n\r")
+        await self._reader.readuntil(b"\n\r")
+        self.closed = loop.create_future()
+        self._tasks.append(loop.create_task(self._read_loop()))
+        self._tasks.append(loop.create_task(self._keepalive_loop()))
+
+    async def _read_loop(self):
+        """
+        Read lines from the server, resolve pending queries and dispatch events.
+        """
+        try:
+            while True:
+                line = (await self._reader.readuntil(b"\n\r"))[:-2]
+                if line.startswith(b"notify"):
+                    self._dispatch_event(line)
+                elif line.startswith(b"error "):
+                    self._resolve(line)
+                elif len(self._pending) > 0:
+                    self._pending[0][1].append(line)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.info("ServerQuery connection closed")
+        finally:
+            while len(self._pending) > 0:
+                future, _ = self._pending.popleft()
+                if not future.done():
+                    future.set_exception(TS3ConnectionClosedException())
+            if not self.closed.done():
+                self.closed.set_result(None)
+
+    def _resolve(self, line):
+        """
+        Resolve the oldest pending query with an error line.
+        :param line: Error line, e.g. b"error id=0 msg=ok"
+        :type line: bytes
+        """
+        if len(self._pending) == 0:
+            logger.warning("Response without pending query: %s", line)
+            return
+        future, data = self._pending.popleft()
+        if future.done():
+            return
+        error = TS3Connection._parse_resp_to_dict(line[len(b"error "):])
+        error_id = int(error.get("id", "-1"))
+        if error_id != 0:
+            future.set_exception(TS3QueryException(error_id, error.get("msg", "")))
+        else:
+            future.set_result(b"".join(data))
+
+    # We really want to catch all exceptions here, a broken event must not stop the read loop
+    # noinspection PyBroadException
+    def _dispatch_event(self, line):
+        """
+        Parse an event line and pass the event to the event listener.
+        :param line: Event line, e.g. b"notifycliententerview ..."
+        :type line: bytes
+        """
+        try:
+            event_type, _, rest = line.decode(encoding='UTF-8').partition(" ")
+            data = {}
+            for part in rest.split(" "):
+                key, _, value = part.partition("=")
+                data[key] = utilities.unescape(value)
+            event = Events.EventParser.parse_event(data, event_type)
+        except BaseException:
+            logger.exception("Error parsing event %s", line)
+            return
+        if self.event_listener is not None:
+            self.event_listener(self, event=event)
+
+    async def send(self, command, args=None):
+        """
+        Send a query and wait for its response.
+        :param command: Command, not escaped.
+        :type command: str
+        :param args: Arguments, escaped before sending.
+        :type args: list[str]
+        :return: Raw response data.
+        :rtype: bytes
+        """
+        query = command
+        for arg in args or []:
+            query += " " + utilities.escape(arg)
+        if self._writer is None or self.closed.done():
+            raise TS3ConnectionClosedException()
+        future = asyncio.get_running_loop().create_future()
+        start = time.perf_counter()
+        # No await between queueing the future and writing, the responses keep the query order
+        self._pending.append((future, []))
+        self._writer.write(query.encode("utf-8") + b"\n\r")
+        future.add_done_callback(functools.partial(QueryPipeline.observe_query, command, start))
+        await self._writer.drain()
+        return await future
+
+    async def query(self, command, args=None):
+        """
+        Send a query and parse its response to a list of dictionaries.
+        :rtype: list[dict[str, str]]
+        """
+        return TS3Connection._parse_resp_to_list_of_dicts(await self.send(command, args))
+
+    async def login(self, user, password):
+        await self.send("login", [user, password])
+
+    async def use(self, sid):
+        await self.send("use", ["sid=" + str(sid)])
+
+    async def whoami(self):
+        return TS3Connection._parse_resp_to_dict(await self.send("whoami"))
+
+    async def clientinfo(self, clid):
+        return TS3Connection._parse_resp_to_dict(await self.send("clientinfo", ["clid=" + str(clid)]))
+
+    async def clientlist(self, params=None):
+        return await self.query("clientlist", ["-" + param for param in params or []])
+
+    async def clientmove(self, channel_id, client_id):
+        await self.send("clientmove", ["cid=" + str(channel_id), "clid=" + str(client_id)])
+
+    async def sendtextmessage(self, targetmode, target, msg):
+        await self.send("sendtextmessage", ["targetmode=" + str(targetmode), "target=" + str(target),
+                                            "msg=" + str(msg)])
+
+    async def _keepalive_loop(self):
+        """
+        Keep the query session from timing out.
+        """
+        while not self.closed.done():
+            await asyncio.sleep(self.keepalive_interval)
+            try:
+                await self.send("version")
+            except TS3ConnectionClosedException:
+                return
+
+    async def close(self):
+        """
+        Quit the query session and close the connection.
+        """
+        if self._writer is None:
+            return
+        try:
+            if not self.closed.done():
+                self._writer.write(b"quit\n\r")
+                await self._writer.drain()
+        except ConnectionError:
+            pass
+        for task in self._tasks:
+            task.cancel()
+        self._writer.close()
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+
+class SyncTS3Connection(QueryPipeline.PipelinedTS3Connection):
+    """
+    Blocking TS3Connection on top of an AsyncTS3Connection. All queries of TS3Connection work and
+    are sent on the event loop, so the existing setup, caches and plugins can run in executor
+    threads. Must not be used from the event loop thread.
+    """
+
+    # TS3Connection.__init__ would open a connection of its own
+    # noinspection PyMissingConstructor
+    def __init__(self, async_conn, loop):
+        """
+        Create a new SyncTS3Connection.
+        :param async_conn: Connection to send the queries on.
+        :type async_conn: AsyncTS3Connection
+        :param loop: Event loop of async_conn.
+        :type loop: asyncio.AbstractEventLoop
+        """
+        self._async_conn = async_conn
+        self._loop = loop
+        self._loop_thread = threading.get_ident()
+        self._logger = logging.getLogger("ts3API.TS3Connection")
+        self.stop_recv = threading.Event()
+
+    def _connect(self, signal_names, event_listener, weak_ref):
+        # Events are passed to the event_listener of the AsyncTS3Connection, the register_for methods
+        # only register for the notifications on the server
+        pass
+
+    def send_async(self, command, args=None):
+        return asyncio.run_coroutine_threadsafe(self._async_conn.send(command, args), self._loop)
+
+    def _send(self, command, args=None, wait_for_resp=True, log_keepalive=False):
+        if threading.get_ident() == self._loop_thread:
+            raise RuntimeError("Blocking query " + command + " on the event loop thread")
+        future = self.send_async(command, args)
+        if not wait_for_resp:
+            return None
+        return future.result()
+
+    @property
+    def in_flight(self):
+        return len(self._async_conn._pending)
+
+    def start_keepalive_loop(self, interval=5):
+        # The AsyncTS3Connection keeps the session alive
+        pass
+
+    def quit(self):
+        self.stop_recv.set()
+        if not self._loop.is_closed():
+            asyncio.run_coroutine_threadsafe(self._async_conn.close(), self._loop)
+
+
+class AsyncEventDispatcher(object):
+    """
+    Dispatcher of the EventHandler in asyncio mode. Every observer has its own queue drained by a
+    task on the event loop, so an observer sees its events in order. Coroutine observers are
+    awaited, all other observers run in the executor.
+    """
+    is_async = True
+
+    def __init__(self, loop, executor, max_queue_size=1000):
+        """
+        Create a new AsyncEventDispatcher.
+        :param loop: Event loop to run the observers on.
+        :type loop: asyncio.AbstractEventLoop
+        :param executor: Executor for observers that are no coroutine functions.
+        :type executor: concurrent.futures.Executor
+        :param max_queue_size: Maximum number of pending events per observer, newer events are
+        dropped.
+        :type max_queue_size: int
+        """
+        self.loop = loop
+        self.executor = executor
+        self.max_queue_size = max_queue_size
+        self.dropped = 0
+        self._queues = {}
+        self._tasks = {}
+        self._in_flight = 0
+        EventHandler._dispatchers.add(self)
+
+    @property
+    def queue_depth(self):
+        """
+        Get the number of events waiting to be dispatched.
+        :rtype: int
+        """
+        return sum(len(queue) for queue in self._queues.values())
+
+    @property
+    def in_flight(self):
+        """
+        Get the number of observers currently handling an event.
+        :rtype: int
+        """
+        return self._in_flight
+
+    @property
+    def workers(self):
+        """
+        Get the number of observers currently being drained.
+        :rtype: int
+        """
+        return len(self._tasks)
+
+    def submit(self, obs, evt):
+        """
+        Queue an event for an observer. Can be called from any thread.
+        :param obs: Observer to inform.
+        :param evt: Event to pass.
+        """
+        self.loop.call_soon_threadsafe(self._submit, obs, evt)
+
+    def _submit(self, obs, evt):
+        queue = self._queues.get(obs)
+        if queue is None:
+            queue = collections.deque()
+            self._queues[obs] = queue
+        if len(queue) >= self.max_queue_size:
+            self.dropped += 1
+            EventHandler.events_dropped.inc()
+            EventHandler.EventHandler.logger.warning("Queue of %s full, dropping %s", obs,
+                                                     type(evt).__name__)
+            return
+        queue.append(evt)
+        if obs not in self._tasks:
+            self._tasks[obs] = self.loop.create_task(self._drain(obs, queue))
+
+    # We really want to catch all exceptions here, a bad observer must not stop the dispatcher
+    # noinspection PyBroadException
+    async def _drain(self, obs, queue):
+        try:
+            while len(queue) > 0:
+                evt = queue.popleft()
+                self._in_flight += 1
+                start = time.perf_counter()
+                try:
+                    if inspect.iscoroutinefunction(obs):
+                        await obs(evt)
+                    else:
+                        await self.loop.run_in_executor(self.executor, Profiler.call, obs, (evt,), None,
+                                                        type(evt).__name__)
+                except Exception:
+                    EventHandler.EventHandler.logger.exception("Exception while informing %s of event of type %s",
+                                                               str(obs), type(evt).__name__)
+                finally:
+                    EventHandler.observer_seconds.labels(EventHandler.observer_name(obs)).observe(
+                        time.perf_counter() - start)
+                    self._in_flight -= 1
+        finally:
+            del self._tasks[obs]
+            if len(queue) == 0:
+                self._queues.pop(obs, None)
+
+    def stop(self):
+        """
+        Cancel all pending events.
+        """
+        for task in list(self._tasks.values()):
+            task.cancel()
+
+
+class AsyncCommandHandler(CommandHandler.CommandHandler):
+    """
+    CommandHandler for asyncio mode. Commands are handled on the event loop, coroutine handlers
+    are awaited and all other handlers run in the executor.
+    """
+    is_async = True
+
+    def __init__(self, ts3conn, async_conn, executor, client_registry=None, identity=None, group_ttl=300):
+        """
+        Create new AsyncCommandHandler.
+        :param ts3conn: Blocking connection, passed to ClientInfo
+        :param async_conn: Connection to query client infos and send replies on
+        :type async_conn: AsyncTS3Connection
+        :param executor: Executor for handlers that are no coroutine functions
+        :type executor: concurrent.futures.Executor
+        """
+        super().__init__(ts3conn, client_registry=client_registry, identity=identity, group_ttl=group_ttl)
+        self.async_conn = async_conn
+        self.executor = executor
+
+    async def get_client_info_async(self, clid, client_data=None):
+        """
+        Get the ClientInfo of a client without blocking the event loop, see get_client_info.
+        :param clid: Client id.
+        :param client_data: Client data to use, e.g. from the client registry. Queried if None.
+        :rtype: ClientInfo.ClientInfo
+        """
+        if client_data is None:
+            client_data = await self.async_conn.clientinfo(clid)
+            if self.client_registry is not None:
+                self.client_registry.update(clid, client_data)
+        # The server group names may have to be reloaded with blocking queries
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, functools.partial(ClientInfo.ClientInfo, clid, self.ts3conn, client_data=client_data))
+
+    async def allowed_handlers_async(self, handlers, sender):
+        """
+        Get the handlers the sender of a command may use without blocking the event loop, see
+        allowed_handlers.
+        :rtype: list[function]
+        """
+        client_data = self.registered_client(sender)
+        if client_data is not None:
+            ci = await self.get_client_info_async(sender, client_data=client_data)
+            allowed = [handler for handler in handlers if self.check_permission(handler, ci)]
+            if len(allowed) > 0:
+                return allowed
+        ci = await self.get_client_info_async(sender)
+        return [handler for handler in handlers if self.check_permission(handler, ci)]
+
+    async def handle_command(self, msg, sender=0):
+        """
+        Handle a new command by informing the corresponding handlers.
+        :param msg: Command message.
+        :param sender: Client id of the sender.
+        """
+        logger.debug("Handling message %s", msg)
+        msg = CommandHandler.CommandMessage(msg)
+        if len(msg.name) == 0:
+            return
+        start = time.perf_counter()
+        command = self.resolve(msg.name)
+        handlers = self.handlers.get(command)
+        if handlers is None:
+            Bot.send_msg_to_client(self.ts3conn, sender, "I cannot interpret your command. I am very sorry. :(")
+            logger.info("Unknown command %s received!", msg)
+            CommandHandler.observe_command("unknown", "unknown", start)
+            return
+        msg.command = command
+        handled = False
+        for handler in await self.allowed_handlers_async(handlers, sender):
+            handled = True
+            if inspect.iscoroutinefunction(handler):
+                await handler(sender, msg)
+            else:
+                await asyncio.get_running_loop().run_in_executor(self.executor, Profiler.call, handler,
+                                                                 (sender, msg), command)
+        if not handled:
+            Bot.send_msg_to_client(self.ts3conn, sender, "You are not allowed to use this command!")
+        CommandHandler.observe_command(command, "handled" if handled else "denied", start)
+
+    async def inform(self, event):
+        """
+        Inform the CommandHandler of a new event.
+        :param event:  New event.
+        """
+        if type(event) is Events.TextMessageEvent:
+            if event.targetmode == "Private":
+                if event.invoker_id != self.identity.client_id:  # Don't talk to yourself ...
+                    self.logger.info("Message: %s from: %s", event.message, event.invoker_name)
+                    await self.handle_command(event.message, sender=event.invoker_id)
+
+
+async def run_all(bots):
+    """
+    Run several bots on the running event loop until all connections are closed.
+    :type bots: list[AsyncTs3Bot]
+    """
+    await asyncio.gather(*(bot.run() for bot in bots))
+
+
+class AsyncTs3Bot(Bot.Ts3Bot):
+    """
+    Teamspeak 3 Bot running on an asyncio event loop. Queries, events and commands are handled on
+    the loop. The setup of the bot and plugin functions that are no coroutine functions run in a
+    thread pool with a blocking view of the connection.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.loop = None
+        self.async_conn = None
+        self.executor = None
+        self.plugins = None
+        super().__init__(*args, **kwargs)
+
+    @staticmethod
+    def bot_from_config(config):
+        """
+        Create a bot from the values parsed from config.ini
+        :param config: a configuration for the bot
+        :type config: dict
+        :return: Created Bot, start it by running AsyncTs3Bot.run
+        :rtype: AsyncTs3Bot
+        """
+        logger = logging.getLogger("bot")
+        plugins = config
+        config = config.pop('General')
+        return AsyncTs3Bot(logger=logger, plugins=plugins, **config)
+
+    def start(self, plugins):
+        """
+        Only remember the plugins, the bot is started by run.
+        :param plugins: Main bot config with plugins section
+        """
+        self.plugins = plugins
+
+    def create_handlers(self):
+        """
+        Create the command and event handler of the bot and start receiving events.
+        """
+        self.command_handler = AsyncCommandHandler(self.ts3conn, self.async_conn, self.executor,
+                                                   client_registry=self.client_registry, identity=self.identity,
+                                                   group_ttl=self.group_cache_ttl)
+        dispatcher = AsyncEventDispatcher(self.loop, self.executor, max_queue_size=self.event_queue_size)
+        self.event_handler = EventHandler.EventHandler(ts3conn=self.ts3conn, command_handler=self.command_handler,
+                                                       dispatcher=dispatcher)
+        self.async_conn.event_listener = self.event_handler.on_event
+
+    async def run(self):
+        """
+        Connect, set up the bot, load the plugins and run until the connection is closed.
+        """
+        if self.is_ssh:
+            self.logger.error("SSH connections are not supported in asyncio mode")
+            return
+        self.loop = asyncio.get_running_loop()
+        # Bots may share the loop, so each passes its own executor instead of setting the default one
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.event_workers)
+        self.async_conn = AsyncTS3Connection(self.host, self.port)
+        # Import the plugins while connecting
+        Moduleloader.preload(self.plugins)
+        try:
+            with Moduleloader.timed("Connecting bot of server " + str(self.sid)):
+                await self.async_conn.connect()
+                await self.async_conn.login(self.user, self.password)
+        except (OSError, TS3QueryException):
+            self.logger.exception("Error while connecting, IP propably not whitelisted or Login data wrong!")
+            await self.async_conn.close()
+            return
+        self.ts3conn = SyncTS3Connection(self.async_conn, self.loop)
+        with Moduleloader.timed("Setting up bot of server " + str(self.sid)):
+            await self.loop.run_in_executor(self.executor, self.setup_bot)
+        if self.event_handler is None:
+            await self.async_conn.close()
+            return
+        with Moduleloader.timed("Loading plugins for server " + str(self.sid)):
+            await Moduleloader.load_modules_async(self, self.plugins)
+        await self.async_conn.closed
+        self.logger.info("Connection closed, stopping")
+        MessageQueue.close_queue(self.ts3conn, timeout=0)
+        ServerGroups.remove_cache(self.ts3conn)
+        self.event_handler.stop()
@@ -1,24 +1,43 @@
+import concurrent.futures
 import configparser
+import contextlib
+import functools
 import logging
 import os
 from distutils.util import strtobool
 
+import ts3API.Events as Events
 import ts3API.TS3Connection
 from ts3API.TS3Connection import TS3QueryException
 from ts3API.TS3QueryExceptionType import TS3QueryExceptionType
 
+import ChannelIndex
+import ClientRegistry
 import CommandHandler
+import ConnectionPool
 import EventHandler
+import EventRecorder
+import MessageQueue
+import LogPipeline
 import Moduleloader
+import QueryPipeline
+import ServerGroups
 
 
 def stop_conn(ts3conn):
+    """
+    Stop a connection after sending the messages still waiting in its message queue.
+    :param ts3conn: TS3Connection to stop.
+    """
+    MessageQueue.close_queue(ts3conn)
+    ServerGroups.remove_cache(ts3conn)
     ts3conn.stop_recv.set()
 
 
 def send_msg_to_client(ts3conn, clid, msg):
     """
-    Convenience method for sending a message to a client without having a bot object.
+    Convenience method for sending a message to a client without having a bot object. The message
+    is queued and sent rate limited, see MessageQueue. Does not block.
     :param ts3conn: TS3Connection to send message on.
     :type ts3conn: ts3API.TS3Connection
     :param clid: Client id of the client to send too.
@@ -27,26 +46,127 @@ def send_msg_to_client(ts3conn, clid, msg):
     :type msg: str
     :return:
     """
-    try:
-        ts3conn.sendtextmessage(targetmode=1, target=clid, msg=msg)
-    except ts3API.TS3Connection.TS3QueryException:
-        logger = logging.getLogger("bot")
-        logger.exception("Error sending a message to clid " + str(clid))
+    MessageQueue.get_queue(ts3conn).send(clid, msg)
+
+
+def move_clients(ts3conn, moves, chunk_size=50):
+    """
+    Move several clients with as few queries as possible. The moves are grouped by destination
+    channel and sent as clientmove queries with up to chunk_size client ids each. If a query
+    fails, its clients are moved one by one to find out which moves failed. Clients that already
+    are in their destination channel count as moved. The queries are pipelined if the connection
+    supports it.
+    :param ts3conn: TS3Connection to move the clients on.
+    :type ts3conn: ts3API.TS3Connection
+    :param moves: Pairs of client id and destination channel id.
+    :type moves: collections.abc.Iterable[(int, int)]
+    :param chunk_size: Maximum number of clients moved with a single query.
+    :type chunk_size: int
+    :return: Dictionary of client ids that could not be moved and the corresponding exception.
+    :rtype: dict[int, TS3QueryException]
+    """
+    by_channel = {}
+    for clid, cid in moves:
+        by_channel.setdefault(int(cid), []).append(int(clid))
+    chunks = [(cid, clids[i:i + chunk_size]) for cid, clids in by_channel.items()
+              for i in range(0, len(clids), chunk_size)]
+    # TS3Connection escapes all arguments, so the "|" separating the client ids has to be part of
+    # the command itself
+    results = QueryPipeline.send_many(ts3conn, [("clientmove cid=" + str(cid) + " " +
+                                                 "|".join("clid=" + str(clid) for clid in chunk), None)
+                                                for cid, chunk in chunks])
+    failed = {}
+    retries = []
+    for (cid, chunk), result in zip(chunks, results):
+        if isinstance(result, TS3QueryException):
+            if len(chunk) == 1:
+                if result.type != TS3QueryExceptionType.CHANNEL_ALREADY_IN:
+                    failed[chunk[0]] = result
+            else:
+                retries.extend((clid, cid) for clid in chunk)
+    results = QueryPipeline.send_many(ts3conn, [("clientmove", ["cid=" + str(cid), "clid=" + str(clid)])
+                                                for clid, cid in retries])
+    for (clid, cid), result in zip(retries, results):
+        if isinstance(result, TS3QueryException) and result.type != TS3QueryExceptionType.CHANNEL_ALREADY_IN:
+            failed[clid] = result
+    return failed
+
+
+class BotIdentity(object):
+    """
+    Identity of the query client of the bot. Captured with whoami once after selecting the virtual
+    server and kept current from move events of the bot.
+    """
+    event_types = (Events.ClientMovedEvent, Events.ClientMovedSelfEvent)
+
+    def __init__(self):
+        self.client_id = None
+        self.database_id = None
+        self.server_id = None
+        self.channel_id = None
+
+    def refresh(self, ts3conn):
+        """
+        Reload the identity with whoami.
+        :param ts3conn: TS3Connection of the bot.
+        :type ts3conn: ts3API.TS3Connection
+        """
+        who = ts3conn.whoami()
+        self.client_id = int(who.get("client_id", '-1'))
+        self.database_id = int(who.get("client_database_id", '-1'))
+        self.server_id = int(who.get("virtualserver_id", '-1'))
+        self.channel_id = int(who.get("client_channel_id", '-1'))
+
+    def on_event(self, evt):
+        """
+        Update the current channel if the bot was moved.
+        :param evt: ClientMovedEvent or ClientMovedSelfEvent
+        """
+        if evt.client_id == self.client_id:
+            self.channel_id = evt.target_channel_id
 
 
 class Ts3Bot:
     """
     Teamspeak 3 Bot with module support.
     """
+    def move_clients(self, moves, chunk_size=50):
+        """
+        Move several clients with as few queries as possible, see Bot.move_clients.
+        :param moves: Pairs of client id and destination channel id.
+        :type moves: collections.abc.Iterable[(int, int)]
+        :param chunk_size: Maximum number of clients moved with a single query.
+        :type chunk_size: int
+        :return: Dictionary of client ids that could not be moved and the corresponding exception.
+        :rtype: dict[int, TS3QueryException]
+        """
+        with self.query_connection() as conn:
+            return move_clients(conn, moves, chunk_size=chunk_size)
+
+    def query_connection(self, timeout=5):
+        """
+        Borrow a connection for read queries and bulk operations. This is a connection of the query
+        pool if one is configured and the primary connection otherwise. Use it as context manager:
+        `with bot.query_connection() as conn: ...`
+        :param timeout: Seconds to wait for an idle pool connection before using the primary one.
+        :type timeout: float
+        """
+        if self.query_pool is None:
+            return contextlib.nullcontext(self.ts3conn)
+        return self.query_pool.connection(fallback=self.ts3conn, timeout=timeout)
+
     def get_channel_id(self, name):
         """
-        Covenience method for getting a channel by name.
+        Covenience method for getting a channel by name. Looks up the channel index, a channel with
+        exactly this name is preferred.
         :param name: Channel name to search for, can be a pattern
         :type name: str
-        :return: Channel id of the first channel found
-        :rtype: int
+        :return: Channel id of the first channel found or None if no channel was found
+        :rtype: int | None
         """
-        ret = self.ts3conn.channelfind(pattern=name)
+        ret = self.channel_index.find_exact(name) or self.channel_index.find(name)
+        if len(ret) == 0:
+            return None
         return int(ret[0]["cid"])
 
     @staticmethod
@@ -63,6 +183,22 @@ class Ts3Bot:
         config = config.pop('General')
         return Ts3Bot(logger=logger, plugins=plugins, **config)
 
+    @classmethod
+    def bots_from_config(cls, config):
+        """
+        Create a bot for every virtual server in the comma separated ServerId list of config.ini. The
+        plugins are loaded once and shared by all bots.
+        :param config: a configuration for the bots
+        :type config: dict
+        :return: Created Bots
+        :rtype: list[Ts3Bot]
+        """
+        logger = logging.getLogger("bot")
+        plugins = config
+        config = config.pop('General')
+        sids = [sid.strip() for sid in config.pop('serverid').split(',') if len(sid.strip()) > 0]
+        return [cls(logger=logger, plugins=plugins, serverid=sid, **config) for sid in sids]
+
     @staticmethod
     def parse_config(logger):
         """
@@ -83,21 +219,30 @@ class Ts3Bot:
             exit()
         return config._sections
 
+    def new_connection(self):
+        """
+        Open and log in a new query connection to the server specified by self.host and self.port.
+        :rtype: QueryPipeline.PipelinedTS3Connection
+        """
+        return QueryPipeline.PipelinedTS3Connection(self.host, self.port,
+                                                    use_ssh=self.is_ssh, username=self.user,
+                                                    password=self.password, accept_all_keys=self.accept_all_keys,
+                                                    host_key_file=self.host_key_file,
+                                                    use_system_hosts=self.use_system_hosts, sshtimeout=self.sshtimeout, sshtimeoutlimit=self.sshtimeoutlimit,
+                                                    max_in_flight=self.query_pipeline_depth)
+
     def connect(self):
         """
         Connect to the server specified by self.host and self.port.
         :return:
         """
         try:
-            self.ts3conn = ts3API.TS3Connection.TS3Connection(self.host, self.port,
-                                                              use_ssh=self.is_ssh, username=self.user,
-                                                              password=self.password, accept_all_keys=self.accept_all_keys,
-                                                              host_key_file=self.host_key_file,
-                                                              use_system_hosts=self.use_system_hosts, sshtimeout=self.sshtimeout, sshtimeoutlimit=self.sshtimeoutlimit)
+            self.ts3conn = self.new_connection()
             # self.ts3conn.login(self.user, self.password)
         except ts3API.TS3Connection.TS3QueryException:
             self.logger.exception("Error while connecting, IP propably not whitelisted or Login data wrong!")
             # This is a very ungraceful exit!
+            LogPipeline.stop()
             os._exit(-1)
             raise
 
@@ -105,9 +250,11 @@ class Ts3Bot:
         """
         Setup routine for new bot. Does the following things:
             1. Select virtual server specified by self.sid
-            2. Set bot nickname to the Name specified by self.bot_name
-            3. Move the bot to the channel specified by self.default_channel
-            4. Register command and event handlers
+            2. Load the server groups, the channels and the identity of the bot
+            3. Set bot nickname to the Name specified by self.bot_name
+            4. Move the bot to the channel specified by self.default_channel
+            5. Register command and event handlers
+            6. Load the client registry
         :return:
         """
         try:
@@ -116,6 +263,9 @@ class Ts3Bot:
             self.logger.exception("Error on use SID")
             exit()
         try:
+            self.server_groups = ServerGroups.get_cache(self.ts3conn, ttl=self.group_cache_ttl)
+            self.channel_index = ChannelIndex.ChannelIndex(self.ts3conn)
+            self.load_server_data()
             try:
                 self.ts3conn.clientupdate(["client_nickname=" + self.bot_name])
             except TS3QueryException as e:
@@ -125,7 +275,11 @@ class Ts3Bot:
                     raise e
             try:
                 self.channel = self.get_channel_id(self.default_channel)
-                self.ts3conn.clientmove(self.channel, int(self.ts3conn.whoami()["client_id"]))
+                if self.channel is None:
+                    self.logger.error("The configured default channel does not exist")
+                else:
+                    self.ts3conn.clientmove(self.channel, self.identity.client_id)
+                    self.identity.channel_id = self.channel
             except TS3QueryException as e:
                 if e.type == TS3QueryExceptionType.CHANNEL_ALREADY_IN:
                     self.logger.info("The bot is already in the configured default channel")
@@ -135,22 +289,157 @@ class Ts3Bot:
             self.logger.exception("Error on setting up client")
             self.ts3conn.quit()
             return
-        self.command_handler = CommandHandler.CommandHandler(self.ts3conn)
-        self.event_handler = EventHandler.EventHandler(ts3conn=self.ts3conn, command_handler=self.command_handler)
+        self.setup_message_queue()
+        self.setup_query_pool()
+        self.client_registry = ClientRegistry.ClientRegistry(self.ts3conn)
+        self.create_handlers()
+        self.server_groups.add_listener(self.command_handler.permissions.clear)
+        self.client_registry.register(self.event_handler)
+        self.channel_index.register(self.event_handler)
+        for event_type in BotIdentity.event_types:
+            self.event_handler.add_observer(self.identity.on_event, event_type)
         try:
             self.ts3conn.register_for_server_events(self.event_handler.on_event)
             self.ts3conn.register_for_channel_events(0, self.event_handler.on_event)
             self.ts3conn.register_for_private_messages(self.event_handler.on_event)
+            self.ts3conn.register_for_unknown_events(self.event_handler.on_event)
         except ts3API.TS3Connection.TS3QueryException:
             self.logger.exception("Error on registering for events.")
             exit()
+        try:
+            self.client_registry.load()
+        except ts3API.TS3Connection.TS3QueryException:
+            self.logger.exception("Error on loading the client list.")
+        self.setup_event_recorder()
+
+    def load_server_data(self):
+        """
+        Load the server groups, the identity of the bot and the channels. The queries are independent,
+        so they are sent at the same time on the pipelined connection.
+        """
+        with Moduleloader.timed("Loading server data of server " + str(self.sid)), \
+                concurrent.futures.ThreadPoolExecutor(max_workers=3, thread_name_prefix="load") as executor:
+            loads = [executor.submit(self.server_groups.refresh),
+                     executor.submit(self.identity.refresh, self.ts3conn),
+                     executor.submit(self.channel_index.load)]
+            for load in loads:
+                load.result()
+
+    def setup_event_recorder(self):
+        """
+        Record all events to the file configured with RecordEvents. The server groups, channels,
+        clients and identity of the bot are recorded first, so a replay starts from the same state.
+        """
+        if self.record_events is None:
+            return
+        recorder = EventRecorder.get_recorder(self.record_events)
+        recorder.snapshot(self.sid, "whoami", [{"client_id": self.identity.client_id,
+                                                "client_channel_id": self.identity.channel_id,
+                                                "client_database_id": self.identity.database_id,
+                                                "virtualserver_id": self.identity.server_id}])
+        recorder.snapshot(self.sid, "servergrouplist", [{"sgid": sgid, "name": name}
+                                                        for sgid, name in self.server_groups.items()])
+        recorder.snapshot(self.sid, "channellist", self.channel_index.channels())
+        recorder.snapshot(self.sid, "clientlist", self.client_registry.clients())
+        self.event_handler.recorder = functools.partial(recorder.record, sid=self.sid)
+        self.logger.info("Recording events to %s", self.record_events)
+
+    def setup_message_queue(self):
+        """
+        Create the outbound message queue. Unless configured, its rate limit is derived from the query
+        flood settings of the server.
+        """
+        rate, burst = self.message_rate, self.message_burst
+        if rate is None or burst is None:
+            limits = MessageQueue.flood_limits(self.ts3conn) or (5.0, 10)
+            rate = limits[0] if rate is None else rate
+            burst = limits[1] if burst is None else burst
+        self.message_queue = MessageQueue.get_queue(self.ts3conn, rate=rate, burst=burst)
+        self.logger.info("Sending at most %s text messages per second, bursts of %s", rate, burst)
+
+    def open_pool_connection(self, index):
+        """
+        Open a connection for the query pool on the virtual server of the bot.
+        :param index: Index of the connection in the pool.
+        :type index: int
+        :rtype: QueryPipeline.PipelinedTS3Connection
+        """
+        conn = self.new_connection()
+        try:
+            conn.use(sid=self.sid)
+            try:
+                conn.clientupdate(["client_nickname=" + self.bot_name + " " + str(index + 1)])
+            except TS3QueryException as e:
+                if e.type != TS3QueryExceptionType.CLIENT_NICKNAME_INUSE:
+                    raise e
+        except TS3QueryException:
+            conn.quit()
+            raise
+        conn.start_keepalive_loop()
+        return conn
+
+    def setup_query_pool(self):
+        """
+        Open the query connection pool if QueryPoolSize is set.
+        """
+        if self.query_pool_size <= 0:
+            return
+        self.query_pool = ConnectionPool.ConnectionPool(self.open_pool_connection, self.query_pool_size)
+        self.query_pool.open()
+
+    def create_handlers(self):
+        """
+        Create the command and event handler of the bot.
+        """
+        self.command_handler = CommandHandler.CommandHandler(self.ts3conn, client_registry=self.client_registry,
+                                                             identity=self.identity, group_ttl=self.group_cache_ttl)
+        self.event_handler = EventHandler.EventHandler(ts3conn=self.ts3conn, command_handler=self.command_handler,
+                                                       workers=self.event_workers,
+                                                       max_queue_size=self.event_queue_size)
+
+    def start(self, plugins):
+        """
+        Connect, set up the bot and load the plugins.
+        :param plugins: Main bot config with plugins section
+        """
+        # Import the plugins while connecting
+        Moduleloader.preload(plugins)
+        with Moduleloader.timed("Connecting bot of server " + str(self.sid)):
+            self.connect()
+        with Moduleloader.timed("Setting up bot of server " + str(self.sid)):
+            self.setup_bot()
+        # Load modules
+        with Moduleloader.timed("Loading plugins for server " + str(self.sid)):
+            Moduleloader.load_modules(self, plugins)
+        self.ts3conn.start_keepalive_loop()
+
+    def shutdown(self):
+        """
+        Quit the bot: send the messages still waiting in the message queue, stop informing event
+        listeners and close the connections.
+        """
+        if self.ts3conn is not None:
+            MessageQueue.close_queue(self.ts3conn)
+        if self.event_handler is not None:
+            self.event_handler.stop()
+        if self.query_pool is not None:
+            self.query_pool.close()
+        if self.ts3conn is not None:
+            ServerGroups.remove_cache(self.ts3conn)
+            self.ts3conn.quit()
 
     def __del__(self):
+        if self.query_pool is not None:
+            self.query_pool.close()
         if self.ts3conn is not None:
+            MessageQueue.close_queue(self.ts3conn, timeout=0)
+            ServerGroups.remove_cache(self.ts3conn)
             self.ts3conn.quit()
 
     def __init__(self, host, port, serverid, user, password, defaultchannel, botname, logger, plugins, ssh="False",
-                 acceptallsshkeys="False", sshhostkeyfile=None, sshloadsystemhostkeys="False", sshtimeout=None, sshtimeoutlimit=3, *_, **__):
+                 acceptallsshkeys="False", sshhostkeyfile=None, sshloadsystemhostkeys="False", sshtimeout=None, sshtimeoutlimit=3, eventworkers="4", eventqueuesize="1000",
+                 groupcachettl="300", querypipelinedepth="8", messagerate=None,
+                 messageburst=None, querypoolsize="0", recordevents=None, *_, **__):
         """
         Create a new Ts3Bot.
         :param host: Host to connect to, can be a IP or a host name
@@ -161,6 +450,14 @@ class Ts3Bot:
         :param default_channel: Channel to move the bot to
         :param bot_name: Nickname of the bot
         :param logger: Logger to use throughout the bot
+        :param eventworkers: Number of threads informing event observers
+        :param eventqueuesize: Maximum number of pending events per observer
+        :param groupcachettl: Seconds after which the cached server groups are reloaded
+        :param querypipelinedepth: Maximum number of queries sent without waiting for their response
+        :param messagerate: Text messages sent per second, derived from the server flood settings if None
+        :param messageburst: Text messages sent at once, derived from the server flood settings if None
+        :param querypoolsize: Number of additional query connections for read queries and bulk operations
+        :param recordevents: File to record all events to, see EventRecorder
         """
         self.host = host
         self.port = port
@@ -181,9 +478,19 @@ class Ts3Bot:
         self.use_system_hosts = bool(strtobool(sshloadsystemhostkeys))
         self.sshtimeout = sshtimeout
         self.sshtimeoutlimit = sshtimeoutlimit
+        self.event_workers = int(eventworkers)
+        self.event_queue_size = int(eventqueuesize)
+        self.group_cache_ttl = int(groupcachettl)
+        self.query_pipeline_depth = int(querypipelinedepth)
+        self.message_rate = None if messagerate is None else float(messagerate)
+        self.message_burst = None if messageburst is None else int(messageburst)
+        self.message_queue = None
+        self.query_pool_size = int(querypoolsize)
+        self.query_pool = None
+        self.record_events = recordevents
+        self.server_groups = None
+        self.client_registry = None
+        self.channel_index = None
+        self.identity = BotIdentity()
 
-        self.connect()
-        self.setup_bot()
-        # Load modules
-        Moduleloader.load_modules(self, plugins)
-        self.ts3conn.start_keepalive_loop()
+        self.start(plugins)
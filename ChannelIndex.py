@@ -0,0 +1,277 @@
+"""Channel index for the Teamspeak3 Bot."""
+import bisect
+import logging
+import re
+import threading
+
+import ts3API.Events as Events
+
+logger = logging.getLogger("bot")
+
+
+class ChannelIndex(object):
+    """
+    In-memory index of the channel tree of the virtual server. The channels are loaded once with
+    channellist and kept current from channel events. Channels are stored as dictionaries with the
+    keys channellist uses (cid, pid, channel_order, channel_name, ...). Events that cannot be
+    applied, e.g. for unknown channels, invalidate the index and it is reloaded once by the next
+    lookup, concurrent lookups wait for that load.
+    """
+    event_types = (Events.ChannelEditedEvent, Events.ChannelCreatedEvent, Events.ChannelDeletedEvent,
+                   Events.ChannelMovedEvent)
+
+    def __init__(self, ts3conn):
+        """
+        Create a new, empty ChannelIndex.
+        :param ts3conn: TS3Connection to load the channels from.
+        """
+        self.ts3conn = ts3conn
+        self._lock = threading.RLock()
+        # Held while loading, so concurrent lookups of an invalid index load it once
+        self._load_lock = threading.Lock()
+        self._channels = {}
+        self._by_name = {}
+        self._sorted_names = None
+        self._valid = False
+        # Incremented on every invalidation, a load started before is outdated
+        self._generation = 0
+        # Events received while loading, applied again to the loaded channels. None if not loading.
+        self._received = None
+
+    def load(self):
+        """
+        (Re-)load all channels from the server. Channel events received while the channel list is
+        queried are applied to the loaded list, the list may have been sent before them. If the
+        index was invalidated meanwhile, it stays invalid and is reloaded on the next lookup.
+        """
+        with self._load_lock:
+            self._load()
+
+    def _load(self):
+        """
+        Load all channels, see load. Caller must hold the load lock.
+        """
+        with self._lock:
+            generation = self._generation
+            self._received = []
+        try:
+            channels = self.ts3conn.channellist()
+        except BaseException:
+            with self._lock:
+                self._received = None
+            raise
+        with self._lock:
+            self._channels = {}
+            self._by_name = {}
+            for channel in channels:
+                self._add(channel)
+            # Changes already contained in the list are applied again, which does not change them
+            for evt in self._received:
+                self._apply(evt)
+            self._received = None
+            self._valid = self._generation == generation
+        logger.debug("Loaded %d channels into index", len(channels))
+
+    def invalidate(self):
+        """
+        Mark the index as outdated, it is reloaded on the next lookup.
+        """
+        with self._lock:
+            self._generation += 1
+            self._valid = False
+
+    def register(self, event_handler):
+        """
+        Register the index as observer for channel events.
+        :param event_handler: EventHandler to register to.
+        :type event_handler: EventHandler.EventHandler
+        """
+        for event_type in ChannelIndex.event_types:
+            event_handler.add_observer(self.on_event, event_type)
+
+    def on_event(self, evt):
+        """
+        Update the index from a channel event.
+        :param evt: ChannelEditedEvent, ChannelCreatedEvent, ChannelDeletedEvent or
+        ChannelMovedEvent
+        """
+        with self._lock:
+            if self._received is not None:
+                self._received.append(evt)
+            if not self._apply(evt) and self._received is None:
+                logger.debug("Event for unknown channel %s, invalidating channel index", evt.channel_id)
+                self.invalidate()
+
+    def _apply(self, evt):
+        """
+        Apply a channel event to the index. Caller must hold the lock.
+        :return: False if the event is for an unknown channel.
+        :rtype: bool
+        """
+        cid = int(evt.channel_id)
+        if isinstance(evt, Events.ChannelCreatedEvent):
+            channel = {key: value for key, value in evt.data.items()
+                       if key.startswith("channel_")}
+            channel["cid"] = str(cid)
+            channel["pid"] = evt.data.get("cpid", '0')
+            self._remove(cid)
+            self._add(channel)
+        elif isinstance(evt, Events.ChannelDeletedEvent):
+            self._remove(cid)
+        elif cid not in self._channels:
+            return False
+        elif isinstance(evt, Events.ChannelMovedEvent):
+            self._channels[cid]["pid"] = str(evt.channel_pid)
+            self._channels[cid]["channel_order"] = str(evt.channel_order)
+        else:
+            channel = self._remove(cid)
+            channel.update((key, value) for key, value in evt.data.items()
+                           if key.startswith("channel_"))
+            self._add(channel)
+        return True
+
+    def _add(self, channel):
+        """
+        Add a channel to the index. Caller must hold the lock.
+        :type channel: dict[str, str]
+        """
+        cid = int(channel.get("cid", '-1'))
+        self._channels[cid] = channel
+        self._by_name.setdefault(channel.get("channel_name", ''), set()).add(cid)
+        self._sorted_names = None
+
+    def _remove(self, cid):
+        """
+        Remove a channel from the index. Caller must hold the lock.
+        :type cid: int
+        :return: Removed channel or None.
+        :rtype: dict[str, str] | None
+        """
+        channel = self._channels.pop(cid, None)
+        if channel is not None:
+            name = channel.get("channel_name", '')
+            cids = self._by_name.get(name, set())
+            cids.discard(cid)
+            if len(cids) == 0:
+                self._by_name.pop(name, None)
+            self._sorted_names = None
+        return channel
+
+    def _ensure_valid(self):
+        """
+        Reload the index if it was invalidated.
+        """
+        if not self._valid:
+            with self._load_lock:
+                # Another lookup may have loaded it while waiting
+                if not self._valid:
+                    self._load()
+
+    def get(self, cid):
+        """
+        Get a channel by id.
+        :param cid: Channel id.
+        :type cid: int | str
+        :return: Channel dictionary or None if there is no such channel. Do not modify it.
+        :rtype: dict[str, str] | None
+        """
+        self._ensure_valid()
+        return self._channels.get(int(cid))
+
+    def channels(self):
+        """
+        Get all channels.
+        :return: List of channel dictionaries.
+        :rtype: list[dict[str, str]]
+        """
+        self._ensure_valid()
+        with self._lock:
+            return list(self._channels.values())
+
+    def names(self):
+        """
+        Get the names of all channels.
+        :rtype: list[str]
+        """
+        self._ensure_valid()
+        with self._lock:
+            return [channel.get("channel_name", '') for channel in self._channels.values()]
+
+    def children(self, cid):
+        """
+        Get the direct sub channels of a channel ordered like in the channel tree.
+        :param cid: Channel id of the parent, 0 for top level channels.
+        :type cid: int | str
+        :rtype: list[dict[str, str]]
+        """
+        self._ensure_valid()
+        with self._lock:
+            children = {int(channel.get("channel_order", '0')): channel
+                        for channel in self._channels.values()
+                        if channel.get("pid", '0') == str(cid)}
+        # channel_order is the id of the channel above, 0 for the first one
+        ordered = []
+        above = 0
+        while above in children:
+            channel = children.pop(above)
+            ordered.append(channel)
+            above = int(channel.get("cid", '-1'))
+        return ordered + list(children.values())
+
+    def find_exact(self, name):
+        """
+        Get all channels with exactly the given name.
+        :type name: str
+        :rtype: list[dict[str, str]]
+        """
+        self._ensure_valid()
+        with self._lock:
+            return [self._channels[cid] for cid in self._by_name.get(name, ())]
+
+    def find_prefix(self, prefix):
+        """
+        Get all channels with a name starting with prefix.
+        :type prefix: str
+        :rtype: list[dict[str, str]]
+        """
+        self._ensure_valid()
+        with self._lock:
+            names = self._sorted_names
+            if names is None:
+                names = sorted(self._by_name)
+                self._sorted_names = names
+            channels = []
+            for i in range(bisect.bisect_left(names, prefix), len(names)):
+                if not names[i].startswith(prefix):
+                    break
+                channels.extend(self._channels[cid] for cid in self._by_name[names[i]])
+            return channels
+
+    def find(self, pattern):
+        """
+        Get all channels with a name containing pattern, ignoring case. This corresponds to the
+        channelfind query.
+        :type pattern: str
+        :rtype: list[dict[str, str]]
+        """
+        self._ensure_valid()
+        pattern = pattern.lower()
+        with self._lock:
+            return [channel for channel in self._channels.values()
+                    if pattern in channel.get("channel_name", '').lower()]
+
+    def match(self, regex):
+        """
+        Get all channels with a name matching a regular expression.
+        :param regex: Regular expression, searched for in the channel names.
+        :type regex: str
+        :rtype: list[dict[str, str]]
+        """
+        self._ensure_valid()
+        compiled = re.compile(regex)
+        with self._lock:
+            return [channel for channel in self._channels.values()
+                    if compiled.search(channel.get("channel_name", '')) is not None]
+
+    def __len__(self):
+        return len(self._channels)
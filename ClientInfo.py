@@ -1,6 +1,8 @@
 import logging
 import re
 
+import ServerGroups
+
 logger = logging.getLogger("bot")
 
 
@@ -10,26 +12,30 @@ class ClientInfo:
     The attributes in this object have been filtered, if you want to know about all
     possible attributes, use print(client_data[0].keys())
     """
-    def __init__(self, client_id, ts3conn):
-        if client_id == "-1":
-            logger.error("Trying to get ClientInfo of clid=-1")
-            logger.warning("Giving out mock object ...")
-            client_data = [{}]
-        else:
-            client_data = ts3conn.clientinfo(client_id)
+    def __init__(self, client_id, ts3conn, client_data=None):
+        """
+        Create a new ClientInfo.
+        :param client_id: Client id of the client.
+        :param ts3conn: TS3Connection to use.
+        :param client_data: Known client data, e.g. from the ClientRegistry. If given, no clientinfo
+        query is sent and attributes not contained in the data are empty.
+        :type client_data: dict[str, str]
+        """
+        if client_data is None:
+            if client_id == "-1":
+                logger.error("Trying to get ClientInfo of clid=-1")
+                logger.warning("Giving out mock object ...")
+                client_data = {}
+            else:
+                client_data = ts3conn.clientinfo(client_id)
         self._name = client_data.get('client_nickname', '')
         self._unique_id = client_data.get('client_unique_identifier', '')
         self._database_id = client_data.get('client_database_id', '')
-        # servergroups is a list of strings
-        sgs = {}
-        for g in ts3conn.servergrouplist():
-            sgs[g.get('sgid')] = g.get('name')
+        # servergroups is a list of strings, the names are resolved on first use
         servergroups_list = client_data.get('client_servergroups', '').split(',')
-        self._servergroups = []
-        for g in servergroups_list:
-            n = sgs.get(g)
-            if n is not None:
-                self._servergroups.append(n)
+        self._ts3conn = ts3conn
+        self._servergroup_ids = tuple(servergroups_list)
+        self._servergroups = None
         self._description = client_data.get('client_description', '')
         self._country = client_data.get('client_country', '')
         self._created = client_data.get('client_created', '')
@@ -48,8 +54,8 @@ class ClientInfo:
         self._channel_id = client_data.get('cid', '-1')
         if len(servergroups_list) == 0:
             logger.error("Client without servergroups parsed ...")
-            logger.error("IP: " + self.ip + "Name: " + self.name + "channel_id: " + self.channel_id)
-            logger.error(str(client_data))
+            logger.error("IP: %sName: %schannel_id: %s", self.ip, self.name, self.channel_id)
+            logger.error("%s", client_data)
 
     @property
     def channel_id(self):
@@ -65,10 +71,16 @@ class ClientInfo:
 
     @property
     def servergroups(self):
+        if self._servergroups is None:
+            self._servergroups = ServerGroups.get_cache(self._ts3conn).names(self._servergroup_ids)
         return self._servergroups
 
+    @property
+    def servergroup_ids(self):
+        return self._servergroup_ids
+
     def is_in_servergroups(self, pattern):
-        for g in self._servergroups:
+        for g in self.servergroups:
             if re.search(pattern=pattern, string=g) is not None:
                 return True
         return False
@@ -0,0 +1,227 @@
+"""Client registry for the Teamspeak3 Bot."""
+import logging
+import threading
+import time
+
+import ts3API.Events as Events
+
+logger = logging.getLogger("bot")
+
+
+class ClientRegistry(object):
+    """
+    In-memory mirror of the clients connected to the virtual server. The registry is loaded once
+    with clientlist and kept current from ClientEntered, ClientMoved and ClientLeft events.
+    Clients are stored as dictionaries with the same keys clientlist uses (clid, cid,
+    client_database_id, client_nickname, client_type, client_away, client_servergroups,
+    client_unique_identifier) and indexed by channel and server group. Server group changes are
+    applied from notifyservergroupclientadded/-deleted if the server sends them, otherwise
+    client_servergroups is only as current as the last clientlist or clientinfo of the client, see
+    groups_age.
+    """
+    event_types = (Events.ClientEnteredEvent, Events.ClientMovedEvent, Events.ClientMovedSelfEvent,
+                   Events.ClientLeftEvent)
+    _group_events = {"notifyservergroupclientadded": True, "notifyservergroupclientdeleted": False}
+    _enter_keys = ('client_database_id', 'client_nickname', 'client_type', 'client_away',
+                   'client_servergroups', 'client_unique_identifier')
+
+    def __init__(self, ts3conn):
+        """
+        Create a new, empty ClientRegistry.
+        :param ts3conn: TS3Connection to load the clients from.
+        """
+        self.ts3conn = ts3conn
+        self._lock = threading.RLock()
+        self._clients = {}
+        self._by_channel = {}
+        self._by_group = {}
+        self._confirmed = {}
+
+    def load(self):
+        """
+        (Re-)load all clients from the server.
+        """
+        clients = self.ts3conn.clientlist(["uid", "away", "groups"])
+        with self._lock:
+            self._clients = {}
+            self._by_channel = {}
+            self._by_group = {}
+            self._confirmed = {}
+            for client in clients:
+                self._add(client)
+        logger.debug("Loaded %d clients into registry", len(clients))
+
+    def register(self, event_handler):
+        """
+        Register the registry as observer for client events and unknown events, which include the
+        server group changes.
+        :param event_handler: EventHandler to register to.
+        :type event_handler: EventHandler.EventHandler
+        """
+        for event_type in ClientRegistry.event_types:
+            event_handler.add_observer(self.on_event, event_type)
+        event_handler.add_observer(self.on_event, Events.TS3Event)
+
+    def on_event(self, evt):
+        """
+        Update the registry from a client event.
+        :param evt: ClientEnteredEvent, ClientMovedEvent, ClientMovedSelfEvent, ClientLeftEvent or
+                    an unknown event, only server group changes are handled of those
+        """
+        if isinstance(evt, Events.ClientEnteredEvent):
+            client = {key: evt.data.get(key, '') for key in ClientRegistry._enter_keys}
+            client['clid'] = str(evt.client_id)
+            client['cid'] = str(evt.target_channel_id)
+            with self._lock:
+                self._remove(evt.client_id)
+                self._add(client)
+        elif isinstance(evt, (Events.ClientMovedEvent, Events.ClientMovedSelfEvent)):
+            with self._lock:
+                client = self._clients.get(evt.client_id)
+                if client is None:
+                    logger.debug("Moved client %d is not in the registry", evt.client_id)
+                    return
+                self._by_channel.get(int(client['cid']), set()).discard(evt.client_id)
+                client['cid'] = str(evt.target_channel_id)
+                self._by_channel.setdefault(evt.target_channel_id, set()).add(evt.client_id)
+        elif isinstance(evt, Events.ClientLeftEvent):
+            with self._lock:
+                self._remove(evt.client_id)
+        elif evt.__dict__.get("_event_type") in ClientRegistry._group_events:
+            self._update_group(evt.data.get("clid"), evt.data.get("sgid"),
+                               ClientRegistry._group_events[evt.__dict__["_event_type"]])
+
+    def _update_group(self, clid, sgid, added):
+        """
+        Add a client to or remove it from a server group.
+        :param clid: Client id.
+        :type clid: str
+        :param sgid: Server group id.
+        :type sgid: str
+        :param added: True if the client was added to the group.
+        :type added: bool
+        """
+        if clid is None or sgid is None:
+            return
+        with self._lock:
+            client = self._clients.get(int(clid))
+            if client is None:
+                return
+            groups = [g for g in client.get('client_servergroups', '').split(',') if len(g) > 0 and g != sgid]
+            if added:
+                groups.append(sgid)
+            client = dict(client, client_servergroups=",".join(groups))
+            self._remove(int(clid))
+            self._add(client)
+
+    def update(self, clid, client_data):
+        """
+        Update a client with fresh data, e.g. from clientinfo. Unknown clients are added.
+        :param clid: Client id.
+        :type clid: int | str
+        :param client_data: Client data using clientlist/clientinfo keys.
+        :type client_data: dict[str, str]
+        """
+        clid = int(clid)
+        with self._lock:
+            client = dict(self._clients.get(clid, {}))
+            for key in ClientRegistry._enter_keys + ('cid',):
+                if key in client_data:
+                    client[key] = client_data[key]
+            client['clid'] = str(clid)
+            self._remove(clid)
+            self._add(client)
+
+    def _add(self, client):
+        """
+        Add a client to the registry and its indices. Its server groups count as confirmed by the
+        server. Caller must hold the lock.
+        :param client: Client dictionary.
+        :type client: dict[str, str]
+        """
+        clid = int(client.get('clid', '-1'))
+        self._clients[clid] = client
+        self._confirmed[clid] = time.monotonic()
+        self._by_channel.setdefault(int(client.get('cid', '-1')), set()).add(clid)
+        for sgid in ClientRegistry._groups_of(client):
+            self._by_group.setdefault(sgid, set()).add(clid)
+
+    def _remove(self, clid):
+        """
+        Remove a client from the registry and its indices. Caller must hold the lock.
+        :param clid: Client id.
+        :type clid: int
+        """
+        client = self._clients.pop(clid, None)
+        self._confirmed.pop(clid, None)
+        if client is None:
+            return
+        self._by_channel.get(int(client.get('cid', '-1')), set()).discard(clid)
+        for sgid in ClientRegistry._groups_of(client):
+            self._by_group.get(sgid, set()).discard(clid)
+
+    @staticmethod
+    def _groups_of(client):
+        """
+        Get the server group ids of a client dictionary.
+        :rtype: list[int]
+        """
+        return [int(g) for g in client.get('client_servergroups', '').split(',') if len(g) > 0]
+
+    def get(self, clid):
+        """
+        Get a client by id.
+        :param clid: Client id.
+        :type clid: int | str
+        :return: Client dictionary or None if the client is unknown. Do not modify it.
+        :rtype: dict[str, str] | None
+        """
+        return self._clients.get(int(clid))
+
+    def groups_age(self, clid):
+        """
+        Get the seconds since the server groups of a client were last received from the server.
+        :param clid: Client id.
+        :type clid: int | str
+        :return: Age in seconds or None if the client is unknown.
+        :rtype: float | None
+        """
+        confirmed = self._confirmed.get(int(clid))
+        return None if confirmed is None else time.monotonic() - confirmed
+
+    def clients(self):
+        """
+        Get all clients.
+        :return: List of client dictionaries.
+        :rtype: list[dict[str, str]]
+        """
+        with self._lock:
+            return list(self._clients.values())
+
+    def in_channel(self, cid):
+        """
+        Get all clients in a channel.
+        :param cid: Channel id.
+        :type cid: int | str
+        :return: List of client dictionaries.
+        :rtype: list[dict[str, str]]
+        """
+        with self._lock:
+            return [self._clients[clid] for clid in self._by_channel.get(int(cid), ())]
+
+    def in_servergroup(self, sgid):
+        """
+        Get all clients that are member of a server group.
+        :param sgid: Server group id.
+        :type sgid: int | str
+        :return: List of client dictionaries.
+        :rtype: list[dict[str, str]]
+        """
+        with self._lock:
+            return [self._clients[clid] for clid in self._by_group.get(int(sgid), ())]
+
+    def __len__(self):
+        return len(self._clients)
+
+    def __contains__(self, clid):
+        return int(clid) in self._clients
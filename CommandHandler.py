@@ -1,34 +1,112 @@
 """Commandhandler for the Teamspeak3 Bot."""
 import logging
+import shlex
+import time
 
 import ts3API.Events as Events
 
 import Bot
+import LogPipeline
+import Metrics
 import ClientInfo
+import Permissions
+import Profiler
 
 logger = logging.getLogger("bot")
 
 
+def tokenize(text):
+    """
+    Split a message into words. Words can be grouped with double quotes, e.g. to pass channel
+    names containing spaces. Falls back to splitting at whitespace if the quotes are unbalanced.
+    :param text: Text to split.
+    :type text: str
+    :return: List of words.
+    :rtype: list[str]
+    """
+    lexer = shlex.shlex(text, posix=True)
+    lexer.whitespace_split = True
+    lexer.quotes = '"'
+    lexer.escape = ''
+    lexer.commenters = ''
+    try:
+        return list(lexer)
+    except ValueError:
+        return text.split()
+
+
+command_seconds = Metrics.histogram("ts3bot_command_seconds", "Time to handle text commands", ("command",))
+commands_handled = Metrics.counter("ts3bot_commands", "Text commands by command and result", ("command", "result"))
+
+
+def observe_command(command, result, start):
+    """
+    Record a handled command in the metrics.
+    :param command: Resolved command, "unknown" for unknown commands.
+    :param result: handled, denied or unknown.
+    :param start: time.perf_counter() when handling started.
+    """
+    commands_handled.labels(command, result).inc()
+    command_seconds.labels(command).observe(time.perf_counter() - start)
+
+
+class CommandMessage(str):
+    """
+    A command message parsed once by the CommandHandler. It is still the complete message string,
+    so handlers can keep using it as such, but additionally offers:
+        name: The command as typed without the leading "!"
+        command: The registered command name resolves to (after alias and prefix resolution)
+        args: Tuple of arguments, double quoted arguments may contain spaces
+        rest: Everything after the command as typed, e.g. the text of a quote
+    """
+
+    def __new__(cls, msg):
+        message = super().__new__(cls, msg)
+        parts = msg.split(None, 1)
+        message.name = parts[0][1:] if len(parts) > 0 else ''
+        message.command = message.name
+        message.rest = parts[1].strip() if len(parts) > 1 else ''
+        message.args = tuple(tokenize(message.rest))
+        return message
+
+
 class CommandHandler:
     """
     Command handler class that listens for PrivateMessages and informs registered handlers of possible commands.
     """
-    def __init__(self, ts3conn):
+    is_async = False
+
+    def __init__(self, ts3conn, client_registry=None, identity=None, group_ttl=300):
         """
         Create new CommandHandler.
         :param ts3conn: TS3Connection to use
+        :param client_registry: ClientRegistry to look up clients in before querying the server
+        :type client_registry: ClientRegistry.ClientRegistry
+        :param identity: Identity of the bot, used to ignore the bots own messages
+        :type identity: Bot.BotIdentity
+        :param group_ttl: Seconds the server groups of a client in the registry are trusted, 0 trusts
+                          them until a permission check fails
+        :type group_ttl: int
         """
         self.ts3conn = ts3conn
-        self.logger = logging.getLogger("textMsg")
-        self.logger.setLevel(logging.INFO)
-        file_handler = logging.FileHandler("msg.log", mode='a+')
-        formatter = logging.Formatter('MSG Logger %(asctime)s %(message)s')
-        file_handler.setFormatter(formatter)
-        self.logger.addHandler(file_handler)
-        self.logger.propagate = 0
+        self.client_registry = client_registry
+        self.group_ttl = group_ttl
+        if identity is None:
+            identity = Bot.BotIdentity()
+            identity.refresh(ts3conn)
+        self.identity = identity
+        self.logger = LogPipeline.file_logger("textMsg", "msg.log", 'MSG Logger %(asctime)s %(message)s')
         self.handlers = {}
+        # Alias -> command, set with add_alias
+        self.aliases = {}
+        # Command, alias or unique prefix of a command marked with @allow_prefix -> command, rebuilt
+        # on demand
+        self._index = None
+        # Prefixes shorter than this are not resolved to commands
+        self.min_prefix_length = 3
         # Default groups if group not specified.
         self.accept_from_groups = ['Server Admin', 'Moderator']
+        self.permissions = Permissions.PermissionEngine(self.accept_from_groups)
 
     def add_handler(self, handler, command):
         """
@@ -38,10 +116,126 @@ class CommandHandler:
         :param command: Command to handle.
         :type command: str
         """
+        self.permissions.register(handler)
         if self.handlers.get(command) is None:
             self.handlers[command] = [handler]
         else:
             self.handlers[command].append(handler)
+        self._index = None
+
+    def remove_handler(self, handler, command):
+        """
+        Remove a handler for a command.
+        :param handler: Handler function to remove.
+        :param command: Command the handler was added for.
+        :type command: str
+        """
+        handlers = self.handlers.get(command)
+        if handlers is None or handler not in handlers:
+            return
+        handlers = [h for h in handlers if h is not handler]
+        if len(handlers) == 0:
+            del self.handlers[command]
+        else:
+            self.handlers[command] = handlers
+        self.permissions.unregister(handler)
+        self._index = None
+
+    def add_alias(self, alias, command):
+        """
+        Add an alias for a command.
+        :param alias: Alias to add.
+        :type alias: str
+        :param command: Command the alias stands for.
+        :type command: str
+        """
+        self.aliases[alias] = command
+        self._index = None
+
+    def _build_index(self):
+        """
+        Build the lookup index of commands. Commands and aliases map to themselves, prefixes of at
+        least min_prefix_length characters map to a command if they are unique among all commands
+        and all handlers of the command are marked with @allow_prefix.
+        :rtype: dict[str, str]
+        """
+        index = {}
+        ambiguous = set()
+        for command in self.handlers:
+            for length in range(self.min_prefix_length, len(command)):
+                prefix = command[:length]
+                if index.get(prefix, command) != command:
+                    ambiguous.add(prefix)
+                index[prefix] = command
+        for prefix in ambiguous:
+            del index[prefix]
+        for prefix, command in list(index.items()):
+            if not all(getattr(handler, "allow_prefix", False) for handler in self.handlers[command]):
+                del index[prefix]
+        for alias, command in self.aliases.items():
+            index[alias] = command
+        for command in self.handlers:
+            index[command] = command
+        return index
+
+    def resolve(self, name):
+        """
+        Resolve a command name, alias or unique prefix of a command allowing prefixes to a registered
+        command.
+        :param name: Name as typed without the leading "!".
+        :type name: str
+        :return: Registered command or None if the name cannot be resolved.
+        :rtype: str | None
+        """
+        index = self._index
+        if index is None:
+            index = self._build_index()
+            self._index = index
+        return index.get(name)
+
+    def get_client_info(self, clid):
+        """
+        Query the ClientInfo of a client from the server and update the client registry with it.
+        :param clid: Client id.
+        :rtype: ClientInfo.ClientInfo
+        """
+        client_data = self.ts3conn.clientinfo(clid)
+        if self.client_registry is not None:
+            self.client_registry.update(clid, client_data)
+        return ClientInfo.ClientInfo(clid, self.ts3conn, client_data=client_data)
+
+    def registered_client(self, clid):
+        """
+        Get the data of a client from the client registry if its server groups are recent enough to
+        check permissions with.
+        :param clid: Client id.
+        :return: Client dictionary or None if the client has to be queried.
+        :rtype: dict[str, str] | None
+        """
+        if self.client_registry is None:
+            return None
+        age = self.client_registry.groups_age(clid)
+        if age is None or (self.group_ttl > 0 and age > self.group_ttl):
+            return None
+        return self.client_registry.get(clid)
+
+    def allowed_handlers(self, handlers, sender):
+        """
+        Get the handlers the sender of a command may use. The server groups of the sender are taken
+        from the client registry. Not all group changes are announced by the server, so the client
+        info is queried if they are outdated or allow none of the handlers.
+        :param handlers: Handlers of the command.
+        :param sender: Client id of the sender.
+        :rtype: list[function]
+        """
+        client_data = self.registered_client(sender)
+        if client_data is not None:
+            ci = ClientInfo.ClientInfo(sender, self.ts3conn, client_data=client_data)
+            allowed = [handler for handler in handlers if self.check_permission(handler, ci)]
+            if len(allowed) > 0:
+                return allowed
+        ci = self.get_client_info(sender)
+        return [handler for handler in handlers if self.check_permission(handler, ci)]
 
     def check_permission(self, handler, clientinfo):
         """
@@ -50,15 +244,7 @@ class CommandHandler:
         :param clientinfo: Client info of the client that tries to use the command.
         :return:
         """
-        if hasattr(handler, "allowed_groups"):
-            for group in handler.allowed_groups:
-                if clientinfo.is_in_servergroups(group):
-                    return True
-        else:
-            for group in self.accept_from_groups:
-                if clientinfo.is_in_servergroups(group):
-                    return True
-        return False
+        return self.permissions.check(handler, clientinfo)
 
     def handle_command(self, msg, sender=0):
         """
@@ -66,23 +252,25 @@ class CommandHandler:
         :param msg: Command message.
         :param sender: Client id of the sender.
         """
-        logger.debug("Handling message " + msg)
-        command = msg.split(None, 1)[0]
-        if len(command) > 1:
-            command = command[1:]
+        logger.debug("Handling message %s", msg)
+        msg = CommandMessage(msg)
+        if len(msg.name) > 0:
+            start = time.perf_counter()
+            command = self.resolve(msg.name)
             handlers = self.handlers.get(command)
-            ci = ClientInfo.ClientInfo(sender, self.ts3conn)
-            handled = False 
+            handled = False
             if handlers is not None:
-                for handler in handlers:
-                    if self.check_permission(handler, ci):
-                        handled = True
-                        handler(sender, msg)
+                msg.command = command
+                for handler in self.allowed_handlers(handlers, sender):
+                    handled = True
+                    Profiler.call(handler, (sender, msg), command=command)
                 if not handled:
                     Bot.send_msg_to_client(self.ts3conn, sender, "You are not allowed to use this command!")
+                observe_command(command, "handled" if handled else "denied", start)
             else:
                 Bot.send_msg_to_client(self.ts3conn, sender, "I cannot interpret your command. I am very sorry. :(")
-                logger.info("Unknown command " + msg + " received!")
+                logger.info("Unknown command %s received!", msg)
+                observe_command("unknown", "unknown", start)
 
     def inform(self, event):
         """
@@ -91,7 +279,6 @@ class CommandHandler:
         """
         if type(event) is Events.TextMessageEvent:
             if event.targetmode == "Private":
-                if event.invoker_id != int(self.ts3conn.whoami()["client_id"]):  # Don't talk to yourself ...
-                    ci = ClientInfo.ClientInfo(event.invoker_id, self.ts3conn)
-                    self.logger.info("Message: " + event.message + " from: " + ci.name)
+                if event.invoker_id != self.identity.client_id:  # Don't talk to yourself ...
+                    self.logger.info("Message: %s from: %s", event.message, event.invoker_name)
                     self.handle_command(event.message, sender=event.invoker_id)
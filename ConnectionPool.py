@@ -0,0 +1,124 @@
+"""Pool of additional query connections for the Teamspeak3 Bot."""
+import contextlib
+import logging
+import queue
+import threading
+
+from ts3API.utilities import TS3Exception
+
+logger = logging.getLogger("bot")
+
+
+class ConnectionPool(object):
+    """
+    Pool of authenticated query connections on the virtual server of the bot. The pool connections
+    do not register for events, events stay on the primary connection. Read queries and bulk
+    operations borrow a pool connection so they do not delay queries on the primary connection,
+    e.g. command replies.
+    """
+
+    def __init__(self, factory, size):
+        """
+        Create a new, empty ConnectionPool, call open to connect.
+        :param factory: Function creating a new connection on the virtual server of the bot, called
+        with the index of the connection in the pool.
+        :param size: Number of connections.
+        :type size: int
+        """
+        self.factory = factory
+        self.size = size
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._connections = {}
+
+    # We really want to catch all exceptions here, a broken pool connection must not stop the bot
+    # noinspection PyBroadException
+    def _open(self, index):
+        """
+        Open the connection with the given index and make it available.
+        :type index: int
+        :return: True if the connection was opened.
+        :rtype: bool
+        """
+        try:
+            conn = self.factory(index)
+        except BaseException:
+            logger.exception("Error opening pool connection %d", index)
+            return False
+        with self._lock:
+            self._connections[index] = conn
+        self._idle.put(index)
+        return True
+
+    def open(self):
+        """
+        Open all connections of the pool.
+        :return: Number of connections opened.
+        :rtype: int
+        """
+        opened = sum(1 for index in range(self.size) if self._open(index))
+        logger.info("Opened %d of %d pool connections", opened, self.size)
+        return opened
+
+    @property
+    def available(self):
+        """
+        Get the number of idle connections.
+        :rtype: int
+        """
+        return self._idle.qsize()
+
+    @property
+    def alive(self):
+        """
+        Get the number of open connections.
+        :rtype: int
+        """
+        return len(self._connections)
+
+    @contextlib.contextmanager
+    def connection(self, fallback=None, timeout=None):
+        """
+        Borrow a connection from the pool. Closed connections are reopened when they are returned.
+        :param fallback: Connection to use if the pool has no open connections.
+        :param timeout: Seconds to wait for an idle connection before using fallback, wait forever
+        if None.
+        :type timeout: float
+        :return: Context manager yielding the connection.
+        """
+        index = None
+        if self.alive > 0:
+            try:
+                index = self._idle.get(timeout=timeout)
+            except queue.Empty:
+                index = None
+        if index is None:
+            if fallback is None:
+                raise TS3Exception("No pool connection available")
+            yield fallback
+            return
+        conn = self._connections[index]
+        try:
+            yield conn
+        finally:
+            if conn.stop_recv.is_set():
+                logger.warning("Pool connection %d was closed, reopening", index)
+                with self._lock:
+                    self._connections.pop(index, None)
+                threading.Thread(target=self._open, args=(index,), daemon=True).start()
+            else:
+                self._idle.put(index)
+
+    # noinspection PyBroadException
+    def close(self):
+        """
+        Quit all connections of the pool.
+        """
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections = {}
+        for conn in connections:
+            try:
+                conn.quit()
+            except BaseException:
+                logger.exception("Error closing pool connection")
@@ -1,27 +1,68 @@
 """EventHandler for the Teamspeak3 Bot."""
+import collections
 import logging
+import queue
 import threading
+import time
+import weakref
 
 import ts3API.Events as Events
 
+import LogPipeline
+import Metrics
+import Profiler
+
+events_received = Metrics.counter("ts3bot_events", "Events received by event type", ("type",))
+events_dropped = Metrics.counter("ts3bot_events_dropped", "Events dropped because the queue of an observer was full")
+observer_seconds = Metrics.histogram("ts3bot_observer_seconds", "Run time of event observers", ("observer",))
+_dispatchers = weakref.WeakSet()
+Metrics.gauge("ts3bot_event_queue_depth", "Events waiting to be dispatched").set_function(
+    lambda: sum(dispatcher.queue_depth for dispatcher in list(_dispatchers)))
+Metrics.gauge("ts3bot_observers_in_flight", "Observers currently handling an event").set_function(
+    lambda: sum(dispatcher.in_flight for dispatcher in list(_dispatchers)))
+
+
+def observer_name(obs):
+    """
+    Get a readable name of an observer for logs and metrics.
+    :rtype: str
+    """
+    name = getattr(obs, "__qualname__", None)
+    if name is None:
+        return str(obs)
+    return getattr(obs, "__module__", "") + "." + name
+
 
 class EventHandler(object):
     """
     EventHandler class responsible for delegating events to registered listeners.
     """
-    logger = logging.getLogger("eventhandler")
-    logger.setLevel(logging.INFO)
-    file_handler = logging.FileHandler("eventhandler.log", mode='a+')
-    formatter = logging.Formatter('Eventhandler Logger %(asctime)s %(message)s')
-    file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
+    logger = LogPipeline.file_logger("eventhandler", "eventhandler.log",
+                                     'Eventhandler Logger %(asctime)s %(message)s')
     logger.info("Configured Eventhandler logger")
-    logger.propagate = 0
 
-    def __init__(self, ts3conn, command_handler):
+    def __init__(self, ts3conn, command_handler, workers=4, max_queue_size=1000, dispatcher=None):
+        """
+        Create a new EventHandler.
+        :param ts3conn: TS3Connection to use
+        :param command_handler: CommandHandler to inform of text messages
+        :param workers: Number of worker threads used to inform observers
+        :type workers: int
+        :param max_queue_size: Maximum number of pending events per observer
+        :type max_queue_size: int
+        :param dispatcher: Dispatcher to inform observers with, creates an EventDispatcher if None
+        """
         self.ts3conn = ts3conn
         self.command_handler = command_handler
         self.observers = {}
+        # Resolved observers per concrete event class, see get_obs_for_event
+        self._resolved = {}
+        self._observers_lock = threading.Lock()
+        if dispatcher is None:
+            dispatcher = EventDispatcher(workers=workers, max_queue_size=max_queue_size)
+        self.dispatcher = dispatcher
+        # Function called with every event before it is dispatched, see EventRecorder
+        self.recorder = None
         self.add_observer(self.command_handler.inform, Events.TextMessageEvent)
 
     def on_event(self, _sender, **kw):
@@ -30,36 +71,33 @@ class EventHandler(object):
         """
         # parsed_event = Events.EventParser.parse_event(event=event)
         parsed_event = kw["event"]
-        if type(parsed_event) is Events.TextMessageEvent:
-            logging.debug(type(parsed_event))
-        elif type(parsed_event) is Events.ChannelEditedEvent:
-            logging.debug(type(parsed_event))
-        elif type(parsed_event) is Events.ChannelDescriptionEditedEvent:
-            logging.debug(type(parsed_event))
-        elif type(parsed_event) is Events.ClientEnteredEvent:
-            logging.debug(type(parsed_event))
-        elif isinstance(parsed_event, Events.ClientLeftEvent):
-            logging.debug(type(parsed_event))
-        elif type(parsed_event) is Events.ClientMovedEvent:
-            logging.debug(type(parsed_event))
-        elif type(parsed_event) is Events.ClientMovedSelfEvent:
-            logging.debug(type(parsed_event))
-        elif type(parsed_event) is Events.ServerEditedEvent:
-            logging.debug("Event of type " + str(type(parsed_event)))
-            logging.debug(parsed_event.changed_properties)
+        if self.recorder is not None:
+            self.recorder(parsed_event)
+        if type(parsed_event) is Events.ServerEditedEvent:
+            EventHandler.logger.debug("Event of type %s changed %s", type(parsed_event).__name__,
+                                      parsed_event.changed_properties)
+        else:
+            EventHandler.logger.debug("Event of type %s", type(parsed_event).__name__)
         # Inform all observers
         self.inform_all(parsed_event)
 
     def get_obs_for_event(self, evt):
         """
-        Get all observers for an event.
+        Get all observers for an event. The result is cached per event class until the
+        observers change.
         :param evt: Event to get observers for.
-        :return: List of observers.
-        :rtype: list[function]
+        :return: Tuple of observers.
+        :rtype: tuple[function]
         """
-        obs = set()
-        for t in type(evt).mro():
-            obs.update(self.observers.get(t, set()))
+        evt_class = type(evt)
+        obs = self._resolved.get(evt_class)
+        if obs is None:
+            with self._observers_lock:
+                obs_set = set()
+                for t in evt_class.mro():
+                    obs_set.update(self.observers.get(t, set()))
+                obs = tuple(obs_set)
+                self._resolved[evt_class] = obs
         return obs
 
     def add_observer(self, obs, evt_type):
@@ -69,9 +107,11 @@ class EventHandler(object):
         :param evt_type: Event type to observe.
         :type evt_type: TS3Event
         """
-        obs_set = self.observers.get(evt_type, set())
-        obs_set.add(obs)
-        self.observers[evt_type] = obs_set
+        with self._observers_lock:
+            obs_set = self.observers.get(evt_type, set())
+            obs_set.add(obs)
+            self.observers[evt_type] = obs_set
+            self._resolved.clear()
 
     def remove_observer(self, obs, evt_type):
         """
@@ -79,27 +119,161 @@ class EventHandler(object):
         :param obs: Observer to remove.
         :param evt_type: Event type to remove the observer from.
         """
-        self.observers.get(evt_type, set()).discard(obs)
+        with self._observers_lock:
+            self.observers.get(evt_type, set()).discard(obs)
+            self._resolved.clear()
 
     def remove_observer_from_all(self, obs):
         """
         Removes an observer from all event_types.
         :param obs: Observer to remove.
         """
-        for evt_type in self.observers.keys():
-            self.remove_observer(obs, evt_type)
+        with self._observers_lock:
+            for obs_set in self.observers.values():
+                obs_set.discard(obs)
+            self._resolved.clear()
 
-    # We really want to catch all exception here, to prevent one observer from crashing the bot
-    # noinspection PyBroadException
     def inform_all(self, evt):
         """
-        Inform all observers registered to the event type of an event.
+        Inform all observers registered to the event type of an event. The observers are called
+        asynchronously by the dispatcher, events are delivered to each observer in order.
         :param evt: Event to inform observers of.
         """
+        events_received.labels(type(evt).__name__).inc()
         for o in self.get_obs_for_event(evt):
+            self.dispatcher.submit(o, evt)
+
+    @property
+    def is_async(self):
+        """
+        True if observers are informed on an asyncio event loop and may be coroutine functions.
+        :rtype: bool
+        """
+        return self.dispatcher.is_async
+
+    def stop(self):
+        """
+        Stop the dispatcher of this EventHandler.
+        """
+        self.dispatcher.stop()
+
+
+class EventDispatcher(object):
+    """
+    Bounded worker pool informing observers of events. Every observer has its own queue, so events
+    are delivered to a single observer in the order they were submitted, while different observers
+    run in parallel.
+    """
+    is_async = False
+
+    def __init__(self, workers=4, max_queue_size=1000):
+        """
+        Create a new EventDispatcher and start its worker threads.
+        :param workers: Number of worker threads.
+        :type workers: int
+        :param max_queue_size: Maximum number of pending events per observer. Events submitted to
+        a full queue are dropped.
+        :type max_queue_size: int
+        """
+        self.max_queue_size = max_queue_size
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._queues = {}
+        self._scheduled = set()
+        self._ready = queue.Queue()
+        self._in_flight = 0
+        self._workers = []
+        _dispatchers.add(self)
+        for i in range(max(1, workers)):
+            worker = threading.Thread(target=self._work, name="EventDispatcher-" + str(i),
+                                      daemon=True)
+            self._workers.append(worker)
+            worker.start()
+
+    @property
+    def queue_depth(self):
+        """
+        Number of events waiting to be delivered over all observers.
+        :rtype: int
+        """
+        with self._lock:
+            return sum(len(q) for q in self._queues.values())
+
+    @property
+    def in_flight(self):
+        """
+        Number of observers currently running.
+        :rtype: int
+        """
+        return self._in_flight
+
+    @property
+    def workers(self):
+        """
+        Number of worker threads.
+        :rtype: int
+        """
+        return len(self._workers)
+
+    def submit(self, obs, evt):
+        """
+        Queue an event for an observer.
+        :param obs: Observer to inform.
+        :param evt: Event to inform the observer of.
+        :return: False if the queue of the observer is full and the event was dropped.
+        :rtype: bool
+        """
+        with self._lock:
+            obs_queue = self._queues.get(obs)
+            if obs_queue is None:
+                obs_queue = collections.deque()
+                self._queues[obs] = obs_queue
+            if len(obs_queue) >= self.max_queue_size:
+                self.dropped += 1
+                events_dropped.inc()
+                EventHandler.logger.warning("Queue of %s is full, dropping event of type %s",
+                                            str(obs), str(type(evt)))
+                return False
+            obs_queue.append(evt)
+            if obs not in self._scheduled:
+                self._scheduled.add(obs)
+                self._ready.put(obs)
+        return True
+
+    def stop(self):
+        """
+        Stop all worker threads after they finished their current observer.
+        """
+        for _ in self._workers:
+            self._ready.put(None)
+
+    # We really want to catch all exception here, to prevent one observer from crashing the bot
+    # noinspection PyBroadException
+    def _work(self):
+        """
+        Worker loop. Takes the next observer with pending events and informs it of one event.
+        """
+        while True:
+            obs = self._ready.get()
+            if obs is None:
+                return
+            with self._lock:
+                evt = self._queues[obs].popleft()
+                self._in_flight += 1
+            start = time.perf_counter()
             try:
-                threading.Thread(target=o(evt)).start()
+                Profiler.call(obs, (evt,), event=type(evt).__name__)
             except BaseException:
                 EventHandler.logger.exception("Exception while informing %s of Event of type "
-                                              "%s\nOriginal data: %s", str(o), str(type(evt)),
+                                              "%s\nOriginal data: %s", str(obs), str(type(evt)),
                                               str(evt.data))
+            finally:
+                observer_seconds.labels(observer_name(obs)).observe(time.perf_counter() - start)
+                with self._lock:
+                    self._in_flight -= 1
+                    if len(self._queues[obs]) > 0:
+                        # Requeue at the end to give other observers a chance to run
+                        self._ready.put(obs)
+                    else:
+                        del self._queues[obs]
+                        self._scheduled.discard(obs)
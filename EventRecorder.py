@@ -0,0 +1,369 @@
+"""Recording and replay of the events received by the Teamspeak3 Bot."""
+import atexit
+import collections
+import concurrent.futures
+import logging
+import queue
+import threading
+import time
+
+import ts3API.Events as Events
+from ts3API import utilities
+from ts3API.TS3Connection import TS3Connection, TS3QueryException
+from ts3API.TS3QueryExceptionType import TS3QueryExceptionType
+
+import QueryProtocol
+
+logger = logging.getLogger("bot")
+
+# Query state recorded when a bot starts, loaded into the StubTS3Connection on replay
+Snapshot = collections.namedtuple("Snapshot", ["command", "items"])
+
+_recorders = {}
+_recorders_lock = threading.Lock()
+
+
+def get_recorder(filename):
+    """
+    Get the process wide recorder for a file, the bots of all virtual servers share it.
+    :param filename: File to append the events to.
+    :type filename: str
+    :rtype: EventRecorder
+    """
+    with _recorders_lock:
+        recorder = _recorders.get(filename)
+        if recorder is None:
+            recorder = EventRecorder(filename)
+            _recorders[filename] = recorder
+        return recorder
+
+
+def event_type_name(evt):
+    """
+    Get the notify name of an event, e.g. notifycliententerview.
+    :type evt: Events.TS3Event
+    :rtype: str
+    """
+    # Unknown events store their type in the instance, TS3Event.__getattr__ must not be reached
+    return evt.__dict__.get("_event_type") or evt.event_type.value
+
+
+class EventRecorder(object):
+    """
+    Appends events to a file, one line per event: unix time in milliseconds, virtual server id and
+    the event as the server sent it, e.g.
+        1700000000123 1 notifyclientmoved ctid=2 reasonid=0 clid=5
+    Snapshots of the query state a bot starts with use the same format with a query command instead
+    of the notify name, e.g. "clientlist". Events are recorded on the receiving thread of the
+    connection, so the lines are written to the file by a thread of the recorder.
+    """
+
+    def __init__(self, filename):
+        """
+        Create a new EventRecorder.
+        :param filename: File to append to, created if it does not exist.
+        :type filename: str
+        """
+        self.filename = filename
+        self.recorded = 0
+        self._lock = threading.Lock()
+        self._file = open(filename, "a", encoding="utf-8")
+        # Records waiting to be written: unix time in milliseconds, sid, name and items, None stops
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._run, name="EventRecorder", daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def _write(self, sid, name, items):
+        self._queue.put((int(time.time() * 1000), sid, name, items))
+
+    # We really want to catch all exceptions here, the writing thread must not die
+    # noinspection PyBroadException
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            try:
+                if record is None:
+                    return
+                line = "{} {} {} {}\n".format(record[0], record[1], record[2], QueryProtocol.format_items(record[3]))
+                with self._lock:
+                    if not self._file.closed:
+                        self._file.write(line)
+            except BaseException:
+                logger.exception("Error recording %s", record[2])
+            finally:
+                self._queue.task_done()
+
+    def record(self, evt, sid=0):
+        """
+        Append an event.
+        :param evt: Event as received from the server.
+        :type evt: Events.TS3Event
+        :param sid: Virtual server id of the bot that received the event.
+        """
+        self._write(sid, event_type_name(evt), [evt.data])
+        self.recorded += 1
+
+    def snapshot(self, sid, command, items):
+        """
+        Append the query state of a bot, e.g. its client list.
+        :param sid: Virtual server id of the bot.
+        :param command: Query command the items answer, e.g. clientlist.
+        :type command: str
+        :param items: Items as returned by the query.
+        :type items: list[dict[str, object]]
+        """
+        self._write(sid, command, items)
+
+    def flush(self):
+        """
+        Write all recorded lines to the file.
+        """
+        if self._writer.is_alive():
+            self._queue.join()
+        with self._lock:
+            if not self._file.closed:
+                self._file.flush()
+
+    def close(self):
+        """
+        Write all recorded lines and close the file.
+        """
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+        with self._lock:
+            self._file.close()
+
+
+def parse_record(line):
+    """
+    Parse a line written by the EventRecorder.
+    :type line: str
+    :return: Unix time in seconds, virtual server id and the event or Snapshot.
+    :rtype: (float, str, Events.TS3Event | Snapshot)
+    """
+    timestamp, sid, name, data = line.rstrip("\n").split(" ", 3)
+    _, _, items = QueryProtocol.parse_query(name + " " + data)
+    if name.startswith("notify"):
+        record = Events.EventParser.parse_event(items[0], name)
+    else:
+        record = Snapshot(name, [item for item in items if len(item) > 0])
+    return int(timestamp) / 1000, sid, record
+
+
+def read_records(filename, sid=None):
+    """
+    Read the records of a recording in order.
+    :param filename: File written by an EventRecorder.
+    :param sid: Only read records of this virtual server, all if None.
+    :return: Generator of (unix time, virtual server id, event or Snapshot) tuples.
+    """
+    with open(filename, encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            if len(line.strip()) == 0:
+                continue
+            try:
+                record = parse_record(line)
+            except ValueError:
+                logger.warning("Skipping malformed line %d of %s", number, filename)
+                continue
+            if sid is None or record[1] == str(sid):
+                yield record
+
+
+class StubTS3Connection(TS3Connection):
+    """
+    Query layer for replays without a server. Answers read queries from the recorded snapshots and
+    the replayed events, all other queries succeed without effect. Queries are counted per command.
+    """
+
+    def __init__(self, latency=0.0):
+        """
+        Create a new StubTS3Connection, no connection is opened.
+        :param latency: Seconds every query takes.
+        :type latency: float
+        """
+        # TS3Connection.__init__ connects, only set what the bot uses
+        self._logger = logger
+        self.stop_recv = threading.Event()
+        self.latency = latency
+        self.queries = collections.Counter()
+        self.whoami_data = {"client_id": "0", "client_channel_id": "0", "client_database_id": "1",
+                            "virtualserver_id": "1"}
+        self.server_groups = []
+        self.channels = collections.OrderedDict()
+        self.clients = collections.OrderedDict()
+        self._lock = threading.RLock()
+
+    def load(self, snapshot):
+        """
+        Replace the state of the stub with a recorded snapshot.
+        :type snapshot: Snapshot
+        """
+        with self._lock:
+            if snapshot.command == "whoami" and len(snapshot.items) > 0:
+                self.whoami_data = snapshot.items[0]
+            elif snapshot.command == "servergrouplist":
+                self.server_groups = snapshot.items
+            elif snapshot.command == "channellist":
+                self.channels = collections.OrderedDict((item["cid"], item) for item in snapshot.items)
+            elif snapshot.command == "clientlist":
+                self.clients = collections.OrderedDict((item["clid"], item) for item in snapshot.items)
+
+    def observe(self, evt):
+        """
+        Update the state of the stub from a replayed event.
+        :type evt: Events.TS3Event
+        """
+        data = evt.data
+        with self._lock:
+            if isinstance(evt, Events.ClientEnteredEvent):
+                client = {key: value for key, value in data.items() if key.startswith("client_")}
+                client.update(clid=data.get("clid"), cid=data.get("ctid"))
+                self.clients[data.get("clid")] = client
+            elif isinstance(evt, Events.ClientLeftEvent):
+                self.clients.pop(data.get("clid"), None)
+            elif isinstance(evt, (Events.ClientMovedEvent, Events.ClientMovedSelfEvent)):
+                client = self.clients.get(data.get("clid"))
+                if client is not None:
+                    client["cid"] = data.get("ctid")
+            elif isinstance(evt, Events.ChannelCreatedEvent):
+                self.channels[data.get("cid")] = {key: value for key, value in data.items()
+                                                  if key == "cid" or key == "cpid" or key.startswith("channel_")}
+            elif isinstance(evt, Events.ChannelDeletedEvent):
+                self.channels.pop(data.get("cid"), None)
+            elif isinstance(evt, Events.ChannelEditedEvent):
+                channel = self.channels.get(data.get("cid"))
+                if channel is not None:
+                    channel.update((key, value) for key, value in data.items() if key.startswith("channel_"))
+
+    def _answer(self, command, items):
+        """
+        Answer a query from the state of the stub.
+        :return: Response items or None for queries without response.
+        :rtype: list[dict] | None
+        """
+        with self._lock:
+            if command == "whoami":
+                return [self.whoami_data]
+            if command == "servergrouplist":
+                return list(self.server_groups)
+            if command == "channellist":
+                return list(self.channels.values())
+            if command == "clientlist":
+                return list(self.clients.values())
+            if command == "clientinfo":
+                client = self.clients.get(items[0].get("clid"))
+                if client is None:
+                    raise TS3QueryException(int(TS3QueryExceptionType.CLIENT_INVALID_ID), "invalid clientID")
+                return [client]
+            if command == "channelfind":
+                pattern = items[0].get("pattern", "").lower()
+                found = [channel for channel in self.channels.values()
+                         if pattern in channel.get("channel_name", "").lower()]
+                if len(found) == 0:
+                    raise TS3QueryException(int(TS3QueryExceptionType.CHANNEL_INVALID_ID), "invalid channelID")
+                return found
+            if command == "clientmove":
+                for item in items:
+                    client = self.clients.get(item.get("clid"))
+                    if client is not None:
+                        client["cid"] = items[0].get("cid")
+        return None
+
+    def _send(self, command, args=None, wait_for_resp=True, log_keepalive=False):
+        query = command
+        for arg in args or []:
+            query += " " + utilities.escape(arg)
+        command, _, items = QueryProtocol.parse_query(query)
+        self.queries[command] += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+        answer = self._answer(command, items)
+        if answer is None:
+            return b""
+        return QueryProtocol.format_items(answer).encode("utf-8")
+
+    def send_async(self, command, args=None):
+        """
+        Send a query, see QueryPipeline.PipelinedTS3Connection.send_async.
+        :rtype: concurrent.futures.Future
+        """
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(self._send(command, args))
+        except TS3QueryException as e:
+            future.set_exception(e)
+        return future
+
+    def start_keepalive_loop(self, interval=5):
+        pass
+
+    def quit(self):
+        self.stop_recv.set()
+
+
+class EventReplayer(object):
+    """
+    Feeds recorded events into an EventHandler, keeping their recorded spacing divided by speed.
+    """
+
+    def __init__(self, event_handler, stub=None, speed=1.0):
+        """
+        Create a new EventReplayer.
+        :param event_handler: EventHandler to inform of the events.
+        :type event_handler: EventHandler.EventHandler
+        :param stub: Query stub to keep in sync with the replayed events and snapshots.
+        :type stub: StubTS3Connection
+        :param speed: Replay speed, 1 replays in real time, 0 as fast as possible.
+        :type speed: float
+        """
+        self.event_handler = event_handler
+        self.stub = stub
+        self.speed = speed
+
+    def replay(self, records):
+        """
+        Replay records, blocks until all events were handed to the EventHandler.
+        :param records: Records as returned by read_records.
+        :return: Number of events, seconds taken and the maximum delay behind the recorded timing.
+        :rtype: dict[str, float]
+        """
+        count = 0
+        max_lag = 0.0
+        first = None
+        start = time.perf_counter()
+        for timestamp, _sid, record in records:
+            if isinstance(record, Snapshot):
+                if self.stub is not None:
+                    self.stub.load(record)
+                continue
+            if first is None:
+                first = timestamp
+                start = time.perf_counter()
+            elif self.speed > 0:
+                delay = start + (timestamp - first) / self.speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    max_lag = max(max_lag, -delay)
+            if self.stub is not None:
+                self.stub.observe(record)
+            self.event_handler.on_event(None, event=record)
+            count += 1
+        return {"events": count, "seconds": time.perf_counter() - start, "max_lag": max_lag}
+
+    def wait_idle(self, timeout=60.0):
+        """
+        Wait until the dispatcher informed all observers of the replayed events.
+        :return: False if the timeout expired.
+        :rtype: bool
+        """
+        dispatcher = self.event_handler.dispatcher
+        deadline = time.monotonic() + timeout
+        while dispatcher.queue_depth > 0 or dispatcher.in_flight > 0:
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
@@ -0,0 +1,491 @@
+"""Local stand-in for a TeamSpeak 3 ServerQuery server, used to benchmark the Teamspeak3 Bot."""
+import collections
+import itertools
+import logging
+import queue
+import socket
+import threading
+import time
+
+from ts3API import utilities
+from ts3API.TS3QueryExceptionType import TS3QueryExceptionType
+
+from QueryProtocol import format_items, parse_query
+
+logger = logging.getLogger("bot")
+
+# Server groups of the fake server: sgid, name and type (1 regular, 2 query)
+SERVER_GROUPS = ((2, "Admin Server Query", 2), (6, "Server Admin", 1), (7, "Moderator", 1),
+                 (8, "Guest", 1), (9, "Normal", 1))
+DEFAULT_GROUP = 9
+AFK_CHANNEL = "AFK"
+
+
+class QueryError(Exception):
+    """
+    Error answered to a query instead of "error id=0 msg=ok".
+    """
+
+    def __init__(self, error_type, msg):
+        super().__init__(msg)
+        self.id = int(error_type)
+        self.msg = msg
+
+
+class FakeServer(object):
+    """
+    ServerQuery server speaking enough of the text protocol for the bot: login, use, whoami,
+    clientupdate, servernotifyregister, servergrouplist, channellist, channelfind, clientlist,
+    clientinfo, clientmove, clientkick, sendtextmessage, instanceinfo, version and quit. Clients are
+    simulated, the driving code adds, moves and removes them and sends text messages to the query
+    clients, which are notified like by a real server. All responses and events are delayed by
+    latency seconds.
+    """
+
+    def __init__(self, clients=10, channels=5, latency=0.0, host="127.0.0.1", port=0, sid=1,
+                 flood_commands=10, flood_time=3):
+        """
+        Create a new FakeServer, call start to accept connections.
+        :param clients: Number of simulated clients connected from the start.
+        :type clients: int
+        :param channels: Number of channels besides the default and the AFK channel.
+        :type channels: int
+        :param latency: Seconds every response and event is delayed.
+        :type latency: float
+        :param host: Address to listen on.
+        :param port: Port to listen on, 0 picks a free port.
+        :param sid: Id of the single virtual server.
+        :param flood_commands: Query flood commands reported by instanceinfo.
+        :param flood_time: Query flood time reported by instanceinfo.
+        """
+        self.latency = latency
+        self.host = host
+        self.port = port
+        self.sid = sid
+        self.flood_commands = flood_commands
+        self.flood_time = flood_time
+        # Number of queries received per command
+        self.queries = collections.Counter()
+        # Text messages sent by query clients: (time.perf_counter(), target clid, message)
+        self.messages = []
+        self.channels = collections.OrderedDict()
+        self.clients = collections.OrderedDict()
+        self._lock = threading.RLock()
+        self._message_cond = threading.Condition(self._lock)
+        self._clids = itertools.count(1)
+        self._sessions = set()
+        self._socket = None
+        self._add_channel("Default Channel", default=True)
+        self._add_channel(AFK_CHANNEL)
+        for i in range(channels):
+            self._add_channel("Channel " + str(i + 1))
+        lobbies = [cid for cid, channel in self.channels.items() if channel["channel_name"] != AFK_CHANNEL]
+        for i in range(clients):
+            self.add_client(cid=lobbies[i % len(lobbies)], notify=False)
+
+    def _add_channel(self, name, default=False):
+        cid = len(self.channels) + 1
+        self.channels[cid] = collections.OrderedDict(
+            (("cid", cid), ("pid", 0), ("channel_order", cid - 1), ("channel_name", name),
+             ("channel_flag_default", int(default)), ("total_clients", 0),
+             ("channel_needed_subscribe_power", 0)))
+        return cid
+
+    @property
+    def default_channel(self):
+        return next(iter(self.channels))
+
+    def channel_id(self, name):
+        """
+        Get the id of a channel by its exact name.
+        :rtype: int | None
+        """
+        for cid, channel in self.channels.items():
+            if channel["channel_name"] == name:
+                return cid
+        return None
+
+    def start(self):
+        """
+        Start accepting connections.
+        :return: Host and port the server listens on.
+        :rtype: (str, int)
+        """
+        self._socket = socket.create_server((self.host, self.port))
+        self.port = self._socket.getsockname()[1]
+        threading.Thread(target=self._accept, name="FakeServer", daemon=True).start()
+        return self.host, self.port
+
+    def stop(self):
+        """
+        Close the listening socket and all connections.
+        """
+        if self._socket is not None:
+            self._socket.close()
+        with self._lock:
+            sessions = list(self._sessions)
+        for session in sessions:
+            session.close()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self._socket.accept()
+            except OSError:
+                return
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            session = _Session(self, conn)
+            with self._lock:
+                self._sessions.add(session)
+            session.start()
+
+    def add_client(self, nickname=None, cid=None, groups=(DEFAULT_GROUP,), away=False, notify=True,
+                   client_type=0):
+        """
+        Connect a simulated client.
+        :param nickname: Nickname, derived from the client id if None.
+        :param cid: Channel to join, the default channel if None.
+        :param groups: Server group ids.
+        :param away: Away flag.
+        :param notify: Notify the query clients with notifycliententerview.
+        :param client_type: 0 for regular clients, 1 for query clients.
+        :return: Client id.
+        :rtype: int
+        """
+        with self._lock:
+            clid = next(self._clids)
+            client = collections.OrderedDict((
+                ("clid", clid), ("cid", self.default_channel if cid is None else cid),
+                ("client_database_id", clid + 100),
+                ("client_nickname", nickname or "Client " + str(clid)), ("client_type", client_type),
+                ("client_unique_identifier", "uid" + str(clid) + "="),
+                ("client_away", int(away)), ("client_away_message", ""),
+                ("client_servergroups", ",".join(str(sgid) for sgid in groups)),
+                ("client_channel_group_id", 8), ("client_input_muted", 0), ("client_output_muted", 0),
+                ("client_platform", "Linux"), ("client_version", "3.6.2"), ("client_country", "DE"),
+                ("connection_client_ip", "127.0.0.1")))
+            self.clients[clid] = client
+            self.channels[client["cid"]]["total_clients"] += 1
+            if notify:
+                self._notify("cliententerview", collections.OrderedDict(
+                    [("cfid", 0), ("ctid", client["cid"]), ("reasonid", 0)] + list(client.items())))
+        return clid
+
+    def remove_client(self, clid, reasonid=8):
+        """
+        Disconnect a simulated client and notify the query clients.
+        :param reasonid: 8 for leaving, 5 for a kick.
+        """
+        with self._lock:
+            client = self.clients.pop(int(clid))
+            self.channels[client["cid"]]["total_clients"] -= 1
+            self._notify("clientleftview", collections.OrderedDict(
+                (("cfid", client["cid"]), ("ctid", 0), ("reasonid", reasonid), ("clid", clid))))
+
+    def move_client(self, clid, cid, invoker=None):
+        """
+        Move a client and notify the query clients.
+        :param invoker: Client dictionary of the client that moved it, None if it moved itself.
+        :raises QueryError: If the client or channel does not exist or the client is in the channel.
+        """
+        with self._lock:
+            client = self.clients.get(int(clid))
+            if client is None:
+                raise QueryError(TS3QueryExceptionType.CLIENT_INVALID_ID, "invalid clientID")
+            if int(cid) not in self.channels:
+                raise QueryError(TS3QueryExceptionType.CHANNEL_INVALID_ID, "invalid channelID")
+            if client["cid"] == int(cid):
+                raise QueryError(TS3QueryExceptionType.CHANNEL_ALREADY_IN, "already member of channel")
+            self.channels[client["cid"]]["total_clients"] -= 1
+            client["cid"] = int(cid)
+            self.channels[client["cid"]]["total_clients"] += 1
+            data = collections.OrderedDict((("ctid", cid), ("reasonid", 0 if invoker is None else 1)))
+            if invoker is not None:
+                data.update((("invokerid", invoker["clid"]), ("invokername", invoker["client_nickname"]),
+                             ("invokeruid", invoker["client_unique_identifier"])))
+            data["clid"] = clid
+            self._notify("clientmoved", data)
+
+    def set_away(self, clid, away=True):
+        """
+        Set the away flag of a client. Like a real server, no event is sent.
+        """
+        with self._lock:
+            self.clients[int(clid)]["client_away"] = int(away)
+
+    def set_server_group(self, clid, sgid, member=True, notify=True):
+        """
+        Add a client to or remove it from a server group.
+        :param member: True to add the client, False to remove it.
+        :param notify: Notify the query clients with notifyservergroupclientadded/-deleted.
+        """
+        with self._lock:
+            client = self.clients[int(clid)]
+            groups = [g for g in str(client["client_servergroups"]).split(",") if len(g) > 0 and g != str(sgid)]
+            if member:
+                groups.append(str(sgid))
+            client["client_servergroups"] = ",".join(groups)
+            if notify:
+                self._notify("servergroupclientadded" if member else "servergroupclientdeleted",
+                             collections.OrderedDict((("invokerid", 0), ("invokername", "Server"),
+                                                      ("invokeruid", "serveradmin"), ("sgid", sgid),
+                                                      ("clid", clid),
+                                                      ("cluid", client["client_unique_identifier"]))))
+
+    def send_text(self, clid, msg, target=None):
+        """
+        Send a private text message from a simulated client to the query clients.
+        :param clid: Client id of the sender.
+        :param msg: Message, e.g. a command.
+        :param target: Client id of the query client to send to, all query clients if None.
+        """
+        with self._lock:
+            sender = self.clients[int(clid)]
+            sessions = [session for session in self._sessions
+                        if session.client is not None and (target is None or session.client["clid"] == target)]
+        for session in sessions:
+            if "textprivate" in session.registered:
+                session.send_event("textmessage", collections.OrderedDict((
+                    ("targetmode", 1), ("msg", msg), ("target", session.client["clid"]),
+                    ("invokerid", clid), ("invokername", sender["client_nickname"]),
+                    ("invokeruid", sender["client_unique_identifier"]))))
+
+    def wait_for_messages(self, count, timeout=10.0):
+        """
+        Wait until the query clients sent at least count text messages in total.
+        :return: False if the timeout expired.
+        :rtype: bool
+        """
+        with self._message_cond:
+            return self._message_cond.wait_for(lambda: len(self.messages) >= count, timeout)
+
+    def _notify(self, event, data):
+        """
+        Send an event to all query clients registered for server or channel events.
+        """
+        with self._lock:
+            sessions = list(self._sessions)
+        for session in sessions:
+            if "server" in session.registered or "channel" in session.registered:
+                session.send_event(event, data)
+
+
+class _Session(threading.Thread):
+    """
+    Connection of one query client.
+    """
+
+    def __init__(self, server, conn):
+        super().__init__(name="FakeServerSession", daemon=True)
+        self.server = server
+        self.conn = conn
+        self.client = None
+        self.registered = set()
+        self._out = queue.Queue()
+        self._closed = False
+        threading.Thread(target=self._write, name="FakeServerWriter", daemon=True).start()
+
+    def close(self):
+        self._closed = True
+        self._out.put(None)
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.conn.close()
+
+    def send(self, text):
+        """
+        Queue a line to the client, it is written after the latency of the server.
+        """
+        self._out.put((time.monotonic() + self.server.latency, (text + "\n\r").encode("utf-8")))
+
+    def send_event(self, event, data):
+        self.send("notify" + event + " " + format_items([data]))
+
+    def _write(self):
+        while True:
+            item = self._out.get()
+            if item is None:
+                return
+            due, data = item
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                self.conn.sendall(data)
+            except OSError:
+                return
+
+    def run(self):
+        self.send("TS3")
+        self.send("Welcome to the TeamSpeak 3 ServerQuery interface, this is a fake server.")
+        buffer = b""
+        try:
+            while not self._closed:
+                data = self.conn.recv(65536)
+                if len(data) == 0:
+                    break
+                buffer += data
+                *lines, buffer = buffer.split(b"\n")
+                for line in lines:
+                    line = line.strip(b"\r").decode("utf-8")
+                    if len(line) > 0 and not self.handle(line):
+                        return
+        except OSError:
+            pass
+        finally:
+            self._leave()
+            self.close()
+
+    def _leave(self):
+        with self.server._lock:
+            self.server._sessions.discard(self)
+            if self.client is not None and self.client["clid"] in self.server.clients:
+                self.server.remove_client(self.client["clid"])
+                self.client = None
+
+    def handle(self, line):
+        """
+        Answer a query.
+        :return: False if the connection should be closed.
+        :rtype: bool
+        """
+        command, options, items = parse_query(line)
+        self.server.queries[command] += 1
+        if command == "quit":
+            self.send("error id=0 msg=ok")
+            return False
+        handler = getattr(self, "_cmd_" + command, None)
+        try:
+            if handler is None:
+                raise QueryError(TS3QueryExceptionType.COMMAND_NOT_FOUND, "command not found")
+            data = handler(options, items)
+        except QueryError as e:
+            self.send("error id=" + str(e.id) + " msg=" + utilities.escape(e.msg))
+        else:
+            if data is not None:
+                self.send(data)
+            self.send("error id=0 msg=ok")
+        return True
+
+    def _need_server(self):
+        if self.client is None:
+            raise QueryError(TS3QueryExceptionType.NOT_CONNECTED, "not connected")
+
+    def _cmd_login(self, _options, _items):
+        return None
+
+    def _cmd_version(self, _options, _items):
+        return format_items([{"version": "3.13.7", "build": 1655727713, "platform": "Linux"}])
+
+    def _cmd_instanceinfo(self, _options, _items):
+        return format_items([{"serverinstance_serverquery_flood_commands": self.server.flood_commands,
+                              "serverinstance_serverquery_flood_time": self.server.flood_time}])
+
+    def _cmd_use(self, _options, items):
+        sid = items[0].get("sid", items[0].get(0))
+        if str(sid) != str(self.server.sid):
+            raise QueryError(TS3QueryExceptionType.SERVER_INVALID_ID, "invalid serverID")
+        if self.client is None:
+            clid = self.server.add_client(nickname="serveradmin from 127.0.0.1", groups=(2,),
+                                          notify=False, client_type=1)
+            self.client = self.server.clients[clid]
+        return None
+
+    def _cmd_whoami(self, _options, _items):
+        self._need_server()
+        client = self.client
+        return format_items([{"virtualserver_status": "online", "virtualserver_id": self.server.sid,
+                              "virtualserver_unique_identifier": "fake", "virtualserver_port": 9987,
+                              "client_id": client["clid"], "client_channel_id": client["cid"],
+                              "client_nickname": client["client_nickname"],
+                              "client_database_id": 1, "client_login_name": "serveradmin",
+                              "client_unique_identifier": "serveradmin", "client_origin_server_id": 0}])
+
+    def _cmd_clientupdate(self, _options, items):
+        self._need_server()
+        nickname = items[0].get("client_nickname")
+        if nickname is not None:
+            with self.server._lock:
+                if any(client["client_nickname"] == nickname and client is not self.client
+                       for client in self.server.clients.values()):
+                    raise QueryError(TS3QueryExceptionType.CLIENT_NICKNAME_INUSE, "nickname is already in use")
+                self.client["client_nickname"] = nickname
+        return None
+
+    def _cmd_servernotifyregister(self, _options, items):
+        self._need_server()
+        self.registered.add(items[0].get("event"))
+        return None
+
+    def _cmd_servergrouplist(self, _options, _items):
+        return format_items([{"sgid": sgid, "name": name, "type": group_type, "iconid": 0, "savedb": 1}
+                             for sgid, name, group_type in SERVER_GROUPS])
+
+    def _cmd_channellist(self, _options, _items):
+        self._need_server()
+        with self.server._lock:
+            return format_items(list(self.server.channels.values()))
+
+    def _cmd_channelfind(self, _options, items):
+        pattern = items[0].get("pattern", "").lower()
+        with self.server._lock:
+            found = [{"cid": cid, "channel_name": channel["channel_name"]}
+                     for cid, channel in self.server.channels.items()
+                     if pattern in channel["channel_name"].lower()]
+        if len(found) == 0:
+            raise QueryError(TS3QueryExceptionType.CHANNEL_INVALID_ID, "invalid channelID")
+        return format_items(found)
+
+    def _cmd_clientlist(self, options, _items):
+        self._need_server()
+        keys = ["clid", "cid", "client_database_id", "client_nickname", "client_type"]
+        if "uid" in options:
+            keys.append("client_unique_identifier")
+        if "away" in options:
+            keys.extend(("client_away", "client_away_message"))
+        if "groups" in options:
+            keys.append("client_servergroups")
+        with self.server._lock:
+            return format_items([collections.OrderedDict((key, client[key]) for key in keys)
+                                 for client in self.server.clients.values()])
+
+    def _cmd_clientinfo(self, _options, items):
+        self._need_server()
+        with self.server._lock:
+            client = self.server.clients.get(int(items[0].get("clid", -1)))
+            if client is None:
+                raise QueryError(TS3QueryExceptionType.CLIENT_INVALID_ID, "invalid clientID")
+            return format_items([client])
+
+    def _cmd_clientmove(self, _options, items):
+        self._need_server()
+        cid = items[0].get("cid")
+        error = None
+        for item in items:
+            try:
+                self.server.move_client(item.get("clid", -1), cid, invoker=self.client)
+            except QueryError as e:
+                error = error or e
+        if error is not None:
+            raise error
+        return None
+
+    def _cmd_clientkick(self, _options, items):
+        self._need_server()
+        for item in items:
+            if int(item.get("clid", -1)) not in self.server.clients:
+                raise QueryError(TS3QueryExceptionType.CLIENT_INVALID_ID, "invalid clientID")
+            self.server.remove_client(item["clid"], reasonid=int(item.get("reasonid", 5)))
+        return None
+
+    def _cmd_sendtextmessage(self, _options, items):
+        self._need_server()
+        target = int(items[0].get("target", -1))
+        with self.server._message_cond:
+            if target not in self.server.clients:
+                raise QueryError(TS3QueryExceptionType.CLIENT_INVALID_ID, "invalid clientID")
+            self.server.messages.append((time.perf_counter(), target, items[0].get("msg", "")))
+            self.server._message_cond.notify_all()
+        return None
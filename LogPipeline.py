@@ -0,0 +1,120 @@
+"""Non-blocking logging for the Teamspeak3 Bot."""
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+
+# Size based rotation of all log files, configurable with configure
+max_bytes = 10 * 1024 * 1024
+backup_count = 3
+
+_queue = queue.SimpleQueue()
+_listener = None
+_lock = threading.Lock()
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that leaves formatting to the background writer. logging.handlers.QueueHandler
+    formats the message in the logging thread.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class _FileRouter(logging.Handler):
+    """
+    Handler of the background writer passing each record to the file handler of its logger.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.handlers = {}
+
+    def emit(self, record):
+        name = record.name
+        handler = self.handlers.get(name)
+        while handler is None and "." in name:
+            name = name.rsplit(".", 1)[0]
+            handler = self.handlers.get(name)
+        if handler is not None and record.levelno >= handler.level:
+            handler.handle(record)
+
+
+_router = _FileRouter()
+
+
+def _start():
+    """
+    Start the background writer if it is not running. Caller must hold _lock.
+    """
+    global _listener
+    if _listener is None:
+        _listener = logging.handlers.QueueListener(_queue, _router)
+        _listener.start()
+        atexit.register(stop)
+
+
+def file_logger(name, filename, fmt, level=logging.INFO):
+    """
+    Get a logger writing to a rotating log file through the background writer. Log calls only put
+    the record into a queue, formatting and writing happen on the writer thread. Configures the
+    logger only once, further calls return it unchanged.
+    :param name: Name of the logger.
+    :type name: str
+    :param filename: File to write to.
+    :type filename: str
+    :param fmt: Format of the log lines, see logging.Formatter.
+    :type fmt: str
+    :param level: Level of the logger.
+    :type level: int
+    :rtype: logging.Logger
+    """
+    logger = logging.getLogger(name)
+    with _lock:
+        if name in _router.handlers:
+            return logger
+        file_handler = logging.handlers.RotatingFileHandler(filename, mode='a', maxBytes=max_bytes,
+                                                            backupCount=backup_count)
+        file_handler.setFormatter(logging.Formatter(fmt))
+        _router.handlers[name] = file_handler
+        logger.addHandler(_QueueHandler(_queue))
+        logger.setLevel(level)
+        logger.propagate = 0
+        _start()
+    return logger
+
+
+def configure(max_size=None, backups=None):
+    """
+    Change the rotation of all log files.
+    :param max_size: Size in bytes at which a log file is rotated, 0 disables rotation.
+    :type max_size: int
+    :param backups: Number of rotated files to keep.
+    :type backups: int
+    """
+    global max_bytes, backup_count
+    with _lock:
+        if max_size is not None:
+            max_bytes = int(max_size)
+        if backups is not None:
+            backup_count = int(backups)
+        for handler in _router.handlers.values():
+            handler.maxBytes = max_bytes
+            handler.backupCount = backup_count
+
+
+def stop():
+    """
+    Write all queued records and stop the background writer.
+    """
+    global _listener
+    with _lock:
+        listener = _listener
+        _listener = None
+    if listener is not None:
+        listener.stop()
+        for handler in _router.handlers.values():
+            handler.flush()
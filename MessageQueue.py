@@ -0,0 +1,298 @@
+"""Rate limited outbound text message queue for the Teamspeak3 Bot."""
+import collections
+import logging
+import threading
+import time
+
+from ts3API.TS3Connection import TS3QueryException
+from ts3API.TS3QueryExceptionType import TS3QueryExceptionType
+from ts3API.utilities import TS3Exception
+
+logger = logging.getLogger("bot")
+_queues = {}
+_queues_lock = threading.Lock()
+
+# Maximum length of a text message accepted by the server in UTF-8 encoded bytes
+MAX_MESSAGE_LENGTH = 1024
+# Seconds waiting messages are still sent for when a queue is closed
+DRAIN_TIMEOUT = 2.0
+
+
+def get_queue(ts3conn, rate=None, burst=None):
+    """
+    Get the process wide message queue for a connection. Creates and starts the queue on first use.
+    :param ts3conn: TS3Connection to send the messages on.
+    :param rate: Messages per second. Only used when the queue is created or if it is not None.
+    :type rate: float
+    :param burst: Messages that can be sent at once. Only used when the queue is created or if it is
+    not None.
+    :type burst: int
+    :return: Message queue for the connection.
+    :rtype: MessageQueue
+    """
+    with _queues_lock:
+        queue = _queues.get(ts3conn)
+        if queue is None or not queue.running:
+            queue = MessageQueue(ts3conn, rate=5.0 if rate is None else rate, burst=10 if burst is None else burst)
+            queue.start()
+            _queues[ts3conn] = queue
+        else:
+            queue.configure(rate=rate, burst=burst)
+        return queue
+
+
+def close_queue(ts3conn, timeout=DRAIN_TIMEOUT):
+    """
+    Remove the message queue of a connection and stop it, see MessageQueue.stop.
+    :param ts3conn: TS3Connection the queue sends on.
+    :param timeout: Seconds to wait for waiting messages to be sent.
+    :type timeout: float
+    """
+    with _queues_lock:
+        queue = _queues.pop(ts3conn, None)
+    if queue is not None:
+        queue.stop(timeout=timeout)
+
+
+def _forget(queue):
+    """
+    Remove a queue from the queues of the process if it is still registered.
+    :type queue: MessageQueue
+    """
+    with _queues_lock:
+        if _queues.get(queue.ts3conn) is queue:
+            del _queues[queue.ts3conn]
+
+
+def flood_limits(ts3conn, share=0.5):
+    """
+    Derive rate and burst from the query flood settings of the server instance.
+    :param ts3conn: TS3Connection to query instanceinfo on.
+    :param share: Share of the flood limit to use for text messages, the rest is left for other
+    queries.
+    :type share: float
+    :return: Rate and burst or None if the flood settings could not be read.
+    :rtype: (float, int) | None
+    """
+    try:
+        info = ts3conn.instanceinfo()
+        commands = int(info["serverinstance_serverquery_flood_commands"])
+        seconds = int(info["serverinstance_serverquery_flood_time"])
+    except (TS3Exception, KeyError, ValueError):
+        logger.debug("Could not read the query flood settings", exc_info=True)
+        return None
+    if commands <= 0 or seconds <= 0:
+        return None
+    return commands * share / seconds, max(1, int(commands * share))
+
+
+def _fitting_characters(msg, max_length):
+    """
+    Get the number of leading characters of a message that fit into max_length UTF-8 encoded bytes.
+    :type msg: str
+    :type max_length: int
+    :rtype: int
+    """
+    encoded = msg.encode("utf-8")
+    if len(encoded) <= max_length:
+        return len(msg)
+    # Decoding drops the last character if it was cut
+    return max(1, len(encoded[:max_length].decode("utf-8", errors="ignore")))
+
+
+def split_message(msg, max_length=MAX_MESSAGE_LENGTH):
+    """
+    Split a message into parts of at most max_length UTF-8 encoded bytes, at line breaks if
+    possible. The server limit applies to the encoded message, so umlauts and emoji count as several
+    bytes.
+    :type msg: str
+    :type max_length: int
+    :rtype: list[str]
+    """
+    parts = []
+    fitting = _fitting_characters(msg, max_length)
+    while fitting < len(msg):
+        cut = msg.rfind("\n", 0, fitting + 1)
+        if cut <= 0:
+            parts.append(msg[:fitting])
+            msg = msg[fitting:]
+        else:
+            parts.append(msg[:cut])
+            msg = msg[cut + 1:]
+        fitting = _fitting_characters(msg, max_length)
+    if len(msg) > 0 or len(parts) == 0:
+        parts.append(msg)
+    return parts
+
+
+class MessageQueue(object):
+    """
+    Queue of private text messages sent by a single thread. Sending is limited by a token bucket
+    to stay below the query flood limit of the server. Messages to a client that are still waiting
+    are merged into one, messages longer than the server accepts are split.
+    """
+
+    def __init__(self, ts3conn, rate=5.0, burst=10, max_length=MAX_MESSAGE_LENGTH):
+        """
+        Create a new MessageQueue, call start to start sending.
+        :param ts3conn: TS3Connection to send the messages on.
+        :param rate: Messages per second.
+        :type rate: float
+        :param burst: Messages that can be sent at once.
+        :type burst: int
+        :param max_length: Maximum length of a single message in UTF-8 encoded bytes.
+        :type max_length: int
+        """
+        self.ts3conn = ts3conn
+        self.rate = float(rate)
+        self.burst = int(burst)
+        self.max_length = max_length
+        self.sent = 0
+        self.merged = 0
+        self._tokens = float(self.burst)
+        self._refilled_at = time.monotonic()
+        self._cond = threading.Condition()
+        # Client id -> messages waiting to be sent, in order of the first waiting message
+        self._pending = collections.OrderedDict()
+        # True while the messages taken from _pending are sent
+        self._sending = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def configure(self, rate=None, burst=None):
+        """
+        Change the rate limit.
+        :param rate: Messages per second, unchanged if None.
+        :param burst: Messages that can be sent at once, unchanged if None.
+        """
+        with self._cond:
+            if rate is not None:
+                self.rate = float(rate)
+            if burst is not None:
+                self.burst = int(burst)
+                self._tokens = min(self._tokens, self.burst)
+
+    def start(self):
+        """
+        Start the sending thread.
+        """
+        self._thread = threading.Thread(target=self._run, name="MessageQueue", daemon=True)
+        self._thread.start()
+
+    @property
+    def running(self):
+        """
+        Check if the sending thread is running.
+        :rtype: bool
+        """
+        return self._thread is not None and self._thread.is_alive() and not self._stop.is_set()
+
+    def stop(self, timeout=0.0):
+        """
+        Stop the sending thread. Waiting messages are sent for up to timeout seconds, messages still
+        waiting then are dropped.
+        :param timeout: Seconds to wait for waiting messages to be sent.
+        :type timeout: float
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            if timeout > 0 and self.running and self._thread is not threading.current_thread():
+                self._cond.wait_for(lambda: len(self._pending) == 0 and not self._sending, timeout)
+            self._stop.set()
+            self._cond.notify_all()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(max(0.0, deadline - time.monotonic()) + 1.0)
+        _forget(self)
+
+    def send(self, clid, msg):
+        """
+        Queue a message to a client. Does not block.
+        :param clid: Client id of the client to send to.
+        :type clid: int
+        :param msg: Message to send.
+        :type msg: str
+        """
+        with self._cond:
+            messages = self._pending.get(clid)
+            if messages is None:
+                self._pending[clid] = [str(msg)]
+            else:
+                messages.append(str(msg))
+                self.merged += 1
+            self._cond.notify()
+
+    @property
+    def queue_depth(self):
+        """
+        Get the number of clients with messages waiting to be sent.
+        :rtype: int
+        """
+        return len(self._pending)
+
+    def _take_token(self):
+        """
+        Wait until a message may be sent.
+        :return: False if the queue was stopped while waiting.
+        :rtype: bool
+        """
+        while not self._stop.is_set():
+            with self._cond:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+                self._refilled_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            self._stop.wait(wait)
+        return False
+
+    def _pause(self, seconds):
+        """
+        Empty the token bucket and wait, used after the server reported flooding.
+        """
+        with self._cond:
+            self._tokens = 0
+            self._refilled_at = time.monotonic() + seconds
+
+    def _run(self):
+        try:
+            self._send_pending()
+        finally:
+            with self._cond:
+                self._sending = False
+                self._cond.notify_all()
+            # The connection is closed or the queue stopped, get_queue creates a new one if needed
+            _forget(self)
+
+    # We really want to catch all exceptions here, the sending thread must not die
+    # noinspection PyBroadException
+    def _send_pending(self):
+        while not self._stop.is_set():
+            with self._cond:
+                self._sending = False
+                self._cond.notify_all()
+                while len(self._pending) == 0 and not self._stop.is_set():
+                    self._cond.wait()
+                if self._stop.is_set():
+                    return
+                clid, messages = self._pending.popitem(last=False)
+                self._sending = True
+            parts = split_message("\n".join(messages), self.max_length)
+            while len(parts) > 0:
+                if not self._take_token():
+                    return
+                try:
+                    self.ts3conn.sendtextmessage(targetmode=1, target=clid, msg=parts[0])
+                    self.sent += 1
+                except TS3QueryException as e:
+                    if e.type == TS3QueryExceptionType.CLIENT_IS_FLOODING:
+                        logger.warning("Server reported query flooding, pausing text messages")
+                        self._pause(max(1.0, self.burst / self.rate))
+                        continue
+                    logger.exception("Error sending a message to clid %s", clid)
+                except BaseException:
+                    logger.exception("Error sending a message to clid %s", clid)
+                    if self.ts3conn.stop_recv.is_set():
+                        return
+                parts.pop(0)
@@ -0,0 +1,357 @@
+"""Metrics registry for the Teamspeak3 Bot."""
+import bisect
+import http.server
+import logging
+import threading
+import time
+
+logger = logging.getLogger("bot")
+
+# Upper bounds in seconds of the default latency buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _Metric(object):
+    """
+    Base class of all metrics. A metric with label names holds one child per combination of label
+    values, created on first use with labels.
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children = {}
+
+    def labels(self, *values):
+        """
+        Get the child for the given label values.
+        :param values: One value per label name.
+        :type values: str
+        """
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._new_child()
+                    self._children[values] = child
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError()
+
+    def _default(self):
+        """
+        Get the child of a metric without labels.
+        """
+        return self.labels()
+
+    def samples(self):
+        """
+        Get the samples of all children.
+        :return: List of (suffix, labels, value) tuples.
+        :rtype: list[(str, dict[str, str], float)]
+        """
+        samples = []
+        for values, child in list(self._children.items()):
+            labels = dict(zip(self.labelnames, values))
+            for suffix, extra, value in child.samples():
+                samples.append((suffix, dict(labels, **extra), value))
+        return samples
+
+
+class _CounterChild(object):
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        return [("_total", {}, self.value)]
+
+
+class Counter(_Metric):
+    """
+    Monotonically increasing count, e.g. of handled events.
+    """
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+
+class _GaugeChild(object):
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        self.function = function
+
+    def get(self):
+        if self.function is not None:
+            return self.function()
+        return self.value
+
+    def samples(self):
+        return [("", {}, self.get())]
+
+
+class Gauge(_Metric):
+    """
+    Value that can go up and down, either set directly or read from a function when collected.
+    """
+    kind = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self._default().set(value)
+
+    def set_function(self, function):
+        self._default().set_function(function)
+
+
+class _HistogramChild(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        """
+        Context manager observing the time spent in its block.
+        """
+        return _Timer(self)
+
+    def quantile(self, q):
+        """
+        Estimate a quantile as the upper bound of the bucket it falls into.
+        :type q: float
+        :rtype: float
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def samples(self):
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            samples.append(("_bucket", {"le": repr(bound)}, cumulative))
+        samples.append(("_bucket", {"le": "+Inf"}, self.count))
+        samples.append(("_sum", {}, self.sum))
+        samples.append(("_count", {}, self.count))
+        return samples
+
+
+class _Timer(object):
+    def __init__(self, child):
+        self.child = child
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        self.child.observe(time.perf_counter() - self.start)
+
+
+class Histogram(_Metric):
+    """
+    Distribution of observed values, e.g. latencies, counted in buckets.
+    """
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._default().observe(value)
+
+    def time(self):
+        return self._default().time()
+
+
+class Registry(object):
+    """
+    Registry of all metrics of the process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _get(self, cls, name, documentation, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = cls(name, documentation, labelnames, **kwargs)
+                self._metrics[name] = metric
+            elif not isinstance(metric, cls):
+                raise ValueError("Metric " + name + " is already registered as " + metric.kind)
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        """
+        Get or create a counter.
+        :rtype: Counter
+        """
+        return self._get(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        """
+        Get or create a gauge.
+        :rtype: Gauge
+        """
+        return self._get(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        """
+        Get or create a histogram.
+        :rtype: Histogram
+        """
+        return self._get(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def metrics(self):
+        """
+        Get all registered metrics sorted by name.
+        :rtype: list[_Metric]
+        """
+        with self._lock:
+            return [self._metrics[name] for name in sorted(self._metrics)]
+
+    # We really want to catch all exceptions here, a broken gauge function must not break the output
+    # noinspection PyBroadException
+    def render(self):
+        """
+        Render all metrics in the Prometheus text exposition format.
+        :rtype: str
+        """
+        lines = []
+        for metric in self.metrics():
+            lines.append("# HELP " + metric.name + " " + metric.documentation)
+            lines.append("# TYPE " + metric.name + " " + metric.kind)
+            try:
+                samples = metric.samples()
+            except BaseException:
+                logger.exception("Error collecting metric %s", metric.name)
+                continue
+            for suffix, labels, value in samples:
+                label_text = ""
+                if len(labels) > 0:
+                    label_text = "{" + ",".join(key + '="' + _escape(value) + '"'
+                                                for key, value in labels.items()) + "}"
+                lines.append(metric.name + suffix + label_text + " " + repr(float(value)))
+        return "\n".join(lines) + "\n"
+
+    # noinspection PyBroadException
+    def summary(self):
+        """
+        Render a short human readable summary: counter totals, gauge values and count, mean and
+        95th percentile of the histograms.
+        :rtype: str
+        """
+        lines = []
+        for metric in self.metrics():
+            for values, child in sorted(metric._children.items()):
+                name = metric.name + ("(" + ", ".join(values) + ")" if len(values) > 0 else "")
+                if isinstance(child, _CounterChild):
+                    lines.append(name + ": " + str(child.value))
+                elif isinstance(child, _GaugeChild):
+                    try:
+                        lines.append(name + ": " + str(child.get()))
+                    except BaseException:
+                        lines.append(name + ": error")
+                elif child.count > 0:
+                    lines.append("{}: n={} mean={:.1f}ms p95<={:.0f}ms".format(
+                        name, child.count, child.sum / child.count * 1000, child.quantile(0.95) * 1000))
+        return "\n".join(lines)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.counter(name, documentation, labelnames)
+
+
+def gauge(name, documentation, labelnames=()):
+    return REGISTRY.gauge(name, documentation, labelnames)
+
+
+def histogram(name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+    return REGISTRY.histogram(name, documentation, labelnames, buckets=buckets)
+
+
+class _MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        logger.debug("Metrics request: " + fmt, *args)
+
+
+_server = None
+
+
+def start_server(port, host="127.0.0.1"):
+    """
+    Serve the metrics in the Prometheus text format on a local port. Does nothing if the server
+    is already running.
+    :param port: Port to listen on.
+    :type port: int
+    :param host: Address to listen on.
+    :type host: str
+    :return: Running server.
+    :rtype: http.server.ThreadingHTTPServer
+    """
+    global _server
+    if _server is None:
+        _server = http.server.ThreadingHTTPServer((host, int(port)), _MetricsRequestHandler)
+        _server.daemon_threads = True
+        threading.Thread(target=_server.serve_forever, name="Metrics", daemon=True).start()
+        logger.info("Serving metrics on %s:%d", host, _server.server_address[1])
+    return _server
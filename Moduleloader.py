@@ -1,23 +1,196 @@
+import asyncio
+import concurrent.futures
+import configparser
+import contextlib
+import contextvars
+import functools
 import importlib
+import inspect
 import logging
 import sys
+import threading
+import time
 
+import LogPipeline
 from CommandHandler import CommandHandler
 from EventHandler import EventHandler
 
 setups = []
 exits = []
+# Functions registered with @command and the commands they handle
+commands = []
+# Functions registered with @event and the event types they listen to
+observers = []
 plugin_modules = {}
-event_handler: 'EventHandler'
-command_handler: 'CommandHandler'
-logger = logging.getLogger("moduleloader")
-logger.setLevel(logging.INFO)
-file_handler = logging.FileHandler("moduleloader.log", mode='a+')
-formatter = logging.Formatter('Moduleloader Logger %(asctime)s %(message)s')
-file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
+# Bots the loaded modules are attached to, one per virtual server
+bots = []
+# Registered handlers of every bot: bot -> list of (plugin function, bound handler, command or event type)
+_registrations = {}
+# Config the modules were loaded with, used by reload_module if no new config is given
+_config = None
+_imported = False
+_import_lock = threading.RLock()
+_current_bot = contextvars.ContextVar("current_bot", default=None)
+# Event loop of the bot in asyncio mode, None in threaded mode
+loop = None
+# Maximum number of plugins set up at the same time
+setup_workers = 8
+logger = LogPipeline.file_logger("moduleloader", "moduleloader.log", 'Moduleloader Logger %(asctime)s %(message)s')
 logger.info("Configured Moduleloader logger")
-logger.propagate = 0
+
+
+@contextlib.contextmanager
+def timed(phase):
+    """
+    Log the time a startup phase takes to the moduleloader log.
+    :param phase: Description of the phase, e.g. "Importing plugins".
+    :type phase: str
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        logger.info("%s took %.3f s", phase, time.perf_counter() - start)
+
+
+def call(function, *args, **kwargs):
+    """
+    Call a plugin function. Coroutine functions are run to completion, on the event loop of the bot
+    in asyncio mode. Must not be called from the event loop thread for coroutine functions.
+    :param function: Function or coroutine function to call.
+    :return: Return value of the function.
+    """
+    if not inspect.iscoroutinefunction(function):
+        return function(*args, **kwargs)
+    if loop is not None and loop.is_running():
+        return asyncio.run_coroutine_threadsafe(function(*args, **kwargs), loop).result()
+    return asyncio.run(function(*args, **kwargs))
+
+
+def current_bot():
+    """
+    Get the bot a plugin function is called for. Set while setup, command and event functions of
+    plugins run, as the modules are shared by the bots of all virtual servers.
+    :return: Bot of the virtual server the current call belongs to or None outside of plugin calls.
+    :rtype: Bot.Ts3Bot | None
+    """
+    return _current_bot.get()
+
+
+def _bind(function, bot):
+    """
+    Wrap a plugin function so current_bot returns bot while it runs.
+    :param function: Function or coroutine function.
+    :param bot: Bot to bind the function to.
+    :return: Wrapper of the same kind as function.
+    """
+    if inspect.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def bound(*args, **kwargs):
+            token = _current_bot.set(bot)
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                _current_bot.reset(token)
+    else:
+        @functools.wraps(function)
+        def bound(*args, **kwargs):
+            token = _current_bot.set(bot)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                _current_bot.reset(token)
+    return bound
+
+
+def _sync(function):
+    """
+    Wrap a coroutine function so it can be called by the threaded command and event handlers.
+    :param function: Function or coroutine function.
+    :return: The function itself if it is no coroutine function, a blocking wrapper otherwise.
+    """
+    if not inspect.iscoroutinefunction(function):
+        return function
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        return call(function, *args, **kwargs)
+    return wrapper
+
+
+def _setup_arguments(setup_func, bot, config):
+    """
+    Get the arguments to call a setup function with. Modules with a section in the config get the
+    options of their section as keyword arguments.
+    :return: Tuple of positional and keyword arguments.
+    :rtype: (tuple, dict)
+    """
+    name = sys.modules.get(setup_func.__module__).pluginname
+    if name in config:
+        return (), dict(ts3bot=bot, **config[name])
+    return (bot,), {}
+
+
+def attach(bot):
+    """
+    Register the commands and event listeners of the loaded modules with the handlers of a bot.
+    :param bot: Bot to attach the modules to.
+    """
+    _register(bot, commands, observers)
+    bots.append(bot)
+
+
+def detach(bot):
+    """
+    Forget a bot that quits, module reloads and exit_all no longer consider it.
+    :param bot: Bot to detach.
+    :return: True if no bot is left.
+    :rtype: bool
+    """
+    if bot in bots:
+        bots.remove(bot)
+    _registrations.pop(bot, None)
+    return len(bots) == 0
+
+
+def _register(bot, command_functions, observer_functions):
+    """
+    Register commands and event listeners with the handlers of a bot and remember the bound
+    handlers, so they can be unregistered on reload.
+    :param command_functions: Pairs of function and commands, see commands.
+    :param observer_functions: Pairs of function and event types, see observers.
+    """
+    registrations = _registrations.setdefault(bot, [])
+    for function, command_list in command_functions:
+        handler = _bind(function, bot)
+        if not bot.command_handler.is_async:
+            handler = _sync(handler)
+        for text_command in command_list:
+            bot.command_handler.add_handler(handler, text_command)
+            registrations.append((function, handler, text_command))
+    for function, event_types in observer_functions:
+        observer = _bind(function, bot)
+        if not bot.event_handler.is_async:
+            observer = _sync(observer)
+        for event_type in event_types:
+            bot.event_handler.add_observer(observer, event_type)
+            registrations.append((function, observer, event_type))
+
+
+def _unregister(bot, module_name):
+    """
+    Remove the commands and event listeners of a module from the handlers of a bot.
+    :param module_name: Name of the module, e.g. modules.afkmover.
+    """
+    kept = []
+    for function, handler, key in _registrations.get(bot, []):
+        if function.__module__ != module_name:
+            kept.append((function, handler, key))
+        elif isinstance(key, str):
+            bot.command_handler.remove_handler(handler, key)
+        else:
+            bot.event_handler.remove_observer(handler, key)
+    _registrations[bot] = kept
 
 
 # We really really want to catch all Exception here to prevent a bad module crashing the
@@ -25,39 +198,171 @@ logger.propagate = 0
 # noinspection PyBroadException,PyPep8
 def load_modules(bot, config):
     """
-    Load modules specified in the Plugins section of config.ini.
+    Load modules specified in the Plugins section of config.ini. The modules are imported only
+    once, further bots get the commands and event listeners of the imported modules and their
+    setup functions are called again for each bot.
     :param bot: Bot to pass to the setup function of the modules
     :param config: Main bot config with plugins section
     """
-    global event_handler, command_handler
-    plugins = config.pop('Plugins')
-    event_handler = bot.event_handler
-    command_handler = bot.command_handler
-    """try:
-        modules = map(__import__, plugins.values())
-        print(modules)
-    except:
-        logger.exception("error on importing plugins")"""
-
-    for plugin in plugins.items():
+    _import_plugins(config)
+    attach(bot)
+    # Call all registered setup functions
+    with timed("Setting up plugins for server " + str(bot.sid)):
+        _setup(bot, setups, config)
+
+
+def _by_module(functions):
+    """
+    Group functions by their module, keeping their order.
+    :return: Lists of functions, one per module.
+    :rtype: list[list]
+    """
+    groups = {}
+    for function in functions:
+        groups.setdefault(function.__module__, []).append(function)
+    return list(groups.values())
+
+
+# noinspection PyBroadException
+def _setup_module(bot, setup_functions, config):
+    """
+    Call the setup functions of one module for a bot in order.
+    :param setup_functions: Setup functions of the module.
+    :param config: Main bot config with plugins section
+    """
+    for setup_func in setup_functions:
+        start = time.perf_counter()
         try:
-            plugin_modules[plugin[0]] = importlib.import_module("modules."+plugin[1],
-                                                                package="modules")
-            plugin_modules[plugin[0]].pluginname = plugin[0]
-            logger.info("Loaded module " + plugin[0])
+            args, kwargs = _setup_arguments(setup_func, bot, config)
+            call(_bind(setup_func, bot), *args, **kwargs)
         except BaseException:
-            logger.exception("While loading plugin " + str(plugin[0]) + " from modules."+plugin[1])
-    # Call all registered setup functions
-    for setup_func in setups:
+            logger.exception("While setting up a module.")
+        logger.info("Setup %s.%s took %.3f s", setup_func.__module__, setup_func.__name__,
+                    time.perf_counter() - start)
+
+
+def _setup(bot, setup_functions, config):
+    """
+    Call setup functions for a bot. The modules are set up concurrently in a thread pool, the setup
+    functions of one module are called one after another.
+    :param setup_functions: Setup functions to call.
+    :param config: Main bot config with plugins section
+    """
+    groups = _by_module(setup_functions)
+    if len(groups) <= 1:
+        for group_functions in groups:
+            _setup_module(bot, group_functions, config)
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(setup_workers, len(groups)),
+                                               thread_name_prefix="setup") as executor:
+        for group_functions in groups:
+            executor.submit(_setup_module, bot, group_functions, config)
+
+
+async def load_modules_async(bot, config):
+    """
+    Load modules specified in the Plugins section of config.ini in asyncio mode. Coroutine setup
+    functions are awaited, all other setup functions run in the executor of the bot.
+    :param bot: Bot to pass to the setup function of the modules
+    :param config: Main bot config with plugins section
+    """
+    global loop
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(bot.executor, _import_plugins, config)
+    attach(bot)
+    with timed("Setting up plugins for server " + str(bot.sid)):
+        await asyncio.gather(*(_setup_module_async(bot, group_functions, config)
+                               for group_functions in _by_module(setups)))
+
+
+async def _setup_module_async(bot, setup_functions, config):
+    """
+    Call the setup functions of one module for a bot in order in asyncio mode.
+    :param setup_functions: Setup functions of the module.
+    :param config: Main bot config with plugins section
+    """
+    for setup_func in setup_functions:
+        start = time.perf_counter()
         try:
-            name = sys.modules.get(setup_func.__module__).pluginname
-            if name in config:
-                plugin_config = config.pop(name)
-                setup_func(ts3bot=bot, **plugin_config)
+            args, kwargs = _setup_arguments(setup_func, bot, config)
+            bound = _bind(setup_func, bot)
+            if inspect.iscoroutinefunction(setup_func):
+                await bound(*args, **kwargs)
             else:
-                setup_func(bot)
-        except BaseException:
+                await loop.run_in_executor(bot.executor, functools.partial(bound, *args, **kwargs))
+        except Exception:
             logger.exception("While setting up a module.")
+        logger.info("Setup %s.%s took %.3f s", setup_func.__module__, setup_func.__name__,
+                    time.perf_counter() - start)
+
+
+def preload(config):
+    """
+    Start importing the modules specified in the Plugins section of config.ini in the background,
+    e.g. while the bot connects. load_modules waits for the import to finish.
+    :param config: Main bot config with plugins section
+    """
+    if not _imported:
+        threading.Thread(target=_import_plugins, args=(config,), name="preload", daemon=True).start()
+
+
+def _import_plugin(name, module_path):
+    """
+    Import a plugin module.
+    :param name: Plugin name as in the Plugins section, e.g. AfkMover.
+    :param module_path: Module in the modules package, e.g. afkmover.
+    :return: Imported module.
+    """
+    start = time.perf_counter()
+    module = importlib.import_module("modules." + module_path, package="modules")
+    module.pluginname = name
+    logger.info("Loaded module %s in %.3f s", name, time.perf_counter() - start)
+    return module
+
+
+# noinspection PyBroadException
+def _import_plugins(config):
+    """
+    Import the modules specified in the Plugins section of config.ini in parallel, unless they were
+    imported already.
+    :param config: Main bot config with plugins section
+    """
+    global _imported, _config
+    with _import_lock:
+        if _imported:
+            return
+        _config = config
+        plugins = list(config['Plugins'].items())
+        with timed("Importing {} plugins".format(len(plugins))), \
+                concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(plugins)),
+                                                      thread_name_prefix="import") as executor:
+            imports = [(name, module_path, executor.submit(_import_plugin, name, module_path))
+                       for name, module_path in plugins]
+            for name, module_path, future in imports:
+                try:
+                    plugin_modules[name] = future.result()
+                except BaseException:
+                    logger.exception("While loading plugin %s from modules.%s", name, module_path)
+        _sort_registrations([plugin_modules[name].__name__ for name, _ in plugins if name in plugin_modules])
+        _imported = True
+
+
+def _sort_registrations(module_names):
+    """
+    Sort the module lists by the order of the plugins in the config. Modules imported in parallel
+    register their functions in the order the imports finish, the functions of a module keep their
+    order.
+    :param module_names: Names of the modules in config order, e.g. modules.afkmover.
+    :type module_names: list[str]
+    """
+    order = {module_name: index for index, module_name in enumerate(module_names)}
+
+    def position(function):
+        return order.get(function.__module__, len(order))
+    setups.sort(key=position)
+    exits.sort(key=position)
+    commands.sort(key=lambda entry: position(entry[0]))
+    observers.sort(key=lambda entry: position(entry[0]))
 
 
 def setup(function):
@@ -73,27 +378,26 @@ def setup(function):
 def event(*event_types):
     """
     Decorator to register a function as an eventlistener for the event types specified in
-    event_types.
+    event_types. The function can be a coroutine function.
     :param event_types: Event types to listen to
     :type event_types: TS3Event
     """
     def register_observer(function):
-        for event_type in event_types:
-            event_handler.add_observer(function, event_type)
+        observers.append((function, event_types))
         return function
     return register_observer
 
 
 def command(*command_list):
     """
-    Decorator to register a function as a handler for text commands.
+    Decorator to register a function as a handler for text commands. The function can be a
+    coroutine function.
     :param command_list: Commands to handle.
     :type command_list: str
     :return:
     """
     def register_command(function):
-        for text_command in command_list:
-            command_handler.add_handler(function, text_command)
+        commands.append((function, command_list))
         return function
     return register_command
 
@@ -111,12 +415,23 @@ def group(*groups):
     return save_allowed_groups
 
 
+def allow_prefix(function):
+    """
+    Decorator to allow calling the commands of a function by a unique prefix, e.g. !vers for
+    !version. Only use it for harmless commands, commands changing state have to be typed in full.
+    :param function: Command function.
+    """
+    function.allow_prefix = True
+    return function
+
+
 def exit(function):
     """
     Decorator to mark a function to be called upon module exit.
     :param function: Exit function to call.
     """
     exits.append(function)
+    return function
 
 
 # We really really want to catch all Exception here to prevent a bad module preventing everything
@@ -128,10 +443,121 @@ def exit_all():
     """
     for exit_func in exits:
         try:
-            exit_func()
+            call(exit_func)
         except BaseException:
             logger.exception("While exiting a module.")
 
 
-"""def reload():
-    exit_all()"""
+# noinspection PyBroadException
+def _exit_module(module_name):
+    """
+    Call the exit functions of a module.
+    :param module_name: Name of the module, e.g. modules.afkmover.
+    """
+    for exit_func in exits:
+        if exit_func.__module__ == module_name:
+            try:
+                call(exit_func)
+            except BaseException:
+                logger.exception("While exiting module %s.", module_name)
+
+
+def _forget(module_name):
+    """
+    Remove the functions of a module from the module lists and its handlers from all bots.
+    :param module_name: Name of the module, e.g. modules.afkmover.
+    """
+    for registry in (setups, exits):
+        registry[:] = [function for function in registry if function.__module__ != module_name]
+    for registry in (commands, observers):
+        registry[:] = [entry for entry in registry if entry[0].__module__ != module_name]
+    for bot in bots:
+        _unregister(bot, module_name)
+
+
+def read_config():
+    """
+    Read the current config.ini for reloading. Returns the config the modules were loaded with if
+    the file cannot be read or has no Plugins section.
+    :rtype: dict[str, dict[str, str]]
+    """
+    config = configparser.ConfigParser()
+    if len(config.read('config.ini')) == 0 or not config.has_section('Plugins'):
+        return _config
+    return config._sections
+
+
+def unload_module(name):
+    """
+    Exit a module and remove its commands and event listeners from all bots.
+    :param name: Plugin name as in the Plugins section, e.g. AfkMover.
+    :return: False if no such module is loaded.
+    :rtype: bool
+    """
+    with _import_lock:
+        module = plugin_modules.pop(name, None)
+        if module is None:
+            return False
+        _exit_module(module.__name__)
+        _forget(module.__name__)
+        logger.info("Unloaded module %s", name)
+        return True
+
+
+def reload_module(name, config=None):
+    """
+    Reload a module on the running bots: call its exit functions, remove its commands and event
+    listeners, import it again and set it up for every bot. A module that is not loaded yet is
+    imported if it is listed in the Plugins section.
+    :param name: Plugin name as in the Plugins section, e.g. AfkMover.
+    :param config: Main bot config with plugins section, read from config.ini if None.
+    :return: False if the module is unknown or could not be imported. The old version of the
+    module stays unloaded in the latter case.
+    :rtype: bool
+    """
+    global _config
+    config = config or read_config()
+    with _import_lock:
+        _config = config
+        module = plugin_modules.get(name)
+        module_path = config['Plugins'].get(name)
+        if module is None and module_path is None:
+            return False
+        if module is not None:
+            unload_module(name)
+        module_name = module.__name__ if module_path is None else "modules." + module_path
+        try:
+            # Modules imported before have to be executed again, so their decorators register again
+            if module_name in sys.modules:
+                module = importlib.reload(sys.modules[module_name])
+            else:
+                module = importlib.import_module(module_name, package="modules")
+        except BaseException:
+            logger.exception("While reloading plugin %s", name)
+            return False
+        module.pluginname = name
+        plugin_modules[name] = module
+        module_commands = [entry for entry in commands if entry[0].__module__ == module.__name__]
+        module_observers = [entry for entry in observers if entry[0].__module__ == module.__name__]
+        module_setups = [function for function in setups if function.__module__ == module.__name__]
+        for bot in bots:
+            _register(bot, module_commands, module_observers)
+            _setup(bot, module_setups, config)
+        logger.info("Reloaded module %s", name)
+        return True
+
+
+def reload_all(config=None):
+    """
+    Reload all modules, see reload_module. Modules no longer listed in the Plugins section are
+    unloaded, newly listed ones are loaded.
+    :param config: Main bot config with plugins section, read from config.ini if None.
+    :return: Names of the modules that could not be reloaded.
+    :rtype: list[str]
+    """
+    config = config or read_config()
+    with _import_lock:
+        for name in list(plugin_modules):
+            if name not in config['Plugins']:
+                unload_module(name)
+        return [name for name in config['Plugins'] if not reload_module(name, config)]
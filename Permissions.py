@@ -0,0 +1,110 @@
+"""Permission checks for text commands of the Teamspeak3 Bot."""
+import re
+import threading
+
+
+def compile_groups(groups):
+    """
+    Compile server group patterns as used by the @group decorator.
+    :param groups: Server group name patterns.
+    :type groups: collections.abc.Iterable[str]
+    :return: Compiled patterns.
+    :rtype: tuple[re.Pattern]
+    """
+    return tuple(re.compile(group) for group in groups)
+
+
+class PermissionEngine(object):
+    """
+    Decides if a client may use a command handler. The group patterns of a handler are compiled
+    upon registration and decisions are cached per client database id and handler. A cached
+    decision is only used as long as the server group ids of the client did not change, a hit saves
+    resolving the group names and matching the patterns. The current server groups come from the
+    client registry, see CommandHandler.allowed_handlers.
+    """
+
+    def __init__(self, default_groups):
+        """
+        Create a new PermissionEngine.
+        :param default_groups: Group patterns for handlers without @group.
+        :type default_groups: list[str]
+        """
+        self.default_groups = default_groups
+        self.hits = 0
+        self.misses = 0
+        # Reentrant, check registers unknown handlers while holding it
+        self._lock = threading.RLock()
+        self._patterns = {}
+        self._decisions = {}
+
+    def register(self, handler):
+        """
+        Compile the allowed groups of a handler.
+        :param handler: Handler function, optionally decorated with @group.
+        :return: Compiled patterns for the handler.
+        :rtype: tuple[re.Pattern]
+        """
+        patterns = compile_groups(getattr(handler, "allowed_groups", self.default_groups))
+        with self._lock:
+            self._patterns[handler] = patterns
+            self._decisions = {key: decision for key, decision in self._decisions.items()
+                               if key[1] is not handler}
+        return patterns
+
+    def unregister(self, handler):
+        """
+        Forget the patterns and cached decisions of a handler.
+        :param handler: Handler function.
+        """
+        with self._lock:
+            self._patterns.pop(handler, None)
+            self._decisions = {key: decision for key, decision in self._decisions.items()
+                               if key[1] is not handler}
+
+    def check(self, handler, clientinfo):
+        """
+        Check if a client is allowed to use a handler.
+        :param handler: Handler function to check permissions for.
+        :param clientinfo: Client info of the client that tries to use the command.
+        :type clientinfo: ClientInfo.ClientInfo
+        :rtype: bool
+        """
+        groups = clientinfo.servergroup_ids
+        key = (clientinfo.database_id, handler)
+        # Decided under the lock, so no decision is written into a dictionary replaced by
+        # register, unregister or clear meanwhile
+        with self._lock:
+            cached = self._decisions.get(key)
+            if cached is not None and cached[0] == groups:
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+            patterns = self._patterns.get(handler)
+            if patterns is None:
+                patterns = self.register(handler)
+            names = clientinfo.servergroups
+            allowed = any(pattern.search(name) is not None for pattern in patterns for name in names)
+            if key[0] != '':
+                self._decisions[key] = (groups, allowed)
+            return allowed
+
+    def clear(self, database_id=None):
+        """
+        Clear cached decisions.
+        :param database_id: Only clear decisions of this client, clear all if None.
+        """
+        with self._lock:
+            if database_id is None:
+                self._decisions = {}
+            else:
+                self._decisions = {key: decision for key, decision in self._decisions.items()
+                                   if key[0] != database_id}
+
+    @property
+    def stats(self):
+        """
+        Get cache statistics.
+        :return: Dictionary with hits, misses and cached decisions.
+        :rtype: dict[str, int]
+        """
+        return {"hits": self.hits, "misses": self.misses, "cached": len(self._decisions)}
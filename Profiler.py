@@ -0,0 +1,171 @@
+"""On-demand cProfile capture of commands and event observers for the Teamspeak3 Bot."""
+import cProfile
+import io
+import logging
+import os
+import pstats
+import threading
+import time
+
+logger = logging.getLogger("bot")
+
+# Kinds of capture targets
+COMMAND = "command"
+MODULE = "module"
+EVENT = "event"
+KINDS = (COMMAND, MODULE, EVENT)
+
+# Directory the pstats files are written to
+profile_dir = "profiles"
+
+_captures = {}
+_captures_lock = threading.Lock()
+# Only one call is profiled at a time, calls running while another one is profiled are not captured
+_profiling = threading.Lock()
+
+
+class Capture(object):
+    """
+    Running capture of one command, plugin module or event type. Every sample-th matching call is
+    profiled, all profiled calls are accumulated in one cProfile.Profile.
+    """
+
+    def __init__(self, kind, name, sample=1):
+        """
+        Create a new Capture.
+        :param kind: COMMAND, MODULE or EVENT.
+        :type kind: str
+        :param name: Command name, module name or event class name.
+        :type name: str
+        :param sample: Profile every sample-th matching call.
+        :type sample: int
+        """
+        self.kind = kind
+        self.name = name
+        self.sample = max(1, int(sample))
+        self.profile = cProfile.Profile()
+        self.started = time.time()
+        self.calls = 0
+        self.profiled = 0
+        self._lock = threading.Lock()
+
+    def take(self):
+        """
+        Count a matching call.
+        :return: True if the call should be profiled.
+        :rtype: bool
+        """
+        with self._lock:
+            self.calls += 1
+            return self.calls % self.sample == 0
+
+    def dump(self):
+        """
+        Write the accumulated profile to a pstats file in profile_dir.
+        :return: Path of the written file.
+        :rtype: str
+        """
+        os.makedirs(profile_dir, exist_ok=True)
+        filename = os.path.join(profile_dir, "{}-{}-{}.pstats".format(
+            self.kind, self.name.replace(os.sep, "_"), time.strftime("%Y%m%d-%H%M%S")))
+        self.profile.dump_stats(filename)
+        return filename
+
+    def summary(self, top=10):
+        """
+        Get the top functions of the profile by cumulative time.
+        :param top: Number of functions to list.
+        :type top: int
+        :rtype: str
+        """
+        header = "{} {}: {} of {} calls profiled".format(self.kind, self.name, self.profiled, self.calls)
+        if self.profiled == 0:
+            return header
+        stream = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=stream)
+        stats.strip_dirs().sort_stats(pstats.SortKey.CUMULATIVE).print_stats(top)
+        lines = [line for line in stream.getvalue().splitlines() if line.strip()]
+        # Skip the preamble of print_stats up to the column header
+        for index, line in enumerate(lines):
+            if line.lstrip().startswith("ncalls"):
+                lines = lines[index:]
+                break
+        return header + "\n" + "\n".join(lines)
+
+
+def start(kind, name, sample=1):
+    """
+    Start capturing a command, plugin module or event type. Restarts a running capture of the same
+    target.
+    :param kind: COMMAND, MODULE or EVENT.
+    :type kind: str
+    :param name: Command name, plugin module name (e.g. afkmover) or event class name
+    (e.g. ClientEnteredEvent).
+    :type name: str
+    :param sample: Profile every sample-th matching call.
+    :type sample: int
+    :rtype: Capture
+    """
+    if kind not in KINDS:
+        raise ValueError("Unknown capture kind " + str(kind))
+    capture = Capture(kind, name, sample)
+    with _captures_lock:
+        _captures[(kind, name)] = capture
+    logger.info("Started profiling %s %s, sampling every %d calls", kind, name, capture.sample)
+    return capture
+
+
+def stop(kind, name):
+    """
+    Stop a capture.
+    :return: Stopped capture or None if the target was not captured.
+    :rtype: Capture | None
+    """
+    with _captures_lock:
+        capture = _captures.pop((kind, name), None)
+    if capture is not None:
+        logger.info("Stopped profiling %s %s", kind, name)
+    return capture
+
+
+def captures():
+    """
+    Get the running captures.
+    :rtype: list[Capture]
+    """
+    with _captures_lock:
+        return list(_captures.values())
+
+
+def module_name(function):
+    """
+    Get the plugin module name of a command handler or observer, e.g. afkmover for modules.afkmover.
+    :rtype: str
+    """
+    return (getattr(function, "__module__", None) or "").rsplit(".", 1)[-1]
+
+
+def call(function, args, command=None, event=None):
+    """
+    Call a command handler or observer, profiling it if its command, event type or module is captured.
+    The call is accounted to the first captured of these.
+    :param function: Command handler or observer to call.
+    :param args: Arguments to call function with.
+    :type args: tuple
+    :param command: Command name if function is a command handler.
+    :type command: str
+    :param event: Event class name if function is an observer.
+    :type event: str
+    :return: Return value of function.
+    """
+    if len(_captures) == 0:
+        return function(*args)
+    capture = (_captures.get((COMMAND, command)) or _captures.get((EVENT, event)) or
+               _captures.get((MODULE, module_name(function))))
+    if capture is None or not capture.take() or not _profiling.acquire(blocking=False):
+        return function(*args)
+    try:
+        capture.profiled += 1
+        return capture.profile.runcall(function, *args)
+    finally:
+        _profiling.release()
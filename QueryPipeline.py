@@ -0,0 +1,255 @@
+"""Pipelined ServerQuery connection for the Teamspeak3 Bot."""
+import collections
+import concurrent.futures
+import functools
+import threading
+import time
+
+import blinker
+import ts3API.Events as Events
+from ts3API import utilities
+from ts3API.Events import TS3Event
+from ts3API.TS3Connection import TS3Connection, TS3QueryException
+from ts3API.utilities import TS3ConnectionClosedException
+
+import Metrics
+
+query_seconds = Metrics.histogram("ts3bot_query_seconds", "Round trip time of queries", ("command",))
+query_errors = Metrics.counter("ts3bot_query_errors", "Queries answered with an error", ("command",))
+
+
+def observe_query(command, start, future):
+    """
+    Record the round trip of an answered query in the metrics, used as done callback of its future.
+    :param command: Query as sent, only the command name is recorded.
+    :param start: time.perf_counter() when the query was sent.
+    :param future: Future of the query.
+    """
+    name = command.split(" ", 1)[0]
+    query_seconds.labels(name).observe(time.perf_counter() - start)
+    if not future.cancelled() and isinstance(future.exception(), TS3QueryException):
+        query_errors.labels(name).inc()
+
+
+class PipelinedTS3Connection(TS3Connection):
+    """
+    TS3Connection that does not wait for the response of a query before sending the next one. The
+    server answers queries in the order they were sent, so queries from many threads are written
+    to the socket as they come, up to max_in_flight unanswered queries, and every response is
+    matched to the oldest pending query. Each query is represented by a Future.
+    """
+
+    def __init__(self, *args, max_in_flight=8, **kwargs):
+        """
+        Create a new PipelinedTS3Connection, takes the same arguments as TS3Connection.
+        :param max_in_flight: Maximum number of queries sent but not yet answered. 1 waits for
+        every response like TS3Connection.
+        :type max_in_flight: int
+        """
+        # The receiving thread is started by TS3Connection.__init__
+        self.max_in_flight = max(1, int(max_in_flight))
+        self._slots = threading.BoundedSemaphore(self.max_in_flight)
+        self._write_lock = threading.Lock()
+        # Futures and collected data lines of the queries waiting for their response
+        self._pending = collections.deque()
+        # Signals and listeners connected by the register_for methods, disconnected on quit
+        self._listeners = []
+        # Sender of the events of this connection. Not the connection itself, blinker takes every
+        # object with a __func__ attribute for a method and TS3Connection answers all attributes.
+        self.event_sender = "ts3conn-" + str(id(self))
+        super().__init__(*args, **kwargs)
+
+    @property
+    def in_flight(self):
+        """
+        Get the number of queries waiting for their response.
+        :rtype: int
+        """
+        return len(self._pending)
+
+    def send_async(self, command, args=None):
+        """
+        Send a query without waiting for its response. Blocks while max_in_flight queries are
+        unanswered.
+        :param command: Command to send, not escaped.
+        :type command: str
+        :param args: Arguments to send, will be escaped.
+        :type args: list[str]
+        :return: Future resolving to the raw response or raising a TS3QueryException.
+        :rtype: concurrent.futures.Future
+        """
+        query = command
+        for arg in args or []:
+            query += " " + utilities.escape(arg)
+        query = (query + "\n\r").encode()
+        future = concurrent.futures.Future()
+        future.add_done_callback(functools.partial(observe_query, command, time.perf_counter()))
+        self._slots.acquire()
+        try:
+            with self._write_lock:
+                if self.stop_recv.is_set():
+                    raise TS3ConnectionClosedException()
+                # The order in _pending has to be the order on the socket
+                self._pending.append((future, []))
+                self._conn.write(query)
+        except BaseException:
+            self._slots.release()
+            raise
+        return future
+
+    def _connect(self, signal_names, event_listener, weak_ref):
+        """
+        Connect a listener to the signals of events received on this connection only. The blinker
+        signals are process wide, the events are sent with event_sender as sender.
+        Listeners are called on the receiving thread, which also resolves the responses of all
+        queries. They must not block, send queries or do I/O, but hand the event to another thread,
+        like EventHandler.on_event does.
+        :param signal_names: Names of the signals to connect to.
+        :type signal_names: list[str]
+        """
+        if event_listener is None:
+            return
+        for name in signal_names:
+            signal = blinker.signal(name)
+            signal.connect(event_listener, sender=self.event_sender, weak=weak_ref)
+            self._listeners.append((signal, event_listener))
+
+    def disconnect_listeners(self):
+        """
+        Disconnect all listeners connected with the register_for methods.
+        """
+        for signal, event_listener in self._listeners:
+            signal.disconnect(event_listener, sender=self.event_sender)
+        self._listeners = []
+
+    def register_for_server_messages(self, event_listener=None, weak_ref=True):
+        super().register_for_server_messages()
+        self._connect([event.name + "_server" for event in Events.text_events], event_listener, weak_ref)
+
+    def register_for_channel_messages(self, event_listener=None, weak_ref=True):
+        super().register_for_channel_messages()
+        self._connect([event.name + "_channel" for event in Events.text_events], event_listener, weak_ref)
+
+    def register_for_private_messages(self, event_listener=None, weak_ref=True):
+        super().register_for_private_messages()
+        self._connect([event.name + "_private" for event in Events.text_events], event_listener, weak_ref)
+
+    def register_for_server_events(self, event_listener=None, weak_ref=True):
+        super().register_for_server_events()
+        self._connect([event.name for event in Events.server_events], event_listener, weak_ref)
+
+    def register_for_channel_events(self, channel_id, event_listener=None, weak_ref=True):
+        super().register_for_channel_events(channel_id)
+        self._connect([event.name for event in Events.channel_events], event_listener, weak_ref)
+
+    def register_for_unknown_events(self, event_listener=None, weak_ref=True):
+        self._connect(["UNKNOWN"], event_listener, weak_ref)
+
+    def _send(self, command, args=None, wait_for_resp=True, log_keepalive=False):
+        future = self.send_async(command, args)
+        if not wait_for_resp:
+            return None
+        return future.result()
+
+    def _resolve(self, line):
+        """
+        Resolve the oldest pending query with an error line.
+        :param line: Error line, e.g. b"error id=0 msg=ok"
+        :type line: bytes
+        """
+        with self._write_lock:
+            if len(self._pending) == 0:
+                self._logger.warning("Response without pending query: %s", line)
+                return
+            future, data = self._pending.popleft()
+        self._slots.release()
+        error = TS3Connection._parse_resp_to_dict(line[len(b"error "):])
+        error_id = int(error.get("id", "-1"))
+        if error_id != 0:
+            future.set_exception(TS3QueryException(error_id, error.get("msg", "")))
+        else:
+            future.set_result(b"".join(data))
+
+    def _fail_pending(self):
+        """
+        Fail all pending queries after the connection was closed.
+        """
+        with self._write_lock:
+            while len(self._pending) > 0:
+                future, _ = self._pending.popleft()
+                self._slots.release()
+                future.set_exception(TS3ConnectionClosedException())
+
+    def _recv(self):
+        """
+        Receive responses and events until the connection is closed.
+        """
+        while not self.stop_recv.is_set():
+            try:
+                line = self._conn.read_until(b"\n\r")[:-2]
+            except (EOFError, TS3ConnectionClosedException):
+                if not self.stop_recv.is_set():
+                    self._logger.exception("Connection closed")
+                self.stop_recv.set()
+                self._conn.close()
+                break
+            if line.startswith(b"error "):
+                self._resolve(line)
+            elif line.startswith(b"notify"):
+                event = self._parse_resp(line)
+                if isinstance(event, TS3Event):
+                    if isinstance(event, Events.TextMessageEvent):
+                        signal = blinker.signal(event.event_type.name + "_" + event.targetmode.lower())
+                    else:
+                        signal = blinker.signal(event.event_type.name)
+                    # Listeners are called on the receiving thread, so events arrive in the order the
+                    # server sent them. They must not block, EventHandler.on_event only queues them.
+                    try:
+                        signal.send(self.event_sender, event=event)
+                    except BaseException:
+                        self._logger.exception("Error informing listeners of %s", event)
+            else:
+                with self._write_lock:
+                    if len(self._pending) > 0:
+                        self._pending[0][1].append(line)
+        self._fail_pending()
+
+    def quit(self):
+        """
+        Send the quit command and stop receiving. Does nothing if the connection is closed already.
+        """
+        self.disconnect_listeners()
+        if self.stop_recv.is_set():
+            return
+        try:
+            self._send("quit", wait_for_resp=False)
+        finally:
+            self.stop_recv.set()
+
+
+def send_many(ts3conn, queries):
+    """
+    Send several queries and wait for all responses. The queries are pipelined on a
+    PipelinedTS3Connection and sent one after another on any other connection.
+    :param ts3conn: Connection to send the queries on.
+    :type ts3conn: ts3API.TS3Connection.TS3Connection
+    :param queries: Pairs of command and arguments, see TS3Connection._send.
+    :type queries: list[(str, list[str] | None)]
+    :return: Raw response or TS3QueryException for every query.
+    :rtype: list[bytes | TS3QueryException]
+    """
+    results = []
+    if isinstance(ts3conn, PipelinedTS3Connection):
+        futures = [ts3conn.send_async(command, args) for command, args in queries]
+        for future in futures:
+            try:
+                results.append(future.result())
+            except TS3QueryException as e:
+                results.append(e)
+    else:
+        for command, args in queries:
+            try:
+                results.append(ts3conn._send(command, args))
+            except TS3QueryException as e:
+                results.append(e)
+    return results
@@ -0,0 +1,42 @@
+"""Text format of ServerQuery responses and notifications, shared by the EventRecorder and FakeServer."""
+from ts3API import utilities
+
+
+def format_items(items):
+    """
+    Format dictionaries as a ServerQuery response, items are separated by "|".
+    :type items: list[dict[str, object]]
+    :rtype: str
+    """
+    return "|".join(" ".join(key + "=" + utilities.escape(str(value)) for key, value in item.items())
+                    for item in items)
+
+
+def parse_query(line):
+    """
+    Parse a query into its command, options and items.
+    :param line: Query without the line terminator, e.g. "clientmove cid=2 clid=1|clid=2"
+    :type line: str
+    :return: Command, set of options (e.g. "away" for -away) and one dictionary per item. Values
+    without a key are stored under their position, e.g. 0 and 1 for login user password.
+    :rtype: (str, set[str], list[dict[str | int, str]])
+    """
+    command, _, rest = line.partition(" ")
+    options = set()
+    items = []
+    for item_text in rest.split("|"):
+        item = {}
+        positional = 0
+        for part in item_text.split(" "):
+            if len(part) == 0:
+                continue
+            if part.startswith("-"):
+                options.add(part[1:])
+            elif "=" in part:
+                key, value = part.split("=", 1)
+                item[key] = utilities.unescape(value)
+            else:
+                item[positional] = utilities.unescape(part)
+                positional += 1
+        items.append(item)
+    return command, options, items
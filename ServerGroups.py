@@ -0,0 +1,190 @@
+"""Server group cache for the Teamspeak3 Bot."""
+import logging
+import threading
+import time
+
+from ts3API.utilities import TS3ConnectionClosedException, TS3Exception
+
+logger = logging.getLogger("bot")
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(ts3conn, ttl=None):
+    """
+    Get the process wide server group cache for a connection. Creates the cache on first use.
+    :param ts3conn: TS3Connection the cache loads the server groups from.
+    :param ttl: Seconds after which the cached groups are reloaded. Only used when the cache is
+    created or if it is not None.
+    :type ttl: int
+    :return: Server group cache for the connection.
+    :rtype: ServerGroupCache
+    """
+    with _caches_lock:
+        cache = _caches.get(ts3conn)
+        if cache is None:
+            cache = ServerGroupCache(ts3conn, ttl=300 if ttl is None else ttl)
+            _caches[ts3conn] = cache
+        elif ttl is not None:
+            cache.ttl = ttl
+        return cache
+
+
+def remove_cache(ts3conn):
+    """
+    Remove the server group cache of a connection, e.g. when the connection is closed.
+    :param ts3conn: TS3Connection of the cache.
+    """
+    with _caches_lock:
+        _caches.pop(ts3conn, None)
+
+
+class ServerGroupCache(object):
+    """
+    Cache mapping server group ids to names and names to ids. The groups are loaded with
+    servergrouplist on first use and upon calling refresh. After ttl seconds they are reloaded in
+    the background, lookups meanwhile return the old groups.
+    """
+
+    def __init__(self, ts3conn, ttl=300):
+        """
+        Create a new, empty ServerGroupCache.
+        :param ts3conn: TS3Connection to load the server groups from.
+        :param ttl: Seconds after which the cached groups are reloaded, 0 disables reloading.
+        :type ttl: int
+        """
+        self.ts3conn = ts3conn
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._names = {}
+        self._ids = {}
+        self._loaded_at = None
+        self._refreshing = False
+        self._listeners = []
+
+    def add_listener(self, listener):
+        """
+        Add a function to call when the server group list changed on a refresh.
+        :param listener: Function without arguments.
+        """
+        self._listeners.append(listener)
+
+    # We really want to catch all exception here, to prevent one listener from breaking the cache
+    # noinspection PyBroadException
+    def refresh(self):
+        """
+        Reload the server groups from the server.
+        :return: True if the server group list changed.
+        :rtype: bool
+        """
+        names = {}
+        ids = {}
+        for group in self.ts3conn.servergrouplist():
+            sgid = group.get('sgid')
+            name = group.get('name')
+            if sgid is not None and name is not None:
+                names[sgid] = name
+                ids[name] = sgid
+        with self._lock:
+            changed = names != self._names
+            self._names = names
+            self._ids = ids
+            self._loaded_at = time.monotonic()
+        if changed:
+            logger.debug("Server group list changed, informing %d listeners", len(self._listeners))
+            for listener in self._listeners:
+                try:
+                    listener()
+                except BaseException:
+                    logger.exception("Error informing %s of changed server groups", listener)
+        return changed
+
+    def _ensure_loaded(self):
+        """
+        Load the server groups if they were never loaded, start reloading them in the background
+        if the ttl expired.
+        """
+        loaded_at = self._loaded_at
+        if loaded_at is None:
+            try:
+                self.refresh()
+            except TS3Exception:
+                logger.exception("Error loading server groups")
+            return
+        if self.ttl <= 0 or time.monotonic() - loaded_at < self.ttl:
+            return
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._refresh_in_background, name="ServerGroupRefresh", daemon=True).start()
+
+    def _refresh_in_background(self):
+        """
+        Reload the server groups after the ttl expired. Keeps the old groups if reloading fails.
+        """
+        try:
+            self.refresh()
+        except (TS3Exception, TS3ConnectionClosedException):
+            logger.exception("Error refreshing server groups")
+            # Do not retry on every lookup
+            self._loaded_at = time.monotonic()
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def name(self, sgid):
+        """
+        Get the name of a server group.
+        :param sgid: Server group id.
+        :type sgid: int | str
+        :return: Name of the server group or None if there is no such group.
+        :rtype: str | None
+        """
+        self._ensure_loaded()
+        return self._names.get(str(sgid))
+
+    def names(self, sgids):
+        """
+        Get the names of several server groups. Unknown group ids are skipped.
+        :param sgids: Server group ids.
+        :type sgids: collections.abc.Iterable[int | str]
+        :return: List of server group names.
+        :rtype: list[str]
+        """
+        self._ensure_loaded()
+        names = self._names
+        return [names[str(sgid)] for sgid in sgids if str(sgid) in names]
+
+    def sgid(self, name):
+        """
+        Get the id of a server group.
+        :param name: Name of the server group.
+        :type name: str
+        :return: Server group id or None if there is no such group.
+        :rtype: int | None
+        """
+        self._ensure_loaded()
+        sgid = self._ids.get(name)
+        return None if sgid is None else int(sgid)
+
+    def sgids(self, *names):
+        """
+        Get the ids of several server groups. Unknown group names are skipped.
+        :param names: Names of the server groups.
+        :type names: str
+        :return: List of server group ids.
+        :rtype: list[int]
+        """
+        self._ensure_loaded()
+        ids = self._ids
+        return [int(ids[name]) for name in names if name in ids]
+
+    def items(self):
+        """
+        Get all cached server groups.
+        :return: List of (sgid, name) tuples.
+        :rtype: list[tuple[int, str]]
+        """
+        self._ensure_loaded()
+        return [(int(sgid), name) for sgid, name in self._names.items()]
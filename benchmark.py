@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""Throughput benchmarks of the Teamspeak3 Bot against a local FakeServer."""
+import argparse
+import json
+import logging
+import platform
+import statistics
+import sys
+import threading
+import time
+
+import ts3API.Events as Events
+
+import Bot
+import FakeServer
+import LogPipeline
+
+logger = logging.getLogger("bot")
+PLUGINS = {"UtilCommand": "utils", "AfkMover": "afkmover"}
+
+
+def start_bot(server):
+    """
+    Start a bot with the utils and afkmover plugins on a FakeServer. Text messages are not rate
+    limited and events are not dropped, so neither limits the measurements.
+    :type server: FakeServer.FakeServer
+    :rtype: Bot.Ts3Bot
+    """
+    bot = Bot.Ts3Bot(server.host, server.port, serverid=str(server.sid), user="serveradmin",
+                     password="benchmark", defaultchannel="Default Channel", botname="Benchmark",
+                     logger=logger, plugins={"Plugins": dict(PLUGINS)}, eventqueuesize="1000000",
+                     messagerate="1000000", messageburst="1000000")
+    # The AfkMover is driven by the benchmark, stop the one started by the plugin
+    from modules import afkmover
+    mover = afkmover.afk_movers.pop(bot, None)
+    if mover is not None:
+        mover.stopped.set()
+        mover.join()
+    return bot
+
+
+def stop_bot(bot):
+    bot.shutdown()
+
+
+def regular_clients(server):
+    return [clid for clid, client in server.clients.items() if client["client_type"] == 0]
+
+
+def lobby_channels(server):
+    return [cid for cid, channel in server.channels.items() if channel["channel_name"] != FakeServer.AFK_CHANNEL]
+
+
+def bench_events(server, bot, count):
+    """
+    Measure how many client moved events per second the bot receives and hands to its observers.
+    """
+    informed = threading.Semaphore(0)
+    # Clients moving themselves are notified without invoker, ts3API parses them as ClientMovedSelfEvent
+    bot.event_handler.add_observer(lambda _evt: informed.release(), Events.ClientMovedSelfEvent)
+    clids = regular_clients(server)
+    lobbies = lobby_channels(server)
+    start = time.perf_counter()
+    for i in range(count):
+        clid = clids[i % len(clids)]
+        current = lobbies.index(server.clients[clid]["cid"])
+        server.move_client(clid, lobbies[(current + 1) % len(lobbies)])
+    for _ in range(count):
+        if not informed.acquire(timeout=30):
+            raise RuntimeError("Timed out waiting for events")
+    elapsed = time.perf_counter() - start
+    return {"value": count / elapsed, "unit": "events/s", "events": count, "seconds": elapsed}
+
+
+def bench_commands(server, bot, count):
+    """
+    Measure the time from a !hello text message to the reply of the bot.
+    """
+    clids = regular_clients(server)
+    latencies = []
+    for i in range(count):
+        sent = len(server.messages)
+        start = time.perf_counter()
+        server.send_text(clids[i % len(clids)], "!hello", target=bot.identity.client_id)
+        if not server.wait_for_messages(sent + 1, timeout=10):
+            raise RuntimeError("Timed out waiting for a command reply")
+        latencies.append(server.messages[sent][0] - start)
+    latencies.sort()
+    return {"value": statistics.median(latencies) * 1000, "unit": "ms",
+            "mean": statistics.mean(latencies) * 1000,
+            "p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000,
+            "commands": count}
+
+
+def _afk_poll(mover):
+    mover.update_afk_list()
+    away_list, back_list = mover.split_afk_list()
+    mover.move_all_back(back_list)
+    mover.move_to_afk(away_list)
+
+
+def _timed(server, function, *args):
+    queries = sum(server.queries.values())
+    start = time.perf_counter()
+    function(*args)
+    return {"value": (time.perf_counter() - start) * 1000, "unit": "ms",
+            "queries": sum(server.queries.values()) - queries}
+
+
+def bench_afkmover(server, bot, share):
+    """
+    Measure AfkMover polls moving a share of the clients to the AFK channel, back and moving nobody.
+    """
+    from modules import afkmover
+    mover = afkmover.AfkMover(threading.Event(), bot.ts3conn, bot.client_registry, bot.channel_index,
+                              bot.query_connection)
+    clids = regular_clients(server)
+    away = clids[:max(1, int(len(clids) * share))]
+    for clid in away:
+        server.set_away(clid)
+    results = {"afk_poll_away": _timed(server, _afk_poll, mover)}
+    for clid in away:
+        server.set_away(clid, False)
+    results["afk_poll_back"] = _timed(server, _afk_poll, mover)
+    results["afk_poll_idle"] = _timed(server, _afk_poll, mover)
+    results["afk_poll_away"]["moved"] = results["afk_poll_back"]["moved"] = len(away)
+    results["afk_poll_idle"]["moved"] = 0
+    return results
+
+
+def bench_multimove(server, bot):
+    """
+    Measure moving all clients into one channel, like !multimove.
+    """
+    clids = regular_clients(server)
+    target = lobby_channels(server)[-1]
+    moves = [(clid, target) for clid in clids if server.clients[clid]["cid"] != target]
+    result = _timed(server, bot.move_clients, moves)
+    result["moved"] = len(moves)
+    return result
+
+
+def run(populations, latency, events, commands, afk_share):
+    """
+    Run all benchmarks for every client population.
+    :return: One result dictionary per benchmark and population.
+    :rtype: list[dict]
+    """
+    results = []
+    for clients in populations:
+        server = FakeServer.FakeServer(clients=clients, latency=latency)
+        server.start()
+        bot = start_bot(server)
+        try:
+            measured = {"events": bench_events(server, bot, events),
+                        "commands": bench_commands(server, bot, commands)}
+            measured.update(bench_afkmover(server, bot, afk_share))
+            measured["multimove"] = bench_multimove(server, bot)
+        finally:
+            stop_bot(bot)
+            server.stop()
+        for name, result in measured.items():
+            results.append(dict(benchmark=name, clients=clients, **result))
+            print("{:<14} {:>5} clients: {:>10.2f} {}".format(name, clients, result["value"], result["unit"]))
+    return results
+
+
+def compare(results, baseline_file):
+    """
+    Print the change of every result against a previous results file.
+    """
+    with open(baseline_file) as f:
+        baseline = {(result["benchmark"], result["clients"]): result for result in json.load(f)["results"]}
+    for result in results:
+        old = baseline.get((result["benchmark"], result["clients"]))
+        if old is None or old["value"] == 0:
+            continue
+        print("{:<14} {:>5} clients: {:>+7.1f}% ({:.2f} -> {:.2f} {})".format(
+            result["benchmark"], result["clients"], (result["value"] / old["value"] - 1) * 100,
+            old["value"], result["value"], result["unit"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--clients", type=int, nargs="+", default=[10, 100, 1000],
+                        help="client populations to benchmark")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds the server delays every response")
+    parser.add_argument("--events", type=int, default=2000, help="events sent per population")
+    parser.add_argument("--commands", type=int, default=200, help="commands sent per population")
+    parser.add_argument("--afk-share", type=float, default=0.1, help="share of clients set away")
+    parser.add_argument("--output", default="benchmark.json", help="file to write the results to")
+    parser.add_argument("--compare", help="previous results file to compare with")
+    args = parser.parse_args()
+    if not logger.hasHandlers():
+        LogPipeline.file_logger("bot", "bot.log", "%(asctime)s: %(levelname)s: %(message)s")
+    results = run(args.clients, args.latency, args.events, args.commands, args.afk_share)
+    with open(args.output, "w") as f:
+        json.dump({"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": sys.version.split()[0],
+                   "platform": platform.platform(), "latency": args.latency, "results": results}, f, indent=2)
+    print("Results written to " + args.output)
+    if args.compare is not None:
+        compare(results, args.compare)
+    LogPipeline.stop()
+
+
+if __name__ == "__main__":
+    main()
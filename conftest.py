@@ -0,0 +1,66 @@
+"""Fixtures shared by the tests of the Teamspeak3 Bot."""
+import os
+import time
+
+import pytest
+
+
+@pytest.hookimpl(trylast=True)
+def pytest_configure(config):
+    # The bot writes its log files and the quotes file to the working directory, so the tests run
+    # in a temporary one. It is changed before the test modules are collected and import the bot.
+    os.chdir(config._tmp_path_factory.mktemp("workdir"))
+
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@pytest.fixture
+def wait_for():
+    """
+    Function waiting until a condition is true, returns False if the timeout expired.
+    """
+    return _wait_for
+
+
+@pytest.fixture
+def server():
+    import FakeServer
+    server = FakeServer.FakeServer(clients=5)
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def bot(server):
+    """
+    Bot with the utils and afkmover plugins connected to server, see benchmark.start_bot.
+    """
+    import benchmark
+    import Moduleloader
+    bot = benchmark.start_bot(server)
+    yield bot
+    if Moduleloader.detach(bot):
+        Moduleloader.exit_all()
+    benchmark.stop_bot(bot)
+
+
+@pytest.fixture
+def conn(server):
+    """
+    Pipelined connection logged in on the virtual server of server.
+    """
+    import Bot  # noqa: F401, imported first to resolve the circular imports of the bot modules
+    import QueryPipeline
+    conn = QueryPipeline.PipelinedTS3Connection(server.host, server.port, username="serveradmin",
+                                                password="test")
+    conn.use(sid=server.sid)
+    yield conn
+    conn.quit()
@@ -1,15 +1,21 @@
 #!/usr/bin/env python3
+import asyncio
 import logging
 import os
 import sys
 import threading
+from distutils.util import strtobool
 
 from ts3API.utilities import TS3ConnectionClosedException
 
+import AsyncBot
 import Bot
+import LogPipeline
+import Metrics
 
 logger = None
 bot = None
+bots = []
 
 
 def exception_handler(exctype, value, tb):
@@ -30,6 +36,7 @@ def restart_program():
     saving data) must be done before calling this function.
     """
     python = sys.executable
+    LogPipeline.stop()
     os.execl(python, python, * sys.argv)
 
 
@@ -45,24 +52,31 @@ def main():
             run_old(*args, **kwargs)
         except (KeyboardInterrupt, SystemExit, TS3ConnectionClosedException):
             # This is a very ungraceful exit!
+            LogPipeline.stop()
             os._exit(-1)
             raise
         except:
             sys.excepthook(*sys.exc_info())
     threading.Thread.run = run
-    global bot, logger
+    global bot, bots, logger
     logger = logging.getLogger("bot")
     if not logger.hasHandlers():
-        logger.propagate = 0
-        logger.setLevel(logging.INFO)
-        file_handler = logging.FileHandler("bot.log", mode='a+')
-        formatter = logging.Formatter("%(asctime)s: %(levelname)s: %(message)s")
-        file_handler.setFormatter(formatter)
-        logger.addHandler(file_handler)
+        logger = LogPipeline.file_logger("bot", "bot.log", "%(asctime)s: %(levelname)s: %(message)s")
         logger.info('Started')
     sys.excepthook = exception_handler
     config = Bot.Ts3Bot.parse_config(logger)
-    bot = Bot.Ts3Bot.bot_from_config(config)
+    LogPipeline.configure(max_size=config['General'].get('logmaxbytes'),
+                          backups=config['General'].get('logbackupcount'))
+    metrics_port = int(config['General'].get('metricsport', '0'))
+    if metrics_port > 0:
+        Metrics.start_server(metrics_port)
+    if strtobool(config['General'].get('useasyncio', 'False')):
+        bots = AsyncBot.AsyncTs3Bot.bots_from_config(config)
+        bot = bots[0] if len(bots) > 0 else None
+        asyncio.run(AsyncBot.run_all(bots))
+    else:
+        bots = Bot.Ts3Bot.bots_from_config(config)
+        bot = bots[0] if len(bots) > 0 else None
 
 if __name__ == "__main__":
     main()
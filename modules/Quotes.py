@@ -1,38 +1,109 @@
 """Quote module for the Teamspeak 3 Bot. Sends quotes to people joining the server."""
-import codecs
+import os
 import random
+import threading
 
 import ts3API.Events as Events
 
 import Bot
 import Moduleloader
 
-bot: Bot.Ts3Bot
-# Server groups who should not receiver quotes upon joining the server
-dont_send = []
+quotes: 'QuoteFile' = None
+# Guards opening and closing quotes, the setups of several bots run in parallel
+quotes_lock = threading.Lock()
+# Server groups of each bot who should not receiver quotes upon joining the server
+dont_send = {}
 
 
-def random_line(afile):
+class QuoteFile(object):
     """
-    Get a random line from a file.
-    :param afile: File to read from.
-    :return: Random line
+    Quote file with an in-memory index of the offsets of all non-blank quotes, so a random quote
+    can be read without scanning the file. Quotes are separated by line breaks, line breaks inside
+    a quote are stored as LINE_BREAK. Once closed, random_quote returns None and add returns False.
     """
-    line = next(afile)
-    for num, aline in enumerate(afile):
-        if random.randrange(num + 2):
-            continue
-        line = aline
-    return line
+    encoding = "ISO-8859-1"
+    # Stands for a line break inside a quote
+    LINE_BREAK = "\x1f"
+
+    def __init__(self, path):
+        """
+        Open a quote file and index its quotes.
+        :param path: Path of the quote file, created if it does not exist.
+        :type path: str
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._offsets = []
+        with open(path, "ab"):
+            pass
+        self._file = open(path, "rb")
+        offset = 0
+        for line in self._file:
+            if len(line.strip()) > 0:
+                self._offsets.append(offset)
+            offset += len(line)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def random_quote(self):
+        """
+        Get a random quote.
+        :return: Random quote or None if there are no quotes.
+        :rtype: str | None
+        """
+        with self._lock:
+            if self._file.closed or len(self._offsets) == 0:
+                return None
+            self._file.seek(random.choice(self._offsets))
+            line = self._file.readline()
+        return line.decode(QuoteFile.encoding).rstrip("\r\n").replace(QuoteFile.LINE_BREAK, "\n")
+
+    def add(self, q):
+        """
+        Append a quote to the file and the index.
+        :param q: Quote to add, may contain line breaks.
+        :type q: str
+        :return: False if the file is closed.
+        :rtype: bool
+        """
+        q = "\n".join(q.splitlines()).replace("\n", QuoteFile.LINE_BREAK)
+        data = (q + "\n").encode(QuoteFile.encoding)
+        with self._lock:
+            if self._file.closed:
+                return False
+            with open(self.path, "ab") as f:
+                offset = f.seek(0, os.SEEK_END)
+                if offset > 0:
+                    self._file.seek(offset - 1)
+                    if self._file.read(1) != b"\n":
+                        # Terminate the last line first, otherwise the quote would be appended to it
+                        data = b"\n" + data
+                        offset += 1
+                f.write(data)
+            if len(q.strip()) > 0:
+                self._offsets.append(offset)
+        return True
+
+    def close(self):
+        """
+        Close the quote file.
+        """
+        with self._lock:
+            self._file.close()
 
 
 def add(q):
     """
     Add a new quote.
     :param q: Quote to add.
+    :return: False if the quote file is closed, e.g. while the module is reloaded.
+    :rtype: bool
     """
-    with codecs.open("quotes", "a+", "ISO-8859-1") as f:
-        f.write(q+"\n")
+    quote_file = quotes
+    if quote_file is None:
+        return False
+    return quote_file.add(q)
 
 
 @Moduleloader.setup
@@ -41,12 +112,24 @@ def setup_quoter(ts3bot):
     Setup the quoter. Define groups not to send quotes to.
     :return:
     """
-    global bot, dont_send
-    bot = ts3bot
-    ts3conn = bot.ts3conn
-    for g in ts3conn.servergrouplist():
-        if g.get('name', '') in ["Guest", "Admin Server Query"]:
-            dont_send.append(int(g.get('sgid', 0)))
+    global quotes
+    # The quote file is shared by the bots of all virtual servers
+    with quotes_lock:
+        if quotes is None:
+            quotes = QuoteFile("quotes")
+    dont_send[ts3bot] = set(ts3bot.server_groups.sgids("Guest", "Admin Server Query"))
+
+
+@Moduleloader.exit
+def exit_quoter():
+    """
+    Close the quote file.
+    """
+    global quotes
+    with quotes_lock:
+        quote_file, quotes = quotes, None
+    if quote_file is not None:
+        quote_file.close()
 
 
 @Moduleloader.event(Events.ClientEnteredEvent,)
@@ -55,13 +138,16 @@ def inform(evt):
     Send out a quote to joining users.
     :param evt: ClientEnteredEvent
     """
+    bot = Moduleloader.current_bot()
+    excluded = dont_send.get(bot, ())
     for g in evt.client_servergroups.split(','):
-        if len(g) == 0 or int(g) in dont_send:
+        if len(g) == 0 or int(g) in excluded:
             return
-    with codecs.open("quotes", "r", "ISO-8859-1") as f:
-        quote = ""
-        while len(quote) == 0:
-            quote = random_line(f)
+    quote_file = quotes
+    if quote_file is None:
+        return
+    quote = quote_file.random_quote()
+    if quote is not None:
         Bot.send_msg_to_client(bot.ts3conn, evt.client_id, quote)
 
 
@@ -70,8 +156,10 @@ def add_quote(sender, msg):
     """
     Add a quote.
     """
-    if len(msg) > len("!addQuote "):
-        add(msg[len("!addQuote "):])
-        Bot.send_msg_to_client(bot.ts3conn, sender, "Quote '" + msg[len("!addQuote "):] +
-                               "' was added.")
+    if len(msg.rest) > 0:
+        ts3conn = Moduleloader.current_bot().ts3conn
+        if add(msg.rest):
+            Bot.send_msg_to_client(ts3conn, sender, "Quote '" + msg.rest + "' was added.")
+        else:
+            Bot.send_msg_to_client(ts3conn, sender, "Quotes are not available right now, please try again.")
 
@@ -1,6 +1,7 @@
 """AfkMover Module for the Teamspeak3 Bot."""
+import contextlib
 import threading
-import traceback
+import time
 from threading import Thread
 
 import ts3API.Events as Events
@@ -8,43 +9,53 @@ from ts3API.utilities import TS3Exception
 
 from Moduleloader import *
 import Bot
-from typing import Union
+import LogPipeline
+import Metrics
+from typing import Dict
 
-afkMover: Union[None, 'AfkMover'] = None
-afkStopper = threading.Event()
-bot: Bot.Ts3Bot
+# Running AfkMover of each bot
+afk_movers: Dict[Bot.Ts3Bot, 'AfkMover'] = {}
 autoStart = True
 channel_name = "AFK"
+# Seconds between two polls of the away flags, the server does not notify away changes
+poll_interval = 2.0
+afk_moves = Metrics.counter("ts3bot_afk_moves", "Clients moved by the AfkMover", ("direction",))
+afk_poll_seconds = Metrics.histogram("ts3bot_afk_poll_seconds", "Duration of the AfkMover away state polls")
 
 
 class AfkMover(Thread):
     """
     AfkMover class. Moves clients set to afk another channel.
     """
-    logger = logging.getLogger("afk")
-    logger.propagate = 0
-    logger.setLevel(logging.WARNING)
-    file_handler = logging.FileHandler("afk.log", mode='a+')
-    formatter = logging.Formatter('AFK Logger %(asctime)s %(message)s')
-    file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
+    logger = LogPipeline.file_logger("afk", "afk.log", 'AFK Logger %(asctime)s %(message)s', level=logging.WARNING)
     logger.info("Configured afk logger")
-    logger.propagate = 0
 
-    def __init__(self, stop_event, ts3conn):
+    def __init__(self, stop_event, ts3conn, client_registry=None, channel_index=None, query_connection=None):
         """
         Create a new AfkMover object.
         :param stop_event: Event to signalize the AfkMover to stop moving.
         :type stop_event: threading.Event
         :param ts3conn: Connection to use
         :type: TS3Connection
+        :param client_registry: Registry used to skip polling while no clients are connected
+        :type client_registry: ClientRegistry.ClientRegistry
+        :param channel_index: Channel index used to look up the afk channel
+        :type channel_index: ChannelIndex.ChannelIndex
+        :param query_connection: Function returning a context manager that yields the connection for
+        polling and moving, e.g. Ts3Bot.query_connection. Uses ts3conn if None.
         """
         Thread.__init__(self)
         self.stopped = stop_event
         self.ts3conn = ts3conn
+        if query_connection is None:
+            query_connection = lambda: contextlib.nullcontext(ts3conn)
+        self.query_connection = query_connection
+        self.client_registry = client_registry
+        self.channel_index = channel_index
         self.afk_channel = self.get_afk_channel(channel_name)
         self.client_channels = {}
         self.afk_list = None
+        self.interval = poll_interval
         if self.afk_channel is None:
             AfkMover.logger.error("Could not get afk channel")
 
@@ -63,48 +74,46 @@ class AfkMover(Thread):
         Update the list of clients.
         """
         try:
-            self.afk_list = self.ts3conn.clientlist(["away"])
-            AfkMover.logger.debug("Awaylist: " + str(self.afk_list))
+            with self.query_connection() as conn:
+                self.afk_list = conn.clientlist(["away"])
+            AfkMover.logger.debug("Awaylist: %s", self.afk_list)
         except TS3Exception:
             AfkMover.logger.exception("Error getting away list!")
             self.afk_list = list()
 
-    def get_away_list(self):
-        """
-        Get list of clients with afk status.
-        :return: List of clients that are set to afk.
-        """
-        if self.afk_list is not None:
-            AfkMover.logger.debug(str(self.afk_list))
-            awaylist = list()
-            for client in self.afk_list:
-                AfkMover.logger.debug(str(self.afk_list))
-                if "cid" not in client.keys():
-                    AfkMover.logger.error("Client without cid!")
-                    AfkMover.logger.error(str(client))
-                elif "client_away" in client.keys() and client.get("client_away", '0') == '1' \
-                        and int(client.get("cid", '-1')) != int(self.afk_channel):
-                    awaylist.append(client)
-            return awaylist
-        else:
-            AfkMover.logger.error("Clientlist is None!")
-            return list()
-
-    def get_back_list(self):
+    def split_afk_list(self):
         """
-        Get list of clients in the afk channel, but not away.
-        :return: List of clients who are back from afk.
+        Split the client list in a single pass into clients that are away and not in the afk
+        channel and clients that are back, but still in the afk channel.
+        :return: Tuple of the list of away clients and the list of clients who are back.
+        :rtype: (list[dict[str, str]], list[dict[str, str]])
         """
-        clientlist = [client for client in self.afk_list if client.get("client_away", '1') == '0'
-                      and int(client.get("cid", '-1')) == int(self.afk_channel)]
-        return clientlist
+        away_list = list()
+        back_list = list()
+        if self.afk_list is None:
+            AfkMover.logger.error("Clientlist is None!")
+            return away_list, back_list
+        afk_channel = str(self.afk_channel)
+        for client in self.afk_list:
+            cid = client.get("cid")
+            if cid is None:
+                AfkMover.logger.error("Client without cid! %s", client)
+            elif client.get("client_away", '0') == '1':
+                if cid != afk_channel:
+                    away_list.append(client)
+            elif cid == afk_channel:
+                back_list.append(client)
+        return away_list, back_list
 
     def get_afk_channel(self, name="AFK"):
         """
         Get the channel id of the channel specified by name.
         :param name: Channel name
-        :return: Channel id
+        :return: Channel id or None if the channel does not exist
         """
+        if self.channel_index is not None:
+            channels = self.channel_index.find_exact(name) or self.channel_index.find(name)
+            return channels[0].get("cid", '-1') if len(channels) > 0 else None
         try:
             channel = self.ts3conn.channelfind(name)[0].get("cid", '-1')
         except TS3Exception:
@@ -117,61 +126,92 @@ class AfkMover(Thread):
         Move clients to the afk_channel.
         :param clients: List of clients to move.
         """
-        AfkMover.logger.info("Moving clients to afk!")
+        if len(clients) == 0:
+            return
+        AfkMover.logger.info("Moving %d clients to afk!", len(clients))
+        AfkMover.logger.debug("Clients: %s", clients)
+        with self.query_connection() as conn:
+            failed = Bot.move_clients(conn, ((client.get("clid", '-1'), self.afk_channel)
+                                             for client in clients))
         for client in clients:
-            AfkMover.logger.info("Moving somebody to afk!")
-            AfkMover.logger.debug("Client: " + str(client))
-            try:
-                self.ts3conn.clientmove(self.afk_channel, int(client.get("clid", '-1')))
-            except TS3Exception:
-                AfkMover.logger.exception("Error moving client! Clid=" +
-                                          str(client.get("clid", '-1')))
-            self.client_channels[client.get("clid", '-1')] = client.get("cid", '0')
-            AfkMover.logger.debug("Moved List after move: " + str(self.client_channels))
+            clid = client.get("clid", '-1')
+            if int(clid) in failed:
+                AfkMover.logger.error("Error moving client! Clid=%s: %s", clid, failed[int(clid)])
+            else:
+                self.client_channels[clid] = client.get("cid", '0')
+                afk_moves.labels("afk").inc()
+        AfkMover.logger.debug("Moved List after move: %s", self.client_channels)
 
-    def move_all_afk(self):
-        """
-        Move all afk clients.
-        """
-        try:
-            afk_list = self.get_away_list()
-            self.move_to_afk(afk_list)
-        except AttributeError:
-            AfkMover.logger.exception("Connection error!")
-
-    def move_all_back(self):
+    def move_all_back(self, back_list):
         """
         Move all clients who are back from afk.
+        :param back_list: List of clients who are back, but still in the afk channel.
         """
-        back_list = self.get_back_list()
         AfkMover.logger.debug("Moving clients back")
-        AfkMover.logger.debug("Backlist is: %s", str(back_list))
-        AfkMover.logger.debug("Saved channel list keys are: %s\n", str(self.client_channels.keys()))
+        AfkMover.logger.debug("Backlist is: %s", back_list)
+        AfkMover.logger.debug("Saved channel list keys are: %s\n", list(self.client_channels.keys()))
+        moves = []
         for client in back_list:
-            if client.get("clid", -1) in self.client_channels.keys():
+            cid = self.client_channels.pop(client.get("clid", '-1'), None)
+            if cid is not None:
                 AfkMover.logger.info("Moving a client back!")
-                AfkMover.logger.debug("Client: " + str(client))
-                AfkMover.logger.debug("Saved channel list keys:" + str(self.client_channels))
-                self.ts3conn.clientmove(self.client_channels.get(client.get("clid", -1)),
-                                        int(client.get("clid", '-1')))
-                del self.client_channels[client.get("clid", '-1')]
+                AfkMover.logger.debug("Client: %s", client)
+                moves.append((client.get("clid", '-1'), cid))
+        with self.query_connection() as conn:
+            failed = Bot.move_clients(conn, moves)
+        afk_moves.labels("back").inc(len(moves) - len(failed))
+        for clid, e in failed.items():
+            AfkMover.logger.error("Error moving client back! Clid=%d: %s", clid, e)
+
+    def has_clients(self):
+        """
+        Check if there are any clients that could be moved, i.e. regular clients are connected or
+        clients are waiting to be moved back.
+        :rtype: bool
+        """
+        if self.client_registry is None or len(self.client_channels) > 0:
+            return True
+        return any(client.get("client_type", '0') == '0'
+                   for client in self.client_registry.clients())
+
+    def on_client_entered(self, evt):
+        """
+        Move clients that join the server while being away right away.
+        :param evt: ClientEnteredEvent
+        """
+        if evt.client_away == '1' and str(evt.target_channel_id) != str(self.afk_channel):
+            self.move_to_afk([{"clid": str(evt.client_id), "cid": str(evt.target_channel_id)}])
+
+    def on_client_moved(self, evt):
+        """
+        Forget the saved channel of clients who left the afk channel before coming back.
+        :param evt: ClientMovedEvent or ClientMovedSelfEvent
+        """
+        clid = str(evt.client_id)
+        if clid in self.client_channels and str(evt.target_channel_id) != str(self.afk_channel):
+            AfkMover.logger.debug("Client %s left the afk channel, forgetting its channel", clid)
+            self.client_channels.pop(clid, None)
 
     def auto_move_all(self):
         """
-        Loop move functions until the stop signal is sent.
+        Reconcile the away state of all clients until the stop signal is sent. Joining and moving
+        clients are handled by the event listeners in between, the away flag is only available by
+        polling as the server does not send notifications for it.
         """
-        while not self.stopped.wait(2.0):
+        while not self.stopped.wait(self.interval):
             AfkMover.logger.debug("Afkmover running!")
+            if not self.has_clients():
+                continue
+            start = time.perf_counter()
             self.update_afk_list()
             try:
-                self.move_all_back()
-                self.move_all_afk()
+                away_list, back_list = self.split_afk_list()
+                self.move_all_back(back_list)
+                self.move_to_afk(away_list)
+                afk_poll_seconds.observe(time.perf_counter() - start)
             except BaseException:
-                AfkMover.logger.error("Uncaught exception:" + str(sys.exc_info()[0]))
-                AfkMover.logger.error(str(sys.exc_info()[1]))
-                AfkMover.logger.error(traceback.format_exc())
-                AfkMover.logger.error("Saved channel list keys are: %s\n",
-                                      str(self.client_channels.keys()))
+                AfkMover.logger.exception("Uncaught exception, saved channel list keys are: %s",
+                                          list(self.client_channels.keys()))
         AfkMover.logger.warning("AFKMover stopped!")
         self.client_channels = {}
 
@@ -179,23 +219,24 @@ class AfkMover(Thread):
 @command('startafk', 'afkstart', 'afkmove',)
 def start_afkmover(_sender=None, _msg=None):
     """
-    Start the AfkMover by clearing the afkStopper signal and starting the mover.
+    Start the AfkMover of the current bot.
     """
-    global afkMover
-    if afkMover is None:
-        afkMover = AfkMover(afkStopper, bot.ts3conn)
-        afkStopper.clear()
-        afkMover.start()
+    bot = current_bot()
+    if bot not in afk_movers:
+        afk_mover = AfkMover(threading.Event(), bot.ts3conn, bot.client_registry, bot.channel_index,
+                             bot.query_connection)
+        afk_movers[bot] = afk_mover
+        afk_mover.start()
 
 
 @command('stopafk', 'afkstop')
 def stop_afkmover(_sender=None, _msg=None):
     """
-    Stop the AfkMover by setting the afkStopper signal and undefining the mover.
+    Stop the AfkMover of the current bot by setting its stop signal and forgetting the mover.
     """
-    global afkMover
-    afkStopper.set()
-    afkMover = None
+    afk_mover = afk_movers.pop(current_bot(), None)
+    if afk_mover is not None:
+        afk_mover.stopped.set()
 
 
 @command('afkgetclientchannellist')
@@ -203,8 +244,30 @@ def get_afk_list(sender=None, _msg=None):
     """
     Get afkmover saved client channels. Mainly for debugging.
     """
-    if afkMover is not None:
-        Bot.send_msg_to_client(bot.ts3conn, sender, str(afkMover.client_channels))
+    bot = current_bot()
+    afk_mover = afk_movers.get(bot)
+    if afk_mover is not None:
+        Bot.send_msg_to_client(bot.ts3conn, sender, str(afk_mover.client_channels))
+
+
+@event(Events.ClientEnteredEvent,)
+def client_entered(event_data):
+    """
+    Move clients joining while away.
+    """
+    afk_mover = afk_movers.get(current_bot())
+    if afk_mover is not None:
+        afk_mover.on_client_entered(event_data)
+
+
+@event(Events.ClientMovedEvent, Events.ClientMovedSelfEvent,)
+def client_moved(event_data):
+    """
+    Forget clients leaving the afk channel.
+    """
+    afk_mover = afk_movers.get(current_bot())
+    if afk_mover is not None:
+        afk_mover.on_client_moved(event_data)
 
 
 @event(Events.ClientLeftEvent,)
@@ -213,15 +276,14 @@ def client_left(event_data):
     Clean up leaving clients.
     """
     # Forget clients that were set to afk and then left
-    if afkMover is not None:
-        if str(event_data.client_id) in afkMover.client_channels:
-            del afkMover.client_channels[str(event_data.client_id)]
+    afk_mover = afk_movers.get(current_bot())
+    if afk_mover is not None:
+        afk_mover.client_channels.pop(str(event_data.client_id), None)
 
 
 @setup
 def setup(ts3bot, channel=channel_name):
-    global bot, channel_name
-    bot = ts3bot
+    global channel_name
     channel_name = channel
     if autoStart:
         start_afkmover()
@@ -229,10 +291,11 @@ def setup(ts3bot, channel=channel_name):
 
 @exit
 def afkmover_exit():
-    global afkMover
-    if afkMover is not None:
-        afkStopper.set()
-        afkMover.join()
-        afkMover = None
+    afk_movers_list = list(afk_movers.values())
+    afk_movers.clear()
+    for afk_mover in afk_movers_list:
+        afk_mover.stopped.set()
+    for afk_mover in afk_movers_list:
+        afk_mover.join()
 
 
@@ -1,75 +1,261 @@
 """Quote module for the Teamspeak 3 Bot. Sends quotes to people joining the server."""
+import logging
 import os
+import random
 import sqlite3
+import threading
+import time
 
 import ts3API.Events as Events
 
 import Bot
 import Moduleloader
 
-bot: Bot.Ts3Bot
+logger = logging.getLogger("bot")
 path: str
-# Server groups who should not receive quotes upon joining the server
-dont_send = []
+quote_db: 'QuoteDB' = None
+# Guards opening and closing quote_db, the setups of several bots run in parallel
+quote_db_lock = threading.Lock()
+# Server groups of each bot who should not receive quotes upon joining the server
+dont_send = {}
+
+
+class QuoteDB(object):
+    """
+    Long-lived, thread-safe access to the quote database. The connection is opened once in WAL
+    mode and shared by all threads, statements are kept prepared by the sqlite3 statement cache.
+    New quotes and shown counter increments can be queued and are written in a single transaction
+    by a background thread every flush_interval seconds or as soon as max_pending writes are queued.
+    """
+    CREATE_TABLE = ('CREATE TABLE IF NOT EXISTS Quotes (id integer primary key, quote text,'
+                    'submitter text, time text, shown integer)')
+    CREATE_INDEX = 'CREATE UNIQUE INDEX IF NOT EXISTS Quotesididx ON Quotes (id)'
+    INSERT = 'INSERT INTO Quotes (quote, submitter, time, shown) VALUES (?, ?, ?, ?)'
+    ID_RANGE = 'SELECT MIN(id), MAX(id) FROM Quotes'
+    SELECT_ID = 'SELECT id, quote, shown FROM Quotes WHERE id = ?'
+    COUNT = 'SELECT COUNT(*) FROM Quotes'
+    SELECT_AT = 'SELECT id, quote, shown FROM Quotes ORDER BY id LIMIT 1 OFFSET ?'
+    # Random ids tried before falling back to counting the quotes
+    RANDOM_TRIES = 8
+    INCREMENT_SHOWN = 'UPDATE Quotes SET shown=shown+? WHERE id=?'
+
+    def __init__(self, db_path, flush_interval=5.0, max_pending=100):
+        """
+        Open the database and create the quote table if necessary.
+        :param db_path: Path of the database file.
+        :type db_path: str
+        :param flush_interval: Seconds between two flushes of queued writes.
+        :type flush_interval: float
+        :param max_pending: Number of queued writes that triggers a flush.
+        :type max_pending: int
+        """
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending_lock = threading.Lock()
+        self._pending_shown = {}
+        self._pending_quotes = []
+        # Set by close, no writes are queued afterwards
+        self._closed = False
+        self._flush_now = threading.Event()
+        self._stopped = threading.Event()
+        self._flusher = None
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(QuoteDB.CREATE_TABLE)
+        self._conn.execute(QuoteDB.CREATE_INDEX)
+        self._conn.commit()
+
+    def random_quote(self):
+        """
+        Get a random quote. Picks random ids between the smallest and largest id until one exists,
+        so every quote is equally likely even if ids are missing. If the ids are sparse, a random
+        row of the table is taken instead.
+        :return: Tuple of id, quote and times shown or None if there are no quotes or the database
+                 is closed.
+        :rtype: (int, str, int) | None
+        """
+        with self._lock:
+            if self._closed:
+                return None
+            min_id, max_id = self._conn.execute(QuoteDB.ID_RANGE).fetchone()
+            if min_id is None:
+                return None
+            for _ in range(QuoteDB.RANDOM_TRIES):
+                quote = self._conn.execute(QuoteDB.SELECT_ID, (random.randint(min_id, max_id),)).fetchone()
+                if quote is not None:
+                    return quote
+            count = self._conn.execute(QuoteDB.COUNT).fetchone()[0]
+            return self._conn.execute(QuoteDB.SELECT_AT, (random.randrange(count),)).fetchone()
+
+    def queue_add(self, quote, submitter):
+        """
+        Queue a new quote to be saved with the next flush.
+        :param quote: Quote to save.
+        :param submitter: Nickname of the client who submitted the quote.
+        :return: False if the database is closed and the quote was not queued.
+        :rtype: bool
+        """
+        with self._pending_lock:
+            if self._closed:
+                return False
+            self._pending_quotes.append((quote, submitter, str(int(time.time())), 0))
+        self._check_pending()
+        return True
+
+    def queue_shown(self, quote_id):
+        """
+        Queue an increment of the shown counter of a quote for the next flush.
+        :param quote_id: Id of the quote.
+        :return: False if the database is closed and the increment was not queued.
+        :rtype: bool
+        """
+        with self._pending_lock:
+            if self._closed:
+                return False
+            self._pending_shown[quote_id] = self._pending_shown.get(quote_id, 0) + 1
+        self._check_pending()
+        return True
+
+    def _check_pending(self):
+        """
+        Wake up the flusher if too many writes are queued.
+        """
+        if len(self._pending_quotes) + len(self._pending_shown) >= self.max_pending:
+            self._flush_now.set()
+
+    def flush(self):
+        """
+        Write all queued quotes and counter increments in a single transaction. If the transaction
+        fails, the writes are queued again for the next flush.
+        """
+        with self._pending_lock:
+            quotes = self._pending_quotes
+            shown = self._pending_shown
+            self._pending_quotes = []
+            self._pending_shown = {}
+        if len(quotes) == 0 and len(shown) == 0:
+            return
+        try:
+            with self._lock:
+                with self._conn:
+                    self._conn.executemany(QuoteDB.INSERT, quotes)
+                    self._conn.executemany(QuoteDB.INCREMENT_SHOWN,
+                                           [(count, quote_id) for quote_id, count in shown.items()])
+        except BaseException:
+            with self._pending_lock:
+                self._pending_quotes[:0] = quotes
+                for quote_id, count in shown.items():
+                    self._pending_shown[quote_id] = self._pending_shown.get(quote_id, 0) + count
+            raise
+
+    def start_flusher(self):
+        """
+        Start the background thread flushing queued writes.
+        """
+        self._flusher = threading.Thread(target=self._flush_loop, name="QuoteDB-flusher",
+                                         daemon=True)
+        self._flusher.start()
+
+    # We really want to catch all exception here, a failed flush must not stop the flusher
+    # noinspection PyBroadException
+    def _flush_loop(self):
+        """
+        Flush queued writes until the database is closed.
+        """
+        while not self._stopped.is_set():
+            self._flush_now.wait(self.flush_interval)
+            self._flush_now.clear()
+            try:
+                self.flush()
+            except BaseException:
+                logger.exception("Error flushing queued quote writes")
+
+    def close(self):
+        """
+        Stop the flusher, write all queued writes and close the database connection.
+        """
+        with self._pending_lock:
+            self._closed = True
+        self._stopped.set()
+        self._flush_now.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.flush()
+        with self._lock:
+            self._conn.close()
 
 
 @Moduleloader.setup
-def setup_quoter(ts3bot, db):
+def setup_quoter(ts3bot, db, flushinterval="5", flushsize="100"):
     """
     Setup the quoter. Define groups not to send quotes to.
+    :param db: Path of the quote database, relative to the modules directory if not absolute.
+    :param flushinterval: Seconds between writing queued quotes and shown counters to the database.
+    :param flushsize: Number of queued writes that triggers writing them right away.
     :return:
     """
-    global bot, dont_send, path
-    bot = ts3bot
-    ts3conn = bot.ts3conn
-    for g in ts3conn.servergrouplist():
-        if g.get('name', '') in ["Guest", "Admin Server Query"]:
-            dont_send.append(int(g.get('sgid', 0)))
-    if not os.path.isabs(db):
-        path = os.path.dirname(__file__)
-        path = os.path.join(path, db)
-    else:
-        path = db
-    path = os.path.abspath(path)
-    # setup and connect to database
-    conn = sqlite3.connect(path)
-    curs = conn.cursor()
-    curs.execute('CREATE TABLE IF NOT EXISTS Quotes (id integer primary key, quote text,'
-                 'submitter text, time text, shown integer)')
-    curs.execute('CREATE UNIQUE INDEX IF NOT EXISTS Quotesididx ON Quotes (id)')
-    conn.commit()
-    conn.close()
+    global path, quote_db
+    dont_send[ts3bot] = set(ts3bot.server_groups.sgids("Guest", "Admin Server Query"))
+    # The database is shared by the bots of all virtual servers
+    with quote_db_lock:
+        if quote_db is not None:
+            return
+        if not os.path.isabs(db):
+            path = os.path.dirname(__file__)
+            path = os.path.join(path, db)
+        else:
+            path = db
+        path = os.path.abspath(path)
+        # setup and connect to database
+        quote_db = QuoteDB(path, flush_interval=float(flushinterval), max_pending=int(flushsize))
+        quote_db.start_flusher()
+
+
+@Moduleloader.exit
+def exit_quoter():
+    """
+    Write queued quotes and counters and close the database.
+    """
+    global quote_db
+    with quote_db_lock:
+        db, quote_db = quote_db, None
+    if db is not None:
+        db.close()
 
 
 @Moduleloader.command('quote',)
 def add_quote(sender, msg):
-    if len(msg) <= len('!quote '):
+    bot = Moduleloader.current_bot()
+    if len(msg.rest) == 0:
         Bot.send_msg_to_client(bot.ts3conn, sender, 'Please include a quote to save.')
     else:
-        conn = sqlite3.connect(path)
-        c = conn.cursor()
-        quote = msg[len('!quote')+1:]
+        quote = msg.rest
         quote = quote.replace('" ', '"\n')
-        submitter = bot.ts3conn.clientinfo(sender)
+        submitter = bot.client_registry.get(sender)
+        if submitter is None:
+            submitter = bot.ts3conn.clientinfo(sender)
         submitter = submitter['client_nickname']
-        c.execute('INSERT INTO Quotes (quote, submitter, time, shown) VALUES (?, ?,'
-                  'strftime("%s", "now"), ?)', (quote, submitter, 0))
-        conn.commit()
-        conn.close()
+        db = quote_db
+        if db is None or not db.queue_add(quote, submitter):
+            Bot.send_msg_to_client(bot.ts3conn, sender, 'Quotes are not available right now, please try again.')
+            return
         Bot.send_msg_to_client(bot.ts3conn, sender, 'Your quote has been saved!')
 
 
 @Moduleloader.event(Events.ClientEnteredEvent,)
 def send_quote(evt):
+    bot = Moduleloader.current_bot()
+    excluded = dont_send.get(bot, ())
     for g in evt.client_servergroups.split(','):
-        if len(g) == 0 or int(g) in dont_send:
+        if len(g) == 0 or int(g) in excluded:
             return
-    conn = sqlite3.connect(path)
-    c = conn.cursor()
-    c.execute('SELECT * FROM Quotes ORDER BY RANDOM() LIMIT 1')
-    quote = c.fetchone()
+    db = quote_db
+    if db is None:
+        return
+    quote = db.random_quote()
+    if quote is None:
+        return
     Bot.send_msg_to_client(bot.ts3conn, evt.client_id, quote[1])
-    c.execute('UPDATE Quotes SET shown=? WHERE id=?', (quote[4] + 1, quote[0]))
-    conn.commit()
-    conn.close()
-
+    db.queue_shown(quote[0])
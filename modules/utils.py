@@ -1,63 +1,69 @@
 from ts3API.TS3Connection import TS3QueryException
 
 import Bot
+import Metrics
 import Moduleloader
+import Profiler
 from Moduleloader import *
 
 __version__ = "0.4"
-bot: Bot.Ts3Bot
 logger = logging.getLogger("bot")
 
 
-@Moduleloader.setup
-def setup(ts3bot):
-    global bot
-    bot = ts3bot
-
-
 @command('hello', )
 @group('Server Admin', )
+@allow_prefix
 def hello(sender, _msg):
+    bot = current_bot()
     Bot.send_msg_to_client(bot.ts3conn, sender, "Hello Admin!")
 
 
 @command('hello', )
 @group('Moderator', )
+@allow_prefix
 def hello(sender, _msg):
+    bot = current_bot()
     Bot.send_msg_to_client(bot.ts3conn, sender, "Hello Moderator!")
 
 
 @command('hello', )
 @group('Normal', )
+@allow_prefix
 def hello(sender, _msg):
+    bot = current_bot()
     Bot.send_msg_to_client(bot.ts3conn, sender, "Hello Casual!")
 
 
 @command('kickme', 'fuckme')
 @group('.*', )
 def kickme(sender, _msg):
+    bot = current_bot()
     ts3conn = bot.ts3conn
     ts3conn.clientkick(sender, 5, "Whatever.")
 
 
 @command('mtest', )
 def mtest(_sender, msg):
+    bot = current_bot()
     print("MTES")
-    channels = msg[len("!mtest "):].split()
+    channels = msg.args
     print(channels)
-    ts3conn = bot.ts3conn
-    print(ts3conn.channelfind(channels[0]))
+    print(bot.channel_index.find(channels[0]))
 
 
 @command('multimove', 'mm')
 @group('Server Admin', 'Moderator')
 def multi_move(sender, msg):
     """
-    Move all clients from one channel to another.
+    Move all clients from one channel to another. Channel names containing spaces can be quoted,
+    unquoted names are split where the source (and if possible the destination) is an existing
+    channel name.
     :param sender: Client id of sender that sent the command.
     :param msg: Sent command.
+    :type msg: CommandHandler.CommandMessage
     """
-    channels = msg.split()[1:]
+    bot = current_bot()
+    channels = msg.args
     source_name = ""
     dest_name = ""
     source = None
@@ -66,13 +72,18 @@ def multi_move(sender, msg):
     if len(channels) < 2:
         if sender != 0:
             Bot.send_msg_to_client(ts3conn, sender, "Usage: multimove source destination")
-            return
+        return
     elif len(channels) > 2:
-        channel_name_list = ts3conn.channel_name_list()
-        for channel_name in channel_name_list:
-            if msg[len("!multimove "):].startswith(channel_name):
-                source_name = channel_name
-                dest_name = msg[len("!multimove ") + len(source_name) + 1:]
+        channel_names = set(bot.channel_index.names())
+        splits = [(" ".join(channels[:i]), " ".join(channels[i:])) for i in range(1, len(channels))]
+        splits = [split for split in splits if split[0] in channel_names]
+        exact_splits = [split for split in splits if split[1] in channel_names]
+        if len(exact_splits) == 1 or len(exact_splits) == 0 and len(splits) == 1:
+            source_name, dest_name = (exact_splits or splits)[0]
+        elif len(splits) > 1:
+            Bot.send_msg_to_client(ts3conn, sender, "Ambiguous channel names, please put them in "
+                                                    "double quotes")
+            return
     else:
         source_name = channels[0]
         dest_name = channels[1]
@@ -82,43 +93,36 @@ def multi_move(sender, msg):
     if dest_name == "":
         Bot.send_msg_to_client(ts3conn, sender, "Destination channel not found")
         return
-    try:
-        channel_matches = ts3conn.channelfind(source_name)
-        channel_candidates = [chan for chan in channel_matches if
-                              chan.get("channel_name", '-1').startswith(source_name)]
-        if len(channel_candidates) == 1:
-            source = channel_candidates[0].get("cid", '-1')
-        elif len(channel_candidates) == 0:
-            Bot.send_msg_to_client(ts3conn, sender, "Source channel could not be found.")
-        else:
-            channels = [chan.get('channel_name') for chan in channel_candidates]
-            Bot.send_msg_to_client(ts3conn, sender,
-                                   "Multiple source channels found: " + ", ".join(channels))
-    except TS3QueryException:
-        Bot.send_msg_to_client(ts3conn, sender, "Source channel not found")
-    try:
-        channel_matches = ts3conn.channelfind(dest_name)
-        channel_candidates = [chan for chan in channel_matches if
-                              chan.get("channel_name", '-1').startswith(dest_name)]
-        if len(channel_candidates) == 1:
-            dest = channel_candidates[0].get("cid", '-1')
-        elif len(channel_candidates) == 0:
-            Bot.send_msg_to_client(ts3conn, sender, "Destination channel could not be found.")
-        else:
-            channels = [chan.get('channel_name') for chan in channel_candidates]
-            Bot.send_msg_to_client(ts3conn, sender,
-                                   "Multiple destination channels found: " + ", ".join(channels))
-    except TS3QueryException:
-        Bot.send_msg_to_client(ts3conn, sender, "Destination channel not found")
+    channel_candidates = bot.channel_index.find_exact(source_name) or \
+        bot.channel_index.find_prefix(source_name)
+    if len(channel_candidates) == 1:
+        source = channel_candidates[0].get("cid", '-1')
+    elif len(channel_candidates) == 0:
+        Bot.send_msg_to_client(ts3conn, sender, "Source channel could not be found.")
+    else:
+        channels = [chan.get('channel_name') for chan in channel_candidates]
+        Bot.send_msg_to_client(ts3conn, sender,
+                               "Multiple source channels found: " + ", ".join(channels))
+    channel_candidates = bot.channel_index.find_exact(dest_name) or \
+        bot.channel_index.find_prefix(dest_name)
+    if len(channel_candidates) == 1:
+        dest = channel_candidates[0].get("cid", '-1')
+    elif len(channel_candidates) == 0:
+        Bot.send_msg_to_client(ts3conn, sender, "Destination channel could not be found.")
+    else:
+        channels = [chan.get('channel_name') for chan in channel_candidates]
+        Bot.send_msg_to_client(ts3conn, sender,
+                               "Multiple destination channels found: " + ", ".join(channels))
     if source is not None and dest is not None:
         try:
-            client_list = ts3conn.clientlist()
-            client_list = [client for client in client_list if client.get("cid", '-1') == source]
+            client_list = bot.client_registry.in_channel(source)
             for client in client_list:
-                clid = client.get("clid", '-1')
-                logger.info("Found client in channel: " + client.get("client_nickname",
-                                                                     "") + " id = " + clid)
-                ts3conn.clientmove(int(dest), int(clid))
+                logger.info("Found client in channel: %s id = %s", client.get("client_nickname", ""),
+                            client.get("clid", '-1'))
+            failed = bot.move_clients((client.get("clid", '-1'), dest) for client in client_list)
+            for clid, e in failed.items():
+                Bot.send_msg_to_client(ts3conn, sender, "Error moving client " + str(clid) + ": id = " +
+                                       str(e.id) + " " + e.message)
         except TS3QueryException as e:
             Bot.send_msg_to_client(ts3conn, sender,
                                    "Error moving clients: id = " + str(e.id) + e.message)
@@ -126,35 +130,158 @@ def multi_move(sender, msg):
 
 @command('version', )
 @group('.*')
+@allow_prefix
 def send_version(sender, _msg):
+    bot = current_bot()
     Bot.send_msg_to_client(bot.ts3conn, sender, __version__)
 
 
 @command('whoami', )
 @group('.*')
+@allow_prefix
 def whoami(sender, _msg):
+    bot = current_bot()
     Bot.send_msg_to_client(bot.ts3conn, sender, "None of your business!")
 
 
+def _quit(bots):
+    """
+    Quit bots. The modules are shared by the bots of all virtual servers, so their exit functions
+    are only called when the last bot quits.
+    :param bots: Bots to quit.
+    :type bots: list[Bot.Ts3Bot]
+    """
+    last = False
+    for bot in bots:
+        last = Moduleloader.detach(bot)
+    if last:
+        Moduleloader.exit_all()
+    for bot in bots:
+        bot.shutdown()
+        logger.warning("Bot of server %s was quit!", bot.sid)
+
+
 @command('stop', )
 @group('Server Admin', )
-def stop_bot(_sender, _msg):
-    Moduleloader.exit_all()
-    bot.ts3conn.quit()
-    logger.warning("Bot was quit!")
+def stop_bot(_sender, msg):
+    if msg.args[:1] == ('all', ):
+        _quit(list(Moduleloader.bots))
+    else:
+        _quit([current_bot()])
 
 
 @command('restart', )
 @group('Server Admin', 'Moderator', )
 def restart_bot(_sender, _msg):
-    Moduleloader.exit_all()
-    bot.ts3conn.quit()
-    logger.warning("Bot was quit!")
+    # Restarts the process, which runs the bots of all virtual servers
+    _quit(list(Moduleloader.bots))
     import main
     main.restart_program()
 
 
+@command('reload', )
+@group('Server Admin', )
+def reload_modules(sender, msg):
+    """
+    Reload a plugin or all plugins without restarting the bot, config.ini is read again.
+    :param sender: Client id of sender that sent the command.
+    :param msg: Sent command.
+    :type msg: CommandHandler.CommandMessage
+    """
+    bot = current_bot()
+    if len(msg.args) != 1:
+        Bot.send_msg_to_client(bot.ts3conn, sender, "Usage: reload plugin|all")
+        return
+    if msg.args[0] == "all":
+        failed = Moduleloader.reload_all()
+        if len(failed) > 0:
+            Bot.send_msg_to_client(bot.ts3conn, sender, "Could not reload: " + ", ".join(failed))
+        else:
+            Bot.send_msg_to_client(bot.ts3conn, sender, "Reloaded all plugins")
+    elif Moduleloader.reload_module(msg.args[0].lower()):
+        Bot.send_msg_to_client(bot.ts3conn, sender, "Reloaded " + msg.args[0])
+    else:
+        Bot.send_msg_to_client(bot.ts3conn, sender, "Could not reload " + msg.args[0])
+
+
+@command('refreshgroups', )
+@group('Server Admin', )
+def refresh_groups(sender, _msg):
+    bot = current_bot()
+    try:
+        bot.server_groups.refresh()
+    except TS3QueryException:
+        logger.exception("Error refreshing server groups")
+        Bot.send_msg_to_client(bot.ts3conn, sender, "Error refreshing server groups!")
+        return
+    Bot.send_msg_to_client(bot.ts3conn, sender, "Server groups refreshed: " +
+                           ", ".join(name for _, name in bot.server_groups.items()))
+
+
+@command('permstats', )
+@group('Server Admin', )
+@allow_prefix
+def permission_stats(sender, _msg):
+    bot = current_bot()
+    stats = bot.command_handler.permissions.stats
+    Bot.send_msg_to_client(bot.ts3conn, sender, "Permission checks: {hits} cache hits, {misses} misses, "
+                                                "{cached} cached decisions".format(**stats))
+
+
+@command('stats', )
+@group('Server Admin', )
+@allow_prefix
+def send_stats(sender, _msg):
+    bot = current_bot()
+    Bot.send_msg_to_client(bot.ts3conn, sender, Metrics.REGISTRY.summary() or "No metrics recorded yet")
+
+
+@command('profile', )
+@group('Server Admin', )
+def profile(sender, msg):
+    """
+    Control profiling of commands, plugin modules and event types:
+        !profile start command|module|event name [sample] - Profile every sample-th call
+        !profile stop command|module|event name [top] - Stop, dump a pstats file and send the top functions
+        !profile list - List the running captures
+    :param sender: Client id of sender that sent the command.
+    :param msg: Sent command.
+    :type msg: CommandHandler.CommandMessage
+    """
+    bot = current_bot()
+    args = msg.args
+    usage = "Usage: profile start|stop command|module|event name [sample|top], profile list"
+    if len(args) == 1 and args[0] == "list":
+        captures = Profiler.captures()
+        if len(captures) == 0:
+            Bot.send_msg_to_client(bot.ts3conn, sender, "No running captures")
+        for capture in captures:
+            Bot.send_msg_to_client(bot.ts3conn, sender, "{} {}: {} of {} calls profiled".format(
+                capture.kind, capture.name, capture.profiled, capture.calls))
+        return
+    if len(args) < 3 or args[0] not in ("start", "stop") or args[1] not in Profiler.KINDS:
+        Bot.send_msg_to_client(bot.ts3conn, sender, usage)
+        return
+    try:
+        number = int(args[3]) if len(args) > 3 else None
+    except ValueError:
+        Bot.send_msg_to_client(bot.ts3conn, sender, usage)
+        return
+    if args[0] == "start":
+        Profiler.start(args[1], args[2], sample=number or 1)
+        Bot.send_msg_to_client(bot.ts3conn, sender, "Profiling " + args[1] + " " + args[2])
+        return
+    capture = Profiler.stop(args[1], args[2])
+    if capture is None:
+        Bot.send_msg_to_client(bot.ts3conn, sender, "Not profiling " + args[1] + " " + args[2])
+        return
+    filename = capture.dump()
+    Bot.send_msg_to_client(bot.ts3conn, sender, capture.summary(number or 10) + "\nWritten to " + filename)
+
+
 @command('commandlist', )
 @group('Server Admin', 'Moderator', )
+@allow_prefix
 def get_command_list(sender, _msg):
+    bot = current_bot()
     Bot.send_msg_to_client(bot.ts3conn, sender, str(list(bot.command_handler.handlers.keys())))
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""Replay recorded events into a bot with stubbed queries, see EventRecorder."""
+import argparse
+import configparser
+import logging
+import sys
+
+import Bot
+import EventRecorder
+import LogPipeline
+import Metrics
+import Moduleloader
+
+logger = logging.getLogger("bot")
+
+
+class ReplayBot(Bot.Ts3Bot):
+    """
+    Bot using a StubTS3Connection instead of connecting to a server.
+    """
+
+    def __init__(self, stub, *args, **kwargs):
+        self.stub = stub
+        super().__init__(*args, **kwargs)
+
+    def new_connection(self):
+        return self.stub
+
+
+def initial_state(filename, sid):
+    """
+    Get the snapshots a recording of a virtual server starts with.
+    :rtype: list[EventRecorder.Snapshot]
+    """
+    snapshots = []
+    for _, _, record in EventRecorder.read_records(filename, sid):
+        if not isinstance(record, EventRecorder.Snapshot):
+            break
+        snapshots.append(record)
+    return snapshots
+
+
+def plugins_from_args(plugins, config_file):
+    """
+    Get the plugin configuration: the Plugins section and plugin sections of the config file, or the
+    given plugins if not None.
+    :param plugins: Comma separated Name=module pairs, e.g. AfkMover=afkmover.
+    :type plugins: str | None
+    :rtype: dict[str, dict[str, str]]
+    """
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    sections = {name: dict(section) for name, section in config.items() if name != "DEFAULT"}
+    sections.pop("General", None)
+    if plugins is not None:
+        sections["Plugins"] = dict(plugin.split("=", 1) for plugin in plugins.split(",") if "=" in plugin)
+    sections.setdefault("Plugins", {})
+    return sections
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("recording", help="file written with RecordEvents")
+    parser.add_argument("--sid", default="1", help="virtual server whose events are replayed")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="replay speed, 1 for real time, 10 for ten times faster, 0 as fast as possible")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds every stubbed query takes")
+    parser.add_argument("--plugins", help="plugins to load as Name=module,..., default from the config file")
+    parser.add_argument("--config", default="config.ini", help="config file to read the plugins from")
+    parser.add_argument("--workers", default="4", help="event worker threads")
+    args = parser.parse_args()
+    if not logger.hasHandlers():
+        LogPipeline.file_logger("bot", "bot.log", "%(asctime)s: %(levelname)s: %(message)s")
+    stub = EventRecorder.StubTS3Connection(latency=args.latency)
+    for snapshot in initial_state(args.recording, args.sid):
+        stub.load(snapshot)
+    channel = stub.channels.get(str(stub.whoami_data.get("client_channel_id")), {}).get("channel_name", "")
+    bot = ReplayBot(stub, "replay", 0, serverid=args.sid, user="", password="", defaultchannel=channel,
+                    botname="Replay", logger=logger, plugins=plugins_from_args(args.plugins, args.config),
+                    eventworkers=args.workers, eventqueuesize=str(sys.maxsize))
+    replayer = EventRecorder.EventReplayer(bot.event_handler, stub=stub, speed=args.speed)
+    result = replayer.replay(EventRecorder.read_records(args.recording, args.sid))
+    replayer.wait_idle()
+    print("Replayed {events} events in {seconds:.2f} s, at most {max_lag:.3f} s behind".format(**result))
+    print("Queries: " + ", ".join("{}={}".format(command, count) for command, count in stub.queries.most_common()))
+    print(Metrics.REGISTRY.summary())
+    Moduleloader.exit_all()
+    LogPipeline.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Server group cache and permission engine."""
+import threading
+import time
+
+import Bot  # noqa: F401, imported first to resolve the circular imports of the bot modules
+import ClientInfo
+import Permissions
+import ServerGroups
+
+
+class _GroupConnection(object):
+    """
+    Answers servergrouplist, optionally blocking until released.
+    """
+
+    def __init__(self, groups):
+        self.groups = groups
+        self.queries = 0
+        self.release = threading.Event()
+        self.release.set()
+
+    def servergrouplist(self):
+        self.queries += 1
+        self.release.wait(5)
+        return [{"sgid": sgid, "name": name} for sgid, name in self.groups.items()]
+
+
+def test_groups_are_loaded_on_first_use():
+    cache = ServerGroups.ServerGroupCache(_GroupConnection({"6": "Server Admin", "8": "Guest"}))
+    assert cache.names(["6", "8", "42"]) == ["Server Admin", "Guest"]
+    assert cache.sgids("Guest", "Unknown") == [8]
+    assert cache.ts3conn.queries == 1
+
+
+def test_expired_groups_are_reloaded_in_the_background(wait_for):
+    conn = _GroupConnection({"6": "Server Admin"})
+    cache = ServerGroups.ServerGroupCache(conn, ttl=60)
+    assert cache.name(6) == "Server Admin"
+    conn.groups = {"6": "Admin"}
+    conn.release.clear()
+    cache._loaded_at -= 61
+    # The lookup returns the old name instead of waiting for the reload
+    start = time.monotonic()
+    assert cache.name(6) == "Server Admin"
+    assert time.monotonic() - start < 1
+    assert cache.name(6) == "Server Admin"
+    conn.release.set()
+    assert wait_for(lambda: cache.name(6) == "Admin")
+    assert conn.queries == 2
+
+
+def test_changed_groups_inform_listeners():
+    conn = _GroupConnection({"6": "Server Admin"})
+    cache = ServerGroups.ServerGroupCache(conn)
+    changes = []
+    cache.add_listener(lambda: changes.append(True))
+    assert cache.refresh()
+    assert not cache.refresh()
+    conn.groups = {"6": "Admin"}
+    assert cache.refresh()
+    assert changes == [True, True]
+
+
+def test_caches_are_removed_with_their_connection():
+    conn = _GroupConnection({})
+    cache = ServerGroups.get_cache(conn, ttl=10)
+    assert ServerGroups.get_cache(conn) is cache
+    ServerGroups.remove_cache(conn)
+    assert conn not in ServerGroups._caches
+
+
+def _client(conn, groups, database_id="5"):
+    return ClientInfo.ClientInfo(1, conn, client_data={"client_database_id": database_id,
+                                                       "client_servergroups": groups})
+
+
+def test_permission_decisions_are_cached_per_groups():
+    conn = _GroupConnection({"6": "Server Admin", "8": "Guest"})
+    ServerGroups.get_cache(conn)
+    engine = Permissions.PermissionEngine(["Server Admin"])
+
+    def handler():
+        pass
+
+    try:
+        assert not engine.check(handler, _client(conn, "8"))
+        cached = _client(conn, "8")
+        assert not engine.check(handler, cached)
+        # A hit does not resolve the group names
+        assert cached._servergroups is None
+        assert engine.check(handler, _client(conn, "8,6"))
+        assert engine.stats == {"hits": 1, "misses": 2, "cached": 1}
+    finally:
+        ServerGroups.remove_cache(conn)
+
+
+def test_permission_patterns_follow_registration():
+    conn = _GroupConnection({"7": "Moderator"})
+    ServerGroups.get_cache(conn)
+    engine = Permissions.PermissionEngine(["Server Admin"])
+
+    def handler():
+        pass
+
+    try:
+        assert not engine.check(handler, _client(conn, "7"))
+        handler.allowed_groups = ["Mod.*"]
+        engine.register(handler)
+        assert engine.check(handler, _client(conn, "7"))
+        engine.clear()
+        assert engine.stats["cached"] == 0
+    finally:
+        ServerGroups.remove_cache(conn)
@@ -0,0 +1,88 @@
+"""Channel index kept current from channel events."""
+import threading
+
+import ts3API.Events as Events
+
+import Bot  # noqa: F401, imported first to resolve the circular imports of the bot modules
+import ChannelIndex
+import EventRecorder
+
+CHANNELS = [{"cid": "1", "pid": "0", "channel_order": "0", "channel_name": "Default Channel"},
+            {"cid": "2", "pid": "0", "channel_order": "1", "channel_name": "AFK"},
+            {"cid": "3", "pid": "1", "channel_order": "0", "channel_name": "Team A"}]
+
+
+def _stub(latency=0.0):
+    stub = EventRecorder.StubTS3Connection(latency=latency)
+    stub.load(EventRecorder.Snapshot("channellist", [dict(channel) for channel in CHANNELS]))
+    return stub
+
+
+def _edited(cid, name):
+    return Events.ChannelEditedEvent({"cid": str(cid), "reasonid": "10", "invokerid": "1",
+                                      "invokername": "Admin", "invokeruid": "admin", "channel_name": name})
+
+
+def test_lookups():
+    index = ChannelIndex.ChannelIndex(_stub())
+    assert [channel["cid"] for channel in index.find_exact("AFK")] == ["2"]
+    assert [channel["cid"] for channel in index.find_prefix("Team")] == ["3"]
+    assert [channel["cid"] for channel in index.find("channel")] == ["1"]
+    assert [channel["cid"] for channel in index.match("^[AT]")] == ["2", "3"]
+    assert [channel["cid"] for channel in index.children(0)] == ["1", "2"]
+
+
+def test_concurrent_lookups_load_once():
+    stub = _stub(latency=0.2)
+    index = ChannelIndex.ChannelIndex(stub)
+    threads = [threading.Thread(target=index.find_exact, args=("AFK", )) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert stub.queries["channellist"] == 1
+
+
+def test_events_update_the_index_without_reloading():
+    stub = _stub()
+    index = ChannelIndex.ChannelIndex(stub)
+    index.load()
+    for i in range(10):
+        index.on_event(_edited(2, "AFK " + str(i)))
+    index.on_event(Events.ChannelCreatedEvent({"cid": "4", "cpid": "0", "channel_name": "New", "invokerid": "1",
+                                               "invokername": "Admin", "invokeruid": "admin"}))
+    index.on_event(Events.ChannelDeletedEvent({"cid": "3", "invokerid": "1", "invokername": "Admin",
+                                               "invokeruid": "admin"}))
+    assert index.find_exact("AFK") == []
+    assert [channel["cid"] for channel in index.find_exact("AFK 9")] == ["2"]
+    assert [channel["cid"] for channel in index.find_exact("New")] == ["4"]
+    assert index.get(3) is None
+    assert stub.queries["channellist"] == 1
+
+
+def test_events_for_unknown_channels_reload_the_index():
+    stub = _stub()
+    index = ChannelIndex.ChannelIndex(stub)
+    index.load()
+    stub.load(EventRecorder.Snapshot("channellist", CHANNELS + [{"cid": "9", "pid": "0", "channel_order": "2",
+                                                                 "channel_name": "Missed"}]))
+    index.on_event(_edited(9, "Missed"))
+    assert [channel["cid"] for channel in index.find_exact("Missed")] == ["9"]
+    assert stub.queries["channellist"] == 2
+
+
+def test_events_received_while_loading_are_kept():
+    stub = _stub()
+    index = ChannelIndex.ChannelIndex(stub)
+    channellist = stub.channellist
+
+    def edited_while_loading():
+        # The list was sent before the edit
+        channels = channellist()
+        index.on_event(_edited(2, "Away"))
+        return channels
+
+    stub.channellist = edited_while_loading
+    index.load()
+    assert [channel["cid"] for channel in index.find_exact("Away")] == ["2"]
+    assert stub.queries["channellist"] == 1
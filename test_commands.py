@@ -0,0 +1,70 @@
+"""Command parsing and resolution of the CommandHandler."""
+import Bot
+import CommandHandler
+import Moduleloader
+
+
+def _handler():
+    def handler(_sender, _msg):
+        pass
+    return handler
+
+
+def _command_handler(prefixed=(), full=()):
+    command_handler = CommandHandler.CommandHandler(None, identity=Bot.BotIdentity())
+    for command in prefixed:
+        command_handler.add_handler(Moduleloader.allow_prefix(_handler()), command)
+    for command in full:
+        command_handler.add_handler(_handler(), command)
+    return command_handler
+
+
+def test_tokenize_groups_quoted_words():
+    assert CommandHandler.tokenize('move "AFK Channel" Lobby') == ["move", "AFK Channel", "Lobby"]
+    assert CommandHandler.tokenize("a  b\tc") == ["a", "b", "c"]
+
+
+def test_tokenize_falls_back_on_unbalanced_quotes():
+    assert CommandHandler.tokenize('say "hello world') == ["say", '"hello', "world"]
+
+
+def test_command_message_parts():
+    msg = CommandHandler.CommandMessage('!multimove "Channel 1" Lobby')
+    assert msg == '!multimove "Channel 1" Lobby'
+    assert msg.name == "multimove"
+    assert msg.args == ("Channel 1", "Lobby")
+    assert msg.rest == '"Channel 1" Lobby'
+    assert CommandHandler.CommandMessage("!").name == ""
+
+
+def test_unique_prefixes_resolve_only_allowed_commands():
+    command_handler = _command_handler(prefixed=("version", "stats"), full=("stop", "multimove"))
+    assert command_handler.resolve("vers") == "version"
+    assert command_handler.resolve("version") == "version"
+    assert command_handler.resolve("stop") == "stop"
+    assert command_handler.resolve("sto") is None
+    assert command_handler.resolve("multi") is None
+    # Too short
+    assert command_handler.resolve("ve") is None
+
+
+def test_ambiguous_prefixes_do_not_resolve():
+    command_handler = _command_handler(prefixed=("stats", "start"))
+    assert command_handler.resolve("sta") is None
+    assert command_handler.resolve("stat") == "stats"
+    assert command_handler.resolve("star") == "start"
+    # A prefix shared with a command typed in full is ambiguous as well
+    command_handler = _command_handler(prefixed=("stats", ), full=("stop", ))
+    assert command_handler.resolve("sta") == "stats"
+    assert command_handler.resolve("st") is None
+
+
+def test_aliases_and_index_updates():
+    command_handler = _command_handler(full=("multimove", ))
+    command_handler.add_alias("mm", "multimove")
+    assert command_handler.resolve("mm") == "multimove"
+    handler = _handler()
+    command_handler.add_handler(handler, "hello")
+    assert command_handler.resolve("hello") == "hello"
+    command_handler.remove_handler(handler, "hello")
+    assert command_handler.resolve("hello") is None
@@ -0,0 +1,93 @@
+"""EventDispatcher and observer resolution of the EventHandler."""
+import threading
+
+import ts3API.Events as Events
+
+import Bot  # noqa: F401, imported first to resolve the circular imports of the bot modules
+import EventHandler
+
+
+class _CommandHandler(object):
+    def inform(self, _evt):
+        pass
+
+
+def _moved(clid):
+    return Events.ClientMovedSelfEvent({"ctid": "2", "reasonid": "0", "clid": str(clid)})
+
+
+def test_one_observer_sees_submitted_order(wait_for):
+    dispatcher = EventHandler.EventDispatcher(workers=4)
+    received = []
+
+    def observer(evt):
+        received.append(evt.client_id)
+
+    try:
+        for clid in range(200):
+            dispatcher.submit(observer, _moved(clid))
+        assert wait_for(lambda: len(received) == 200)
+        assert received == list(range(200))
+    finally:
+        dispatcher.stop()
+
+
+def test_full_queue_drops_events(wait_for):
+    dispatcher = EventHandler.EventDispatcher(workers=1, max_queue_size=2)
+    release = threading.Event()
+    received = []
+
+    def observer(evt):
+        release.wait(5)
+        received.append(evt.client_id)
+
+    try:
+        assert dispatcher.submit(observer, _moved(1))
+        # The worker holds the first event, the queue takes two more
+        assert wait_for(lambda: dispatcher.in_flight == 1)
+        assert dispatcher.submit(observer, _moved(2))
+        assert dispatcher.submit(observer, _moved(3))
+        assert not dispatcher.submit(observer, _moved(4))
+        assert dispatcher.dropped == 1
+        release.set()
+        assert wait_for(lambda: len(received) == 3)
+        assert received == [1, 2, 3]
+    finally:
+        release.set()
+        dispatcher.stop()
+
+
+def test_failing_observer_does_not_stop_the_workers(wait_for):
+    dispatcher = EventHandler.EventDispatcher(workers=1)
+    received = []
+
+    def failing(_evt):
+        raise ValueError("observer failed")
+
+    try:
+        dispatcher.submit(failing, _moved(1))
+        dispatcher.submit(lambda evt: received.append(evt.client_id), _moved(2))
+        assert wait_for(lambda: received == [2])
+    finally:
+        dispatcher.stop()
+
+
+def test_observers_are_resolved_by_event_class():
+    handler = EventHandler.EventHandler(None, _CommandHandler(), workers=1)
+    try:
+        def moved(_evt):
+            pass
+
+        def every(_evt):
+            pass
+
+        handler.add_observer(moved, Events.ClientMovedSelfEvent)
+        assert moved in handler.get_obs_for_event(_moved(1))
+        assert every not in handler.get_obs_for_event(_moved(1))
+        # The resolved observers are cached per class until the observers change
+        handler.add_observer(every, Events.TS3Event)
+        assert set(handler.get_obs_for_event(_moved(1))) == {moved, every}
+        handler.remove_observer(moved, Events.ClientMovedSelfEvent)
+        assert handler.get_obs_for_event(_moved(1)) == (every,)
+    finally:
+        handler.stop()
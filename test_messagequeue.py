@@ -0,0 +1,66 @@
+"""Rate limited text message queue."""
+import threading
+
+import MessageQueue
+
+
+class RecordingConnection(object):
+    """
+    Connection stand-in recording the sent text messages.
+    """
+
+    def __init__(self):
+        self.stop_recv = threading.Event()
+        self.messages = []
+
+    def sendtextmessage(self, targetmode, target, msg):
+        self.messages.append((target, msg))
+
+
+def test_short_messages_are_not_split():
+    assert MessageQueue.split_message("hello", 10) == ["hello"]
+    assert MessageQueue.split_message("", 10) == [""]
+
+
+def test_split_counts_encoded_bytes():
+    msg = "ä" * 10 + "😀" * 5
+    parts = MessageQueue.split_message(msg, 7)
+    assert all(len(part.encode("utf-8")) <= 7 for part in parts)
+    assert "".join(parts) == msg
+    assert parts[:3] == ["äää", "äää", "äää"]
+
+
+def test_split_prefers_line_breaks():
+    parts = MessageQueue.split_message("first line\nsecond ä line\nthird", 16)
+    assert parts == ["first line", "second ä line", "third"]
+
+
+def test_lines_longer_than_a_message_are_cut():
+    parts = MessageQueue.split_message("x\n" + "ü" * 6, 8)
+    assert parts == ["x", "üüüü", "üü"]
+
+
+def test_waiting_messages_are_merged_and_sent_on_stop():
+    conn = RecordingConnection()
+    queue = MessageQueue.MessageQueue(conn, rate=1000, burst=1000)
+    for i in range(3):
+        queue.send(1, "line " + str(i))
+    queue.send(2, "other")
+    queue.start()
+    queue.stop(timeout=5)
+    assert not queue.running
+    assert conn.messages == [(1, "line 0\nline 1\nline 2"), (2, "other")]
+    assert queue.merged == 2
+
+
+def test_closed_queues_are_replaced():
+    conn = RecordingConnection()
+    queue = MessageQueue.get_queue(conn)
+    assert MessageQueue.get_queue(conn) is queue
+    MessageQueue.close_queue(conn)
+    replaced = MessageQueue.get_queue(conn)
+    try:
+        assert replaced is not queue
+        assert replaced.running
+    finally:
+        MessageQueue.close_queue(conn, timeout=0)
@@ -0,0 +1,29 @@
+"""Batched client moves."""
+from ts3API.TS3QueryExceptionType import TS3QueryExceptionType
+
+import Bot
+import benchmark
+
+
+def test_moves_are_sent_in_chunks(server, conn):
+    clids = [server.add_client(notify=False) for _ in range(7)]
+    first, second = benchmark.lobby_channels(server)[1:3]
+    moves = [(clid, first) for clid in clids[:5]] + [(clid, second) for clid in clids[5:]]
+    assert Bot.move_clients(conn, moves, chunk_size=2) == {}
+    # 5 clients in chunks of 2 and 2 clients in one chunk
+    assert server.queries["clientmove"] == 4
+    assert all(server.clients[clid]["cid"] == first for clid in clids[:5])
+    assert all(server.clients[clid]["cid"] == second for clid in clids[5:])
+
+
+def test_failed_chunks_are_retried_per_client(server, conn):
+    clids = [server.add_client(notify=False) for _ in range(3)]
+    target = benchmark.lobby_channels(server)[1]
+    server.move_client(clids[0], target)
+    missing = max(server.clients) + 100
+    failed = Bot.move_clients(conn, [(clid, target) for clid in clids] + [(missing, target)], chunk_size=10)
+    # The client already in the channel counts as moved, only the unknown client failed
+    assert list(failed) == [missing]
+    assert failed[missing].type == TS3QueryExceptionType.CLIENT_INVALID_ID
+    assert server.queries["clientmove"] == 1 + 4
+    assert all(server.clients[clid]["cid"] == target for clid in clids)
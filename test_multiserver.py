@@ -0,0 +1,41 @@
+"""Bots of several virtual servers in one process must only handle the events of their own server."""
+import time
+
+import Bot
+import benchmark
+import FakeServer
+import Moduleloader
+
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_no_cross_talk():
+    servers = [FakeServer.FakeServer(clients=3, sid=sid) for sid in (1, 2)]
+    bots = []
+    try:
+        for server in servers:
+            server.start()
+            bots.append(benchmark.start_bot(server))
+        first, second = servers
+        # Both servers hand out the same client ids, a leaked command would be answered on the second
+        clid = benchmark.regular_clients(first)[0]
+        first.send_text(clid, "!version", target=bots[0].identity.client_id)
+        assert first.wait_for_messages(1, timeout=5)
+        joined = first.add_client(nickname="Only on server 1")
+        assert _wait_for(lambda: bots[0].client_registry.get(joined) is not None)
+        time.sleep(0.2)
+        assert len(second.messages) == 0
+        assert all(client["client_nickname"] != "Only on server 1" for client in bots[1].client_registry.clients())
+    finally:
+        for bot in bots:
+            benchmark.stop_bot(bot)
+        Moduleloader.exit_all()
+        for server in servers:
+            server.stop()
@@ -0,0 +1,59 @@
+"""Pool of additional query connections."""
+import pytest
+from ts3API.utilities import TS3Exception
+
+import Bot  # noqa: F401, imported first to resolve the circular imports of the bot modules
+import ConnectionPool
+import QueryPipeline
+
+
+@pytest.fixture
+def pool(server):
+    def connect(_index):
+        conn = QueryPipeline.PipelinedTS3Connection(server.host, server.port, username="serveradmin",
+                                                    password="test")
+        conn.use(sid=server.sid)
+        return conn
+
+    pool = ConnectionPool.ConnectionPool(connect, 2)
+    yield pool
+    pool.close()
+
+
+def test_connections_are_borrowed_and_returned(pool):
+    assert pool.open() == 2
+    with pool.connection() as first:
+        with pool.connection() as second:
+            assert first is not second
+            assert pool.available == 0
+            assert len(first.clientlist()) > 0
+    assert pool.available == 2
+
+
+def test_fallback_without_connections(server, conn):
+    pool = ConnectionPool.ConnectionPool(lambda index: None, 1)
+    with pool.connection(fallback=conn) as borrowed:
+        assert borrowed is conn
+    with pytest.raises(TS3Exception):
+        with pool.connection():
+            pass
+
+
+def test_fallback_when_all_connections_are_borrowed(pool, conn):
+    pool.open()
+    with pool.connection() as first, pool.connection() as second:
+        with pool.connection(fallback=conn, timeout=0.01) as borrowed:
+            assert borrowed is conn
+            assert borrowed not in (first, second)
+
+
+def test_closed_connections_are_reopened(pool, wait_for):
+    pool.open()
+    with pool.connection() as borrowed:
+        borrowed.quit()
+    assert wait_for(lambda: pool.alive == 2 and pool.available == 2)
+    connections = []
+    with pool.connection() as first, pool.connection() as second:
+        connections = [first, second]
+    assert borrowed not in connections
+    assert all(not conn.stop_recv.is_set() for conn in connections)
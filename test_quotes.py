@@ -0,0 +1,133 @@
+"""Quote file of the Quotes plugin and quote database of the phrasendrescher plugin."""
+import collections
+import sqlite3
+
+import pytest
+
+import Bot  # noqa: F401, imported first to resolve the circular imports of the bot modules
+import Moduleloader
+
+
+@pytest.fixture(scope="module")
+def plugins():
+    """
+    The Quotes and phrasendrescher modules. Importing them registers their setups and commands,
+    they are removed again so bots started by later tests do not load them.
+    """
+    from modules import Quotes, phrasendrescher
+    yield Quotes, phrasendrescher
+    for module in (Quotes, phrasendrescher):
+        Moduleloader._forget(module.__name__)
+
+
+def test_quote_file_indexes_quotes(plugins, tmp_path):
+    quotes, _ = plugins
+    path = tmp_path / "quotes"
+    path.write_bytes(b"first\n\n   \nsecond")
+    quote_file = quotes.QuoteFile(str(path))
+    try:
+        assert len(quote_file) == 2
+        assert quote_file.add("third")
+        assert len(quote_file) == 3
+        # The unterminated last line was terminated before appending
+        assert path.read_bytes() == b"first\n\n   \nsecond\nthird\n"
+        assert {quote_file.random_quote() for _ in range(100)} == {"first", "second", "third"}
+    finally:
+        quote_file.close()
+
+
+def test_quote_file_keeps_multi_line_quotes(plugins, tmp_path):
+    quotes, _ = plugins
+    path = str(tmp_path / "quotes")
+    quote_file = quotes.QuoteFile(path)
+    quote_file.add("first line\r\nsecond line")
+    quote_file.close()
+    quote_file = quotes.QuoteFile(path)
+    try:
+        assert len(quote_file) == 1
+        assert quote_file.random_quote() == "first line\nsecond line"
+    finally:
+        quote_file.close()
+
+
+def test_closed_quote_file(plugins, tmp_path):
+    quotes, _ = plugins
+    quote_file = quotes.QuoteFile(str(tmp_path / "quotes"))
+    quote_file.add("quote")
+    quote_file.close()
+    assert quote_file.random_quote() is None
+    assert not quote_file.add("another quote")
+
+
+def test_quote_db_writes_on_flush(plugins, tmp_path):
+    _, phrasendrescher = plugins
+    db = phrasendrescher.QuoteDB(str(tmp_path / "quotes.db"), max_pending=1000)
+    try:
+        assert db.random_quote() is None
+        assert db.queue_add("first", "Alice")
+        assert db.random_quote() is None
+        db.flush()
+        quote_id, quote, shown = db.random_quote()
+        assert (quote, shown) == ("first", 0)
+        db.queue_shown(quote_id)
+        db.queue_shown(quote_id)
+        db.flush()
+        assert db.random_quote()[2] == 2
+    finally:
+        db.close()
+
+
+def test_quote_db_keeps_writes_of_failed_flushes(plugins, tmp_path):
+    _, phrasendrescher = plugins
+    db = phrasendrescher.QuoteDB(str(tmp_path / "quotes.db"))
+    try:
+        db.queue_add("first", "Alice")
+        db.flush()
+        quote_id = db.random_quote()[0]
+        db._conn.execute("CREATE TEMP TRIGGER fail BEFORE INSERT ON Quotes "
+                         "BEGIN SELECT RAISE(ABORT, 'disk full'); END")
+        db.queue_add("second", "Bob")
+        db.queue_shown(quote_id)
+        with pytest.raises(sqlite3.DatabaseError):
+            db.flush()
+        # Written neither partially
+        assert db.random_quote()[2] == 0
+        db.queue_add("third", "Carol")
+        db._conn.execute("DROP TRIGGER fail")
+        db.flush()
+        quotes = {db.random_quote()[1:] for _ in range(200)}
+        assert quotes == {("first", 1), ("second", 0), ("third", 0)}
+    finally:
+        db.close()
+
+
+def test_quote_db_picks_quotes_uniformly(plugins, tmp_path):
+    _, phrasendrescher = plugins
+    db = phrasendrescher.QuoteDB(str(tmp_path / "quotes.db"))
+    try:
+        for quote in ("a", "b", "c"):
+            db.queue_add(quote, "Alice")
+        db.flush()
+        # A large gap in front of the last quote must not make it more likely
+        db._conn.execute("UPDATE Quotes SET id=1000 WHERE quote='c'")
+        db._conn.commit()
+        counts = collections.Counter(db.random_quote()[1] for _ in range(3000))
+        assert all(800 < count < 1200 for count in counts.values())
+    finally:
+        db.close()
+
+
+def test_closed_quote_db(plugins, tmp_path):
+    _, phrasendrescher = plugins
+    db = phrasendrescher.QuoteDB(str(tmp_path / "quotes.db"))
+    db.queue_add("first", "Alice")
+    db.close()
+    assert not db.queue_add("second", "Bob")
+    assert not db.queue_shown(1)
+    assert db.random_quote() is None
+    db = phrasendrescher.QuoteDB(str(tmp_path / "quotes.db"))
+    try:
+        # Queued writes are flushed on close
+        assert db.random_quote()[1] == "first"
+    finally:
+        db.close()
@@ -0,0 +1,47 @@
+"""Client registry and the lookup of command senders."""
+import benchmark
+import FakeServer
+
+
+def test_registry_follows_client_events(server, bot, wait_for):
+    registry = bot.client_registry
+    assert {int(client["clid"]) for client in registry.clients()} == set(server.clients)
+    clid = server.add_client(nickname="Joined")
+    assert wait_for(lambda: registry.get(clid) is not None)
+    assert registry.get(clid)["client_nickname"] == "Joined"
+    target = benchmark.lobby_channels(server)[1]
+    server.move_client(clid, target)
+    assert wait_for(lambda: clid in [int(client["clid"]) for client in registry.in_channel(target)])
+    server.remove_client(clid)
+    assert wait_for(lambda: registry.get(clid) is None)
+    assert clid not in [int(client["clid"]) for client in registry.in_servergroup(FakeServer.DEFAULT_GROUP)]
+
+
+def test_registry_follows_server_group_events(server, bot, wait_for):
+    registry = bot.client_registry
+    clid = benchmark.regular_clients(server)[0]
+    server.set_server_group(clid, 6)
+    assert wait_for(lambda: "6" in registry.get(clid)["client_servergroups"].split(","))
+    assert clid in [int(client["clid"]) for client in registry.in_servergroup(6)]
+    server.set_server_group(clid, 6, member=False)
+    assert wait_for(lambda: "6" not in registry.get(clid)["client_servergroups"].split(","))
+
+
+def test_commands_use_the_registry(server, bot):
+    clid = benchmark.regular_clients(server)[0]
+    queried = server.queries["clientinfo"]
+    server.send_text(clid, "!version", target=bot.identity.client_id)
+    assert server.wait_for_messages(1, timeout=5)
+    assert server.queries["clientinfo"] == queried
+
+
+def test_denied_commands_query_the_client(server, bot):
+    clid = benchmark.regular_clients(server)[0]
+    # The server does not announce this promotion, the registry still has the old groups
+    server.set_server_group(clid, 6, notify=False)
+    queried = server.queries["clientinfo"]
+    server.send_text(clid, "!multimove", target=bot.identity.client_id)
+    assert server.wait_for_messages(1, timeout=5)
+    assert server.messages[-1][2].startswith("Usage")
+    assert server.queries["clientinfo"] == queried + 1
+    assert "6" in bot.client_registry.get(clid)["client_servergroups"].split(",")
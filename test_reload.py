@@ -0,0 +1,21 @@
+"""Reloading plugins on running bots."""
+import time
+
+import benchmark
+import Moduleloader
+
+
+def test_reloaded_commands_are_registered_once(server, bot):
+    config = {"Plugins": dict(benchmark.PLUGINS)}
+    for _ in range(2):
+        assert Moduleloader.reload_module("UtilCommand", config=config)
+    assert len(bot.command_handler.handlers["version"]) == 1
+    clid = benchmark.regular_clients(server)[0]
+    server.send_text(clid, "!version", target=bot.identity.client_id)
+    assert server.wait_for_messages(1, timeout=5)
+    time.sleep(0.2)
+    assert len(server.messages) == 1
+
+
+def test_unknown_plugins_are_not_reloaded(bot):
+    assert not Moduleloader.reload_module("Unknown", config={"Plugins": dict(benchmark.PLUGINS)})